@@ -0,0 +1,20 @@
+"""
+Crash-safe file replacement for files read by other processes
+"""
+
+import os
+from pathlib import Path
+
+def fsync_path(path: Path):
+    """Flush a file or directory entry to disk"""
+    fd = os.open(str(path), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def atomic_replace(tmp_path: Path, path: Path):
+    """fsync a fully written temp file and rename it over the target"""
+    fsync_path(tmp_path)
+    os.replace(tmp_path, path)
+    fsync_path(path.parent)
@@ -0,0 +1,102 @@
+"""
+Request coalescing for model inference
+
+Concurrent callers submit single items; items that arrive within a short
+window are run through the model together and each caller receives its
+own row of the batched result.
+"""
+
+import asyncio
+import time
+from concurrent.futures import Executor
+from typing import Any, Callable, List, Optional, Sequence, Tuple
+import structlog
+
+logger = structlog.get_logger()
+
+class MicroBatcher:
+    """Collects concurrent submissions into batches for a single model call"""
+
+    def __init__(
+        self,
+        batch_fn: Callable[[List[Any]], Sequence[Any]],
+        window_ms: float,
+        max_batch_size: int,
+        name: str = "batcher",
+        executor: Optional[Executor] = None
+    ):
+        self.batch_fn = batch_fn
+        self.executor = executor
+        self.window_s = max(window_ms, 0.0) / 1000.0
+        self.max_batch_size = max(max_batch_size, 1)
+        self.name = name
+
+        self._pending: List[Tuple[Any, asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+
+        # Counters for monitoring
+        self.batches = 0
+        self.items = 0
+
+    async def submit(self, item: Any) -> Any:
+        """Submit one item and wait for its result from the batched call"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.window_s, self._flush)
+
+        return await future
+
+    def _flush(self):
+        """Hand the pending items to a batch run"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        if not self._pending:
+            return
+
+        batch, self._pending = self._pending, []
+        asyncio.ensure_future(self._run_batch(batch))
+
+    async def _run_batch(self, batch: List[Tuple[Any, asyncio.Future]]):
+        """Run the batch function and resolve every caller's future"""
+        items = [item for item, _ in batch]
+        start_time = time.perf_counter()
+
+        try:
+            if self.executor is not None:
+                loop = asyncio.get_running_loop()
+                results = await loop.run_in_executor(self.executor, self.batch_fn, items)
+            else:
+                results = self.batch_fn(items)
+        except Exception as e:
+            logger.error(f"{self.name} batch of {len(items)} failed: {str(e)}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        self.batches += 1
+        self.items += len(items)
+
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+        logger.debug(
+            f"{self.name} ran batch of {len(items)} in "
+            f"{(time.perf_counter() - start_time) * 1000:.1f}ms"
+        )
+
+    def get_stats(self) -> dict:
+        """Get batching statistics"""
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch_size": round(self.items / self.batches, 2) if self.batches else 0.0
+        }
@@ -17,6 +17,20 @@ class Settings(BaseSettings):
     SHOPIFY_API_SECRET: str
     SHOPIFY_SCOPES: str = "read_products"
     APP_URL: str
+    SHOPIFY_API_BASE_URL: Optional[str] = None  # Admin API origin override, e.g. fake_shopify.py
+    
+    # Catalog ingestion: rest pages, bulk GraphQL export, or auto by product count
+    SHOPIFY_INGEST_MODE: str = "auto"
+    SHOPIFY_BULK_MIN_PRODUCTS: int = 10000
+    SHOPIFY_BULK_POLL_INTERVAL_SECONDS: float = 2.0
+    SHOPIFY_BULK_TIMEOUT_SECONDS: float = 3600.0
+    
+    # Shopify API rate limits (per shop, shared by all jobs in a process)
+    SHOPIFY_REST_BUCKET_SIZE: int = 40  # starting guess; responses report the real size
+    SHOPIFY_GRAPHQL_BUCKET_SIZE: int = 1000  # query cost points
+    SHOPIFY_GRAPHQL_RESTORE_RATE: float = 50.0  # cost points per second
+    SHOPIFY_RATE_LIMIT_HEADROOM: float = 0.1  # share of each bucket left for other API clients
+    SHOPIFY_API_RETRIES: int = 5  # attempts after a throttled response
     
     # Database
     DATABASE_URL: str
@@ -34,14 +48,105 @@ class Settings(BaseSettings):
     
     # ML Configuration
     CLIP_MODEL: str = "ViT-B/32"
-    FAISS_INDEX_TYPE: str = "Flat"
+    FAISS_INDEX_TYPE: str = "Flat"  # Flat, HNSW, IVFPQ, auto
     MAX_PRODUCTS_PHASE0: int = 5000
+    INFERENCE_BACKEND: str = "torch"  # torch, torchscript, onnx, onnx-int8
+    MODEL_ARTIFACT_DIR: Optional[str] = None  # defaults to a models/ dir next to FAISS_DIR
     
     # Performance
     MAX_IMAGE_SIZE_MB: int = 8
     SEARCH_RESULT_LIMIT: int = 24
     EMBEDDING_DIMENSION: int = 512
     
+    EMBEDDING_BATCH_SIZE: int = 32
+    
+    FAST_PREPROCESS: bool = True  # JPEG draft decode + vectorized normalization
+    MODEL_WARMUP: bool = True
+    
+    # ANN index selection (FAISS_INDEX_TYPE=auto) and search knobs
+    AUTO_INDEX_HNSW_MIN_VECTORS: int = 20000
+    AUTO_INDEX_IVFPQ_MIN_VECTORS: int = 200000
+    HNSW_M: int = 32
+    IVFPQ_CODE_SIZE: int = 64  # bytes per vector, for IVFPQ and pq storage
+    FAISS_NPROBE: int = 16
+    FAISS_EF_SEARCH: int = 64
+    FAISS_STORAGE: str = "float32"  # float32, fp16, sq8 or pq for Flat/HNSW vectors
+    FAISS_RERANK_FACTOR: int = 4  # candidates per result re-scored exactly for compressed indices
+    FAISS_FILTER_EXACT_MAX_IDS: int = 4096  # filters matching at most this many products scan them exactly
+    FAISS_REDUCE_DIM: int = 0  # project stored vectors to e.g. 128 or 256 dims, 0 disables
+    FAISS_REDUCE_METHOD: str = "pca"  # pca or opq
+    FAISS_REDUCE_SCOPE: str = "shop"  # shop trains per shop, global uses ml_tools train-transform output
+    
+    # Index residency
+    INDEX_MEMORY_BUDGET_MB: int = 2048
+    INDEX_MMAP: bool = True  # memory-map IVF indices in read-only (API) processes
+    INDEX_RELOAD_INTERVAL_SECONDS: float = 5.0  # 0 disables hot-reload polling
+    
+    # Shopify HTTP client (one pooled connection set per ShopifyClient)
+    HTTP_TIMEOUT_SECONDS: float = 30.0
+    HTTP_MAX_CONNECTIONS: int = 64
+    HTTP_MAX_KEEPALIVE_CONNECTIONS: int = 32
+    HTTP_KEEPALIVE_EXPIRY_SECONDS: float = 30.0
+    HTTP2: bool = True  # needs the h2 package (httpx[http2])
+    
+    # Product image downloads
+    IMAGE_DOWNLOAD_CONCURRENCY: int = 32
+    IMAGE_DOWNLOAD_PER_HOST: int = 16
+    IMAGE_DOWNLOAD_RETRIES: int = 3
+    IMAGE_DOWNLOAD_BACKOFF_SECONDS: float = 0.5  # base of jittered exponential backoff
+    IMAGE_DOWNLOAD_MAX_MB: float = 20.0
+    
+    # Staged ingestion (fetch -> download -> decode -> embed -> index)
+    INGEST_QUEUE_SIZE: int = 256  # items waiting in front of each stage
+    INGEST_DOWNLOAD_WORKERS: int = 4  # each downloads a batch of up to IMAGE_DOWNLOAD_CONCURRENCY images
+    INGEST_DECODE_WORKERS: int = 4
+    INGEST_EMBED_WORKERS: int = 1  # each runs EMBEDDING_BATCH_SIZE images per forward pass
+    INGEST_INDEX_BATCH_SIZE: int = 256  # products per DB commit and FAISS upsert
+    INGEST_PROGRESS_INTERVAL_SECONDS: float = 1.0
+    
+    # Product embedding store reused across indexing runs
+    EMBEDDING_STORE_PATH: Optional[str] = None  # defaults to embeddings.sqlite next to FAISS_DIR
+    
+    # Query embedding cache
+    QUERY_CACHE_BACKEND: str = "memory"  # memory, sqlite, none
+    QUERY_CACHE_MAX_ENTRIES: int = 10000
+    QUERY_CACHE_MAX_MB: float = 32.0
+    QUERY_CACHE_TTL_SECONDS: float = 3600.0
+    QUERY_CACHE_PATH: Optional[str] = None  # sqlite backend, defaults to TMP_DIR
+    
+    # Executors
+    INFERENCE_THREADS: int = 2
+    DECODE_PROCESSES: int = 0  # 0 decodes on the inference threads
+    TORCH_INTRA_OP_THREADS: int = 0  # 0 keeps torch default
+    TORCH_INTER_OP_THREADS: int = 0
+    
+    # Query micro-batching
+    QUERY_BATCH_WINDOW_MS: float = 5.0
+    QUERY_BATCH_MAX_SIZE: int = 16
+    SEARCH_BATCH_MAX_IMAGES: int = 16  # images per /search/batch request
+    
+    # Text queries
+    TEXT_BATCH_MAX_SIZE: int = 64
+    TEXT_CACHE_BACKEND: str = "memory"  # memory or none
+    TEXT_CACHE_MAX_ENTRIES: int = 50000
+    TEXT_CACHE_MAX_MB: float = 128.0
+    
+    # Precomputed similar products
+    SIMILAR_PRODUCTS_ENABLED: bool = True
+    SIMILAR_PRODUCTS_K: int = 24
+    SIMILAR_SEARCH_BATCH_SIZE: int = 4096  # query rows per index.search call
+    SIMILAR_FULL_REBUILD_RATIO: float = 0.2  # rebuild the table when more products changed
+    
+    # Multi-crop queries
+    QUERY_CROP_MAX_REGIONS: int = 17  # whole image plus a 4x4 grid
+    QUERY_FUSION_RRF_K: int = 60
+    
+    # Near-duplicate products
+    DUPLICATE_THRESHOLD: float = 0.97  # cosine similarity joining two products
+    DUPLICATE_BLOCK_SIZE: int = 1024  # query rows per range_search call
+    DUPLICATE_DETECTION_AFTER_INDEXING: bool = False
+    COLLAPSE_DUPLICATES: bool = False  # default for /search
+    
     class Config:
         env_file = ".env"
         case_sensitive = True
@@ -0,0 +1,215 @@
+"""
+Query embedding caches keyed by content hash
+
+Backends:
+- memory: per-process LRU bounded by entry count and bytes, with TTL
+- sqlite: local on-disk store shared by all workers on a host
+"""
+
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Tuple
+import numpy as np
+import structlog
+
+from config import settings
+
+logger = structlog.get_logger()
+
+def content_hash(data: bytes) -> str:
+    """Stable hash of raw bytes used as cache key"""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def embedding_namespace() -> str:
+    """Identifies the model configuration that produced an embedding"""
+    return f"{settings.CLIP_MODEL}:{settings.INFERENCE_BACKEND}:{int(settings.FAST_PREPROCESS)}"
+
+def normalize_query_text(text: str) -> str:
+    """Canonical form of a text query: NFKC, case-folded, single-spaced"""
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", text)).strip().casefold()
+
+class EmbeddingCache(ABC):
+    """Base class for embedding caches with hit/miss accounting"""
+
+    backend = "base"
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        embedding = self._get(key)
+        if embedding is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return embedding
+
+    def put(self, key: str, embedding: np.ndarray):
+        self._put(key, np.ascontiguousarray(embedding, dtype=np.float32))
+
+    @abstractmethod
+    def _get(self, key: str) -> Optional[np.ndarray]:
+        ...
+
+    @abstractmethod
+    def _put(self, key: str, embedding: np.ndarray):
+        ...
+
+    @abstractmethod
+    def _size(self) -> Tuple[int, int]:
+        """Current (entries, bytes)"""
+
+    def get_stats(self) -> dict:
+        """Get cache statistics"""
+        entries, size_bytes = self._size()
+        lookups = self.hits + self.misses
+        return {
+            "backend": self.backend,
+            "entries": entries,
+            "size_mb": round(size_bytes / (1024 * 1024), 2),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0
+        }
+
+class InMemoryEmbeddingCache(EmbeddingCache):
+    """LRU cache bounded by entry count and bytes, with TTL expiry"""
+
+    backend = "memory"
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl_seconds: float):
+        super().__init__(max_entries, max_bytes, ttl_seconds)
+        self._entries: "OrderedDict[str, Tuple[float, np.ndarray]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def _get(self, key: str) -> Optional[np.ndarray]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            stored_at, embedding = entry
+            if self.ttl_seconds > 0 and time.monotonic() - stored_at > self.ttl_seconds:
+                self._remove(key)
+                return None
+
+            self._entries.move_to_end(key)
+            return embedding
+
+    def _put(self, key: str, embedding: np.ndarray):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = (time.monotonic(), embedding)
+            self._bytes += embedding.nbytes
+
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self.evictions += 1
+
+    def _remove(self, key: str):
+        _, embedding = self._entries.pop(key)
+        self._bytes -= embedding.nbytes
+
+    def _size(self) -> Tuple[int, int]:
+        return len(self._entries), self._bytes
+
+class SqliteEmbeddingCache(EmbeddingCache):
+    """On-disk cache shared by worker processes on the same host"""
+
+    backend = "sqlite"
+
+    def __init__(self, path: str, max_entries: int, max_bytes: int, ttl_seconds: float):
+        super().__init__(max_entries, max_bytes, ttl_seconds)
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, stored_at REAL NOT NULL, used_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_embeddings_used_at ON embeddings (used_at)")
+
+    def _get(self, key: str) -> Optional[np.ndarray]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT vector, stored_at FROM embeddings WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+
+            vector, stored_at = row
+            if self.ttl_seconds > 0 and now - stored_at > self.ttl_seconds:
+                self._conn.execute("DELETE FROM embeddings WHERE key = ?", (key,))
+                return None
+
+            self._conn.execute("UPDATE embeddings SET used_at = ? WHERE key = ?", (now, key))
+        return np.frombuffer(vector, dtype=np.float32).copy()
+
+    def _put(self, key: str, embedding: np.ndarray):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO embeddings (key, vector, stored_at, used_at) VALUES (?, ?, ?, ?)",
+                (key, embedding.tobytes(), now, now)
+            )
+
+            # All rows have the same size, so the byte budget is an entry limit
+            limit = min(self.max_entries, self.max_bytes // max(embedding.nbytes, 1))
+            entries = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            if entries > limit:
+                excess = entries - limit
+                self._conn.execute(
+                    "DELETE FROM embeddings WHERE key IN "
+                    "(SELECT key FROM embeddings ORDER BY used_at LIMIT ?)",
+                    (excess,)
+                )
+                self.evictions += excess
+
+    def _size(self) -> Tuple[int, int]:
+        with self._lock:
+            entries, size_bytes = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+            ).fetchone()
+        return entries, size_bytes
+
+def create_embedding_cache(
+    backend: str,
+    max_entries: int,
+    max_mb: float,
+    ttl_seconds: float,
+    path: Optional[str] = None
+) -> Optional[EmbeddingCache]:
+    """Create an embedding cache for a configured backend ("none" disables caching)"""
+    max_bytes = int(max_mb * 1024 * 1024)
+
+    if backend == "none":
+        return None
+    if backend == "memory":
+        return InMemoryEmbeddingCache(max_entries, max_bytes, ttl_seconds)
+    if backend == "sqlite":
+        if not path:
+            raise ValueError("sqlite embedding cache requires a path")
+        return SqliteEmbeddingCache(path, max_entries, max_bytes, ttl_seconds)
+
+    raise ValueError(f"Unknown embedding cache backend: {backend}")
@@ -0,0 +1,106 @@
+"""
+Content-addressed on-disk store of product image embeddings
+
+Embeddings are keyed by model configuration and image content hash;
+image references map (image URL, Shopify image updated_at) to a content
+hash so unchanged images are reused without downloading them again.
+"""
+
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Optional
+import numpy as np
+import structlog
+
+from config import settings
+from embedding_cache import embedding_namespace
+
+logger = structlog.get_logger()
+
+def get_embedding_store_path() -> Path:
+    """Store location, next to FAISS_DIR by default"""
+    if settings.EMBEDDING_STORE_PATH:
+        return Path(settings.EMBEDDING_STORE_PATH)
+    return Path(settings.FAISS_DIR).parent / "embeddings.sqlite"
+
+class ProductEmbeddingStore:
+    """Persistent embeddings for product images, shared by all shops"""
+
+    def __init__(self, path: Optional[Path] = None, namespace: Optional[str] = None):
+        self.path = path or get_embedding_store_path()
+        self.namespace = namespace or embedding_namespace()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS image_refs ("
+            "namespace TEXT NOT NULL, image_url TEXT NOT NULL, updated_at TEXT NOT NULL, "
+            "content_hash TEXT NOT NULL, PRIMARY KEY (namespace, image_url, updated_at))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "namespace TEXT NOT NULL, content_hash TEXT NOT NULL, vector BLOB NOT NULL, "
+            "PRIMARY KEY (namespace, content_hash))"
+        )
+
+        # Counters for the current process
+        self.reference_hits = 0
+        self.content_hits = 0
+        self.misses = 0
+
+    def lookup_reference(self, image_url: str, updated_at: str) -> Optional[np.ndarray]:
+        """Embedding for an image URL and version, if seen before"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT e.vector FROM image_refs r JOIN embeddings e "
+                "ON e.namespace = r.namespace AND e.content_hash = r.content_hash "
+                "WHERE r.namespace = ? AND r.image_url = ? AND r.updated_at = ?",
+                (self.namespace, image_url, updated_at or "")
+            ).fetchone()
+
+        if row is None:
+            return None
+        self.reference_hits += 1
+        return np.frombuffer(row[0], dtype=np.float32).copy()
+
+    def lookup_content(self, content_hash: str) -> Optional[np.ndarray]:
+        """Embedding for downloaded image bytes, if the same content was embedded before"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT vector FROM embeddings WHERE namespace = ? AND content_hash = ?",
+                (self.namespace, content_hash)
+            ).fetchone()
+
+        if row is None:
+            self.misses += 1
+            return None
+        self.content_hits += 1
+        return np.frombuffer(row[0], dtype=np.float32).copy()
+
+    def store(self, image_url: str, updated_at: str, content_hash: str, embedding: np.ndarray):
+        """Record an embedding and the image reference that produced it"""
+        vector = np.ascontiguousarray(embedding, dtype=np.float32).tobytes()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.execute(
+                "INSERT OR IGNORE INTO embeddings (namespace, content_hash, vector) VALUES (?, ?, ?)",
+                (self.namespace, content_hash, vector)
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO image_refs (namespace, image_url, updated_at, content_hash) "
+                "VALUES (?, ?, ?, ?)",
+                (self.namespace, image_url, updated_at or "", content_hash)
+            )
+            self._conn.execute("COMMIT")
+
+    def get_stats(self) -> dict:
+        """Get store hit statistics for this process"""
+        return {
+            "reference_hits": self.reference_hits,
+            "content_hits": self.content_hits,
+            "misses": self.misses
+        }
@@ -0,0 +1,119 @@
+"""
+Full-precision product vectors kept beside compressed shop indices
+
+Saved as two .npy files sorted by product ID so readers can memory-map the
+vectors and look rows up with a binary search over the (small) ID array.
+"""
+
+from pathlib import Path
+from typing import Dict, Iterable, Set, Tuple
+import numpy as np
+
+def exact_vectors_paths(index_path: Path) -> Tuple[Path, Path]:
+    """(ids, vectors) sidecar paths for an index file"""
+    stem = index_path.name[:-len(index_path.suffix)] if index_path.suffix else index_path.name
+    return index_path.with_name(f"{stem}.ids.npy"), index_path.with_name(f"{stem}.vectors.npy")
+
+class ExactVectorStore:
+    """Sorted ID and vector arrays with an in-memory overlay for updates"""
+
+    def __init__(self, ids: np.ndarray, vectors: np.ndarray):
+        self.dimension = vectors.shape[1]
+        self._ids = ids
+        self._vectors = vectors
+        self._pending: Dict[int, np.ndarray] = {}
+        self._removed: Set[int] = set()
+
+    @classmethod
+    def from_arrays(cls, ids: np.ndarray, vectors: np.ndarray) -> "ExactVectorStore":
+        order = np.argsort(ids, kind="stable")
+        return cls(
+            np.ascontiguousarray(ids[order], dtype=np.int64),
+            np.ascontiguousarray(vectors[order], dtype=np.float32)
+        )
+
+    @classmethod
+    def load(cls, index_path: Path, mmap: bool = True) -> "ExactVectorStore":
+        ids_path, vectors_path = exact_vectors_paths(index_path)
+        ids = np.load(ids_path)
+        vectors = np.load(vectors_path, mmap_mode="r" if mmap else None)
+        return cls(ids, vectors)
+
+    @staticmethod
+    def exists(index_path: Path) -> bool:
+        return all(path.exists() for path in exact_vectors_paths(index_path))
+
+    def save(self, ids_path: Path, vectors_path: Path):
+        """Write both arrays, merging pending updates"""
+        ids, vectors = self.items()
+        # Open file objects so np.save does not append another .npy suffix
+        with open(ids_path, "wb") as f:
+            np.save(f, ids)
+        with open(vectors_path, "wb") as f:
+            np.save(f, vectors)
+
+    def upsert(self, ids: Iterable, vectors: np.ndarray):
+        for product_id, vector in zip(ids, vectors):
+            product_id = int(product_id)
+            self._pending[product_id] = np.array(vector, dtype=np.float32)
+            self._removed.discard(product_id)
+
+    def remove(self, ids: Iterable):
+        for product_id in ids:
+            product_id = int(product_id)
+            self._pending.pop(product_id, None)
+            self._removed.add(product_id)
+
+    def lookup(self, ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """(vectors, found mask) for product IDs; rows for missing IDs are zero"""
+        flat_ids = np.asarray(ids, dtype=np.int64).ravel()
+        vectors = np.zeros((len(flat_ids), self.dimension), dtype=np.float32)
+        found = np.zeros(len(flat_ids), dtype=bool)
+
+        if len(self._ids):
+            rows = np.minimum(np.searchsorted(self._ids, flat_ids), len(self._ids) - 1)
+            hit = self._ids[rows] == flat_ids
+            if hit.any():
+                # Fancy indexing into a memmap reads only the touched rows
+                vectors[hit] = self._vectors[rows[hit]]
+                found |= hit
+
+        if self._pending or self._removed:
+            for position, product_id in enumerate(flat_ids.tolist()):
+                if product_id in self._pending:
+                    vectors[position] = self._pending[product_id]
+                    found[position] = True
+                elif product_id in self._removed:
+                    found[position] = False
+
+        return vectors.reshape(*np.shape(ids), self.dimension), found.reshape(np.shape(ids))
+
+    def items(self) -> Tuple[np.ndarray, np.ndarray]:
+        """All (ids, vectors) sorted by ID, with pending updates applied"""
+        if not self._pending and not self._removed:
+            return self._ids, np.asarray(self._vectors)
+
+        overridden = np.fromiter(set(self._pending) | self._removed, dtype=np.int64)
+        keep = ~np.isin(self._ids, overridden)
+        ids = self._ids[keep]
+        vectors = np.asarray(self._vectors[keep])
+
+        if self._pending:
+            pending_ids = np.fromiter(self._pending.keys(), dtype=np.int64, count=len(self._pending))
+            pending_vectors = np.stack(list(self._pending.values()))
+            ids = np.concatenate([ids, pending_ids])
+            vectors = np.concatenate([vectors, pending_vectors])
+
+        store = ExactVectorStore.from_arrays(ids, vectors)
+        return store._ids, store._vectors
+
+    @property
+    def heap_bytes(self) -> int:
+        """Bytes held outside the page cache"""
+        size = self._ids.nbytes + len(self._pending) * self.dimension * 4
+        if not isinstance(self._vectors, np.memmap):
+            size += self._vectors.nbytes
+        return size
+
+    def __len__(self) -> int:
+        return len(self.items()[0]) if self._pending or self._removed else len(self._ids)
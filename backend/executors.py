@@ -0,0 +1,114 @@
+"""
+Executor layer that keeps CPU-bound decode and inference off the event loop
+"""
+
+import asyncio
+import multiprocessing
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Any, Callable, Optional, Sequence, Tuple
+import numpy as np
+import structlog
+
+from config import settings
+
+logger = structlog.get_logger()
+
+# Per-process preprocessing function used by decode workers
+_worker_preprocess = None
+
+def _init_decode_worker(
+    image_size: Tuple[int, int],
+    mean: Sequence[float],
+    std: Sequence[float]
+):
+    """Build the CLIP preprocessing function once per decode process"""
+    global _worker_preprocess
+
+    if settings.FAST_PREPROCESS:
+        from image_preprocessing import FastPreprocessor
+        _worker_preprocess = FastPreprocessor(image_size, mean, std).load_and_crop
+        return
+
+    import io
+    import open_clip
+    from PIL import Image
+
+    transform = open_clip.image_transform(image_size, is_train=False, mean=mean, std=std)
+
+    def preprocess(image_data: bytes) -> np.ndarray:
+        image = Image.open(io.BytesIO(image_data)).convert('RGB')
+        return transform(image).numpy()
+
+    _worker_preprocess = preprocess
+
+def decode_and_preprocess(image_data: bytes) -> np.ndarray:
+    """Decode an image and apply CLIP preprocessing inside a decode process"""
+    try:
+        return _worker_preprocess(image_data)
+    except Exception as e:
+        raise ValueError(f"Invalid image format: {str(e)}")
+
+def configure_torch_threads():
+    """Apply configured torch intra-op and inter-op thread counts"""
+    import torch
+
+    if settings.TORCH_INTRA_OP_THREADS > 0:
+        torch.set_num_threads(settings.TORCH_INTRA_OP_THREADS)
+
+    if settings.TORCH_INTER_OP_THREADS > 0:
+        try:
+            torch.set_num_interop_threads(settings.TORCH_INTER_OP_THREADS)
+        except RuntimeError:
+            # Can only be set once, before any inter-op parallel work
+            logger.warning("Torch inter-op threads already initialized, keeping current value")
+
+class InferenceExecutors:
+    """Thread pool for torch/FAISS work plus an optional process pool for image decode"""
+
+    def __init__(self):
+        # torch and FAISS release the GIL, so threads overlap real work
+        self.inference_pool = ThreadPoolExecutor(
+            max_workers=settings.INFERENCE_THREADS,
+            thread_name_prefix="inference"
+        )
+        self.decode_pool: Optional[ProcessPoolExecutor] = None
+
+    def start(
+        self,
+        image_size: Tuple[int, int],
+        mean: Sequence[float],
+        std: Sequence[float]
+    ):
+        """Configure torch threading and start the decode processes if enabled"""
+        configure_torch_threads()
+
+        if settings.DECODE_PROCESSES > 0 and self.decode_pool is None:
+            # Spawn rather than fork a process that already holds torch thread pools
+            self.decode_pool = ProcessPoolExecutor(
+                max_workers=settings.DECODE_PROCESSES,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_decode_worker,
+                initargs=(image_size, mean, std)
+            )
+            logger.info(f"Started {settings.DECODE_PROCESSES} image decode processes")
+
+    async def _run(self, executor: Executor, fn: Callable, *args) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, fn, *args)
+
+    async def run_inference(self, fn: Callable, *args) -> Any:
+        """Run a CPU-bound callable on the inference thread pool"""
+        return await self._run(self.inference_pool, fn, *args)
+
+    async def run_decode(self, image_data: bytes) -> np.ndarray:
+        """Decode and preprocess an image in the decode process pool"""
+        if self.decode_pool is None:
+            raise RuntimeError("Decode process pool not started")
+        return await self._run(self.decode_pool, decode_and_preprocess, image_data)
+
+    def shutdown(self):
+        """Stop all executors"""
+        self.inference_pool.shutdown(wait=False)
+        if self.decode_pool is not None:
+            self.decode_pool.shutdown(wait=False)
+            self.decode_pool = None
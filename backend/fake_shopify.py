@@ -0,0 +1,248 @@
+"""
+Local stand-in for the parts of the Shopify Admin API that indexing uses
+
+Serves a generated catalog over REST pagination and GraphQL bulk export,
+plus solid-color product images, so ingestion can be exercised without a
+real shop:
+
+    python fake_shopify.py --products 5000 --port 8765
+    SHOPIFY_API_BASE_URL=http://127.0.0.1:8765 SHOPIFY_INGEST_MODE=bulk ...
+
+tests/test_shopify_client.py serves it on an ephemeral port in-process.
+
+Routes:
+    GET  /admin/api/<version>/shop.json
+    GET  /admin/api/<version>/products/count.json
+    GET  /admin/api/<version>/products.json?limit=&page_info=
+    POST /admin/api/<version>/graphql.json   (bulkOperationRunQuery, node)
+    GET  /bulk/products.jsonl
+    GET  /images/<product id>.jpg
+"""
+
+import argparse
+import io
+import json
+import re
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List
+from urllib.parse import parse_qs, urlsplit
+
+from PIL import Image
+
+FIRST_PRODUCT_ID = 1000
+BULK_OPERATION_ID = "gid://shopify/BulkOperation/1"
+
+_ADMIN_ROUTE = re.compile(r"^/admin/api/[^/]+/(?P<resource>[\w/]+)\.json$")
+_IMAGE_ROUTE = re.compile(r"^/images/(?P<product_id>\d+)\.jpg$")
+
+class FakeCatalog:
+    """Deterministic products; every `no_image_every`-th product has no image"""
+
+    def __init__(self, origin: str, products: int, no_image_every: int):
+        self.origin = origin
+        self.count = products
+        self.no_image_every = no_image_every
+
+    def _has_image(self, position: int) -> bool:
+        return not self.no_image_every or position % self.no_image_every != self.no_image_every - 1
+
+    def rest_product(self, position: int) -> Dict:
+        product_id = FIRST_PRODUCT_ID + position
+        images = []
+        if self._has_image(position):
+            images.append({
+                "id": product_id * 10,
+                "src": f"{self.origin}/images/{product_id}.jpg",
+                "updated_at": "2024-01-01T00:00:00-00:00"
+            })
+        return {
+            "id": product_id,
+            "title": f"Product {position}",
+            "handle": f"product-{position}",
+            "product_type": ["Shirts", "Shoes", "Bags"][position % 3],
+            "vendor": f"Vendor {position % 7}",
+            "tags": f"fake, batch-{position % 10}",
+            "images": images,
+            "variants": [{
+                "id": product_id * 100,
+                "price": f"{10 + position % 90}.00",
+                "inventory_management": "shopify",
+                "inventory_policy": "deny",
+                "inventory_quantity": position % 4
+            }]
+        }
+
+    def bulk_lines(self) -> Iterator[Dict]:
+        """Bulk JSONL objects: each product followed by its image and variant nodes"""
+        for position in range(self.count):
+            product = self.rest_product(position)
+            parent_id = f"gid://shopify/Product/{product['id']}"
+            yield {
+                "id": parent_id,
+                "title": product["title"],
+                "handle": product["handle"],
+                "productType": product["product_type"],
+                "vendor": product["vendor"],
+                "tags": [tag.strip() for tag in product["tags"].split(",")],
+            }
+            for image in product["images"]:
+                yield {
+                    "id": f"gid://shopify/ProductImage/{image['id']}",
+                    "url": image["src"],
+                    "__parentId": parent_id
+                }
+            for variant in product["variants"]:
+                yield {
+                    "id": f"gid://shopify/ProductVariant/{variant['id']}",
+                    "price": variant["price"],
+                    "inventoryQuantity": variant["inventory_quantity"],
+                    "inventoryPolicy": variant["inventory_policy"].upper(),
+                    "inventoryItem": {"tracked": True},
+                    "__parentId": parent_id
+                }
+
+def _jpeg(product_id: int) -> bytes:
+    color = ((product_id * 37) % 256, (product_id * 91) % 256, (product_id * 53) % 256)
+    buffer = io.BytesIO()
+    Image.new("RGB", (256, 256), color).save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue()
+
+class FakeShopifyHandler(BaseHTTPRequestHandler):
+    catalog: FakeCatalog
+    bulk_polls: int
+    _polls = 0
+    _lock = threading.Lock()
+
+    def _send_json(self, payload: Dict, headers: Dict[str, str] = None):
+        body = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-Shopify-Shop-Api-Call-Limit", "1/40")
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _authorized(self) -> bool:
+        if self.headers.get("X-Shopify-Access-Token"):
+            return True
+        self.send_error(401, "Missing access token")
+        return False
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        admin = _ADMIN_ROUTE.match(url.path)
+        image = _IMAGE_ROUTE.match(url.path)
+
+        if admin:
+            if not self._authorized():
+                return
+            resource = admin.group("resource")
+            if resource == "shop":
+                self._send_json({"shop": {"name": "Fake shop", "myshopify_domain": "fake.myshopify.com"}})
+            elif resource == "products/count":
+                self._send_json({"count": self.catalog.count})
+            elif resource == "products":
+                self._send_products(url.path, parse_qs(url.query))
+            else:
+                self.send_error(404)
+
+        elif url.path == "/bulk/products.jsonl":
+            self.send_response(200)
+            self.send_header("Content-Type", "application/jsonl")
+            self.end_headers()
+            # No Content-Length: the body ends when the connection closes
+            for line in self.catalog.bulk_lines():
+                self.wfile.write(json.dumps(line).encode() + b"\n")
+
+        elif image:
+            body = _jpeg(int(image.group("product_id")))
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        else:
+            self.send_error(404)
+
+    def _send_products(self, path: str, query: Dict[str, List[str]]):
+        limit = min(int(query.get("limit", ["50"])[0]), 250)
+        offset = int(query.get("page_info", ["0"])[0])
+        end = min(offset + limit, self.catalog.count)
+        products = [self.catalog.rest_product(position) for position in range(offset, end)]
+
+        headers = {}
+        if end < self.catalog.count:
+            headers["Link"] = f'<{self.catalog.origin}{path}?limit={limit}&page_info={end}>; rel="next"'
+        self._send_json({"products": products}, headers)
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        admin = _ADMIN_ROUTE.match(url.path)
+        if not admin or admin.group("resource") != "graphql":
+            self.send_error(404)
+            return
+        if not self._authorized():
+            return
+
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        query = request.get("query", "")
+
+        if "bulkOperationRunQuery" in query:
+            with self._lock:
+                FakeShopifyHandler._polls = 0
+            self._send_json({"data": {"bulkOperationRunQuery": {
+                "bulkOperation": {"id": BULK_OPERATION_ID, "status": "CREATED"},
+                "userErrors": []
+            }}})
+
+        elif "node(" in query:
+            with self._lock:
+                FakeShopifyHandler._polls += 1
+                polls = FakeShopifyHandler._polls
+            done = polls > self.bulk_polls
+            self._send_json({"data": {"node": {
+                "id": BULK_OPERATION_ID,
+                "status": "COMPLETED" if done else "RUNNING",
+                "errorCode": None,
+                "objectCount": str(self.catalog.count) if done else "0",
+                "url": f"{self.catalog.origin}/bulk/products.jsonl" if done and self.catalog.count else None
+            }}})
+
+        else:
+            self._send_json({"errors": [{"message": "Unsupported query"}]})
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local Shopify Admin API stand-in")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--products", type=int, default=1000)
+    parser.add_argument("--no-image-every", type=int, default=10, help="0 gives every product an image")
+    parser.add_argument("--bulk-polls", type=int, default=2, help="Status polls before the bulk export completes")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    FakeShopifyHandler.catalog = FakeCatalog(f"http://{args.host}:{args.port}", args.products, args.no_image_every)
+    FakeShopifyHandler.bulk_polls = args.bulk_polls
+
+    server = ThreadingHTTPServer((args.host, args.port), FakeShopifyHandler)
+    server.verbose = args.verbose
+    print(f"Fake Shopify serving {args.products} products on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,146 @@
+"""
+Fast image preprocessing for CLIP
+
+Decodes JPEGs at a reduced scale with PIL's draft mode, applies EXIF
+orientation, resizes the shortest side and center-crops like the
+open_clip eval transform, then normalizes whole batches in one
+vectorized NumPy operation.
+
+Multi-crop queries describe regions as (x0, y0, x1, y1) fractions of the
+image, so they apply to any decode scale.
+"""
+
+import io
+from typing import List, Optional, Sequence, Tuple, Union
+import numpy as np
+from PIL import Image, ImageOps
+
+Region = Tuple[float, float, float, float]
+
+FULL_IMAGE: Region = (0.0, 0.0, 1.0, 1.0)
+
+CROP_MODES = ("center", "grid", "boxes")
+
+def query_regions(mode: str, grid_size: int = 2, boxes: Optional[Sequence[Sequence[float]]] = None) -> List[Region]:
+    """Regions to embed for a query mode, always starting with the whole image"""
+    if mode not in CROP_MODES:
+        raise ValueError(f"Unknown crop mode: {mode}")
+
+    regions = [FULL_IMAGE]
+    if mode == "grid":
+        if grid_size < 1:
+            raise ValueError("Grid size must be at least 1")
+        step = 1.0 / grid_size
+        for row in range(grid_size):
+            for col in range(grid_size):
+                regions.append((col * step, row * step, (col + 1) * step, (row + 1) * step))
+        # A 1x1 grid is the whole image again
+        regions = list(dict.fromkeys(regions))
+
+    elif mode == "boxes":
+        for box in boxes or []:
+            if len(box) != 4:
+                raise ValueError("Boxes must be [x0, y0, x1, y1]")
+            x0, y0, x1, y1 = (float(v) for v in box)
+            if not (0.0 <= x0 < x1 <= 1.0 and 0.0 <= y0 < y1 <= 1.0):
+                raise ValueError("Box coordinates must be fractions with x0 < x1 and y0 < y1")
+            regions.append((x0, y0, x1, y1))
+
+    return regions
+
+def region_box(region: Region, width: int, height: int) -> Tuple[int, int, int, int]:
+    """Pixel box of a fractional region, at least one pixel wide and high"""
+    x0, y0, x1, y1 = region
+    left, top = int(round(x0 * width)), int(round(y0 * height))
+    right = max(int(round(x1 * width)), left + 1)
+    bottom = max(int(round(y1 * height)), top + 1)
+    return left, top, right, bottom
+
+def decode_scale(regions: Sequence[Region]) -> float:
+    """Draft decode scale for a set of regions, so the smallest still covers the target size"""
+    smallest = min(min(x1 - x0, y1 - y0) for x0, y0, x1, y1 in regions)
+    return min(4.0, 1.0 / smallest)
+
+class FastPreprocessor:
+    """Numerically close, faster replacement for the open_clip eval transform"""
+
+    def __init__(
+        self,
+        image_size: Union[int, Tuple[int, int]],
+        mean: Sequence[float],
+        std: Sequence[float]
+    ):
+        if isinstance(image_size, int):
+            image_size = (image_size, image_size)
+        self.height, self.width = image_size
+
+        # Fold ToTensor's 1/255 scaling into the normalization constants
+        std_array = np.asarray(std, dtype=np.float32).reshape(1, 3, 1, 1)
+        mean_array = np.asarray(mean, dtype=np.float32).reshape(1, 3, 1, 1)
+        self._scale = 1.0 / (255.0 * std_array)
+        self._offset = mean_array / std_array
+
+    def load_image(self, image_data: bytes, scale: float = 1.0) -> Image.Image:
+        """Decode an image, letting JPEGs decode close to scale x the target size"""
+        image = Image.open(io.BytesIO(image_data))
+
+        # Draft mode keeps both sides >= the requested size, so the shortest
+        # side still covers the resize target; no-op for non-JPEG formats
+        image.draft('RGB', (int(self.width * scale), int(self.height * scale)))
+
+        image = ImageOps.exif_transpose(image)
+        return image.convert('RGB')
+
+    def resize_and_crop(self, image: Image.Image) -> np.ndarray:
+        """Resize shortest side and center-crop, returning uint8 HWC pixels"""
+        width, height = image.size
+        target_short = min(self.height, self.width)
+
+        # Same size rounding as torchvision Resize(int)
+        if width <= height:
+            new_width, new_height = target_short, int(target_short * height / width)
+        else:
+            new_width, new_height = int(target_short * width / height), target_short
+
+        if (new_width, new_height) != (width, height):
+            image = image.resize((new_width, new_height), Image.BICUBIC)
+
+        pixels = np.asarray(image, dtype=np.uint8)
+
+        # Same offset rounding as torchvision CenterCrop
+        top = int(round((new_height - self.height) / 2.0))
+        left = int(round((new_width - self.width) / 2.0))
+        return pixels[top:top + self.height, left:left + self.width]
+
+    def load_and_crop(self, image_data: bytes) -> np.ndarray:
+        """Decode image bytes into a uint8 HWC crop ready for normalization"""
+        return self.resize_and_crop(self.load_image(image_data))
+
+    def load_and_crop_regions(
+        self,
+        image_data: bytes,
+        regions: Sequence[Region],
+        scale: Optional[float] = None
+    ) -> np.ndarray:
+        """Decode once and crop every region, returning a uint8 NHWC batch
+
+        The decode scale defaults to decode_scale(regions); pass it to crop
+        a subset of regions exactly as the full set would be.
+        """
+        image = self.load_image(image_data, scale=decode_scale(regions) if scale is None else scale)
+
+        width, height = image.size
+        crops = []
+        for region in regions:
+            box = region_box(region, width, height)
+            crops.append(self.resize_and_crop(image if box == (0, 0, width, height) else image.crop(box)))
+        return np.stack(crops)
+
+    def normalize(self, crops: np.ndarray) -> np.ndarray:
+        """Normalize a uint8 NHWC batch into float32 NCHW model input"""
+        batch = crops.transpose(0, 3, 1, 2).astype(np.float32)
+        return np.ascontiguousarray(batch * self._scale - self._offset)
+
+    def __call__(self, image_data_list: List[bytes]) -> np.ndarray:
+        """Preprocess a list of encoded images into one model input batch"""
+        return self.normalize(np.stack([self.load_and_crop(data) for data in image_data_list]))
@@ -0,0 +1,362 @@
+"""
+Lazily loaded per-shop FAISS indices held in a memory-budgeted LRU
+
+On-disk layout per shop:
+- shop_{id}.v{N}.index: immutable index snapshot, version N
+- shop_{id}.v{N}.ids.npy / .vectors.npy: full-precision vectors of
+  compressed snapshots, used for exact re-ranking
+- shop_{id}.manifest.json: points at the current snapshot version
+- shop_{id}.index: legacy unversioned index, read when no manifest exists
+
+Snapshots are written to a temp file, fsynced and renamed into place before
+the manifest is swapped the same way, so readers never open a partial file.
+"""
+
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Set, Tuple
+import faiss
+import structlog
+
+from atomic_files import atomic_replace
+from exact_vectors import ExactVectorStore, exact_vectors_paths
+from vector_index import ShopIndex
+
+logger = structlog.get_logger()
+
+_SHOP_FILE = re.compile(r"^shop_(\d+)\.(?:manifest\.json|index)$")
+_SNAPSHOT_FILE = re.compile(r"^shop_(\d+)\.v(\d+)\.")
+
+class ShopIndexRegistry:
+    """Loads shop indices on first use and evicts cold shops over a byte budget
+
+    Read-only registries memory-map index types that support it (IVF
+    inverted lists), so their codes live in the page cache rather than the
+    heap. Indices modified in memory are never evicted until saved.
+    """
+
+    def __init__(
+        self,
+        faiss_dir: str,
+        budget_bytes: int,
+        read_only: bool = False,
+        use_mmap: bool = True,
+        on_load: Optional[Callable[[int, ShopIndex], None]] = None
+    ):
+        self.faiss_dir = Path(faiss_dir)
+        self.budget_bytes = budget_bytes
+        self.read_only = read_only
+        self.use_mmap = use_mmap
+        self.on_load = on_load
+
+        self._indices: "OrderedDict[int, ShopIndex]" = OrderedDict()
+        self._sizes: Dict[int, int] = {}
+        self._versions: Dict[int, int] = {}
+        self._dirty: Set[int] = set()
+        self._lock = threading.RLock()
+
+        # Counters for monitoring
+        self.loads = 0
+        self.evictions = 0
+        self.reloads = 0
+
+    def legacy_index_path(self, shop_id: int) -> Path:
+        return self.faiss_dir / f"shop_{shop_id}.index"
+
+    def manifest_path(self, shop_id: int) -> Path:
+        return self.faiss_dir / f"shop_{shop_id}.manifest.json"
+
+    def snapshot_path(self, shop_id: int, version: int) -> Path:
+        return self.faiss_dir / f"shop_{shop_id}.v{version}.index"
+
+    def read_manifest(self, shop_id: int) -> Optional[dict]:
+        try:
+            return json.loads(self.manifest_path(shop_id).read_text())
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Invalid index manifest for shop {shop_id}: {str(e)}")
+            return None
+
+    def current_snapshot(self, shop_id: int) -> Optional[Tuple[int, Path]]:
+        """(version, path) of the index file to read, version 0 for legacy files"""
+        manifest = self.read_manifest(shop_id)
+        if manifest is not None:
+            version = int(manifest["version"])
+            return version, self.snapshot_path(shop_id, version)
+
+        legacy_path = self.legacy_index_path(shop_id)
+        if legacy_path.exists():
+            return 0, legacy_path
+        return None
+
+    def index_path(self, shop_id: int) -> Optional[Path]:
+        """Path of the current index file, if any"""
+        snapshot = self.current_snapshot(shop_id)
+        return snapshot[1] if snapshot else None
+
+    def on_disk_shops(self) -> List[int]:
+        """Shop IDs with an index manifest or legacy index file"""
+        shop_ids = set()
+        for path in self.faiss_dir.glob("shop_*"):
+            match = _SHOP_FILE.match(path.name)
+            if match:
+                shop_ids.add(int(match.group(1)))
+        return sorted(shop_ids)
+
+    def peek(self, shop_id: int) -> Optional[ShopIndex]:
+        """Resident index without loading or touching LRU order"""
+        with self._lock:
+            return self._indices.get(shop_id)
+
+    def get(self, shop_id: int) -> Optional[ShopIndex]:
+        """Index for a shop, loading it from disk on first use"""
+        with self._lock:
+            index = self._indices.get(shop_id)
+            if index is not None:
+                self._indices.move_to_end(shop_id)
+                return index
+
+        loaded = self._load(shop_id)
+        if loaded is None:
+            return None
+
+        version, index, size_bytes = loaded
+        with self._lock:
+            # Another thread may have loaded or built it meanwhile
+            current = self._indices.get(shop_id)
+            if current is not None:
+                self._indices.move_to_end(shop_id)
+                return current
+
+            self.loads += 1
+            self._versions[shop_id] = version
+            self._insert(shop_id, index, size_bytes)
+            return index
+
+    def _load(self, shop_id: int) -> Optional[Tuple[int, ShopIndex, int]]:
+        """Read the current snapshot for a shop, outside the registry lock"""
+        snapshot = self.current_snapshot(shop_id)
+        if snapshot is None:
+            return None
+
+        version, path = snapshot
+        try:
+            index, mmapped = self._read(path)
+        except (RuntimeError, ValueError) as e:
+            # RuntimeError covers a snapshot deleted between manifest and read
+            logger.warning(f"Skipping index for shop {shop_id}: {str(e)}")
+            return None
+
+        if self.on_load is not None:
+            self.on_load(shop_id, index)
+
+        logger.info(
+            f"Loaded FAISS index v{version} for shop {shop_id}: {index.live_count} vectors"
+            f"{' (mmap)' if mmapped else ''}"
+        )
+        return version, index, self._estimate_bytes(index, path, mmapped)
+
+    def refresh(self) -> int:
+        """Swap in newer snapshots of resident shops, returns the number swapped
+
+        The new index is read before the lock is taken, and searches already
+        running keep their reference to the previous index object.
+        """
+        with self._lock:
+            resident = [
+                (shop_id, self._versions.get(shop_id, 0))
+                for shop_id in self._indices
+                if shop_id not in self._dirty
+            ]
+
+        swapped = 0
+        for shop_id, loaded_version in resident:
+            snapshot = self.current_snapshot(shop_id)
+            if snapshot is None:
+                # Index deleted by another process
+                self.pop(shop_id)
+                continue
+            if snapshot[0] <= loaded_version:
+                continue
+
+            loaded = self._load(shop_id)
+            if loaded is None:
+                continue
+
+            version, index, size_bytes = loaded
+            with self._lock:
+                if shop_id in self._dirty or self._versions.get(shop_id, 0) >= version:
+                    continue
+                self._versions[shop_id] = version
+                self._insert(shop_id, index, size_bytes)
+                self.reloads += 1
+                swapped += 1
+
+            logger.info(f"Reloaded FAISS index for shop {shop_id} at v{version}")
+        return swapped
+
+    def put(self, shop_id: int, index: ShopIndex, dirty: bool = True):
+        """Register an index built or modified in memory"""
+        with self._lock:
+            if dirty:
+                self._dirty.add(shop_id)
+            self._insert(shop_id, index, self._estimate_bytes(index))
+
+    def mark_dirty(self, shop_id: int):
+        with self._lock:
+            self._dirty.add(shop_id)
+
+    def save(self, shop_id: int) -> Optional[Path]:
+        """Write a resident index as a new snapshot and point the manifest at it"""
+        with self._lock:
+            index = self._indices.get(shop_id)
+            if index is None:
+                return None
+
+            self.faiss_dir.mkdir(parents=True, exist_ok=True)
+            current = self.current_snapshot(shop_id)
+            version = max(current[0] if current else 0, self._versions.get(shop_id, 0)) + 1
+
+            # Snapshot files first, then the manifest that makes them visible
+            snapshot_path = self.snapshot_path(shop_id, version)
+            index.save(str(self._tmp_path(snapshot_path)))
+            written = [snapshot_path]
+            if index.exact is not None:
+                ids_path, vectors_path = exact_vectors_paths(snapshot_path)
+                index.exact.save(self._tmp_path(ids_path), self._tmp_path(vectors_path))
+                written.extend([ids_path, vectors_path])
+
+            for path in written:
+                atomic_replace(self._tmp_path(path), path)
+
+            manifest_path = self.manifest_path(shop_id)
+            tmp_path = self._tmp_path(manifest_path)
+            tmp_path.write_text(json.dumps({
+                "version": version,
+                "files": [path.name for path in written],
+                "ntotal": index.ntotal,
+                "index_type": index.index_type,
+                "storage": index.storage,
+                "saved_at": time.time()
+            }))
+            atomic_replace(tmp_path, manifest_path)
+
+            self._versions[shop_id] = version
+            self._dirty.discard(shop_id)
+            self._insert(shop_id, index, self._estimate_bytes(index, snapshot_path))
+
+        self._prune_snapshots(shop_id, keep_from=version - 1)
+        return snapshot_path
+
+    @staticmethod
+    def _tmp_path(path: Path) -> Path:
+        return path.with_name(f"{path.name}.tmp-{os.getpid()}")
+
+    def _snapshot_files(self, shop_id: int) -> List[Tuple[int, Path]]:
+        """(version, path) of every snapshot file of a shop"""
+        files = []
+        for path in self.faiss_dir.glob(f"shop_{shop_id}.v*"):
+            match = _SNAPSHOT_FILE.match(path.name)
+            if match and int(match.group(1)) == shop_id and ".tmp-" not in path.name:
+                files.append((int(match.group(2)), path))
+        return files
+
+    def _prune_snapshots(self, shop_id: int, keep_from: int):
+        """Delete snapshots older than keep_from, and the legacy file
+
+        The previous version is kept for readers that resolved the manifest
+        just before it was swapped; mmapped readers keep their open mapping.
+        """
+        paths = [self.legacy_index_path(shop_id)]
+        paths.extend(path for version, path in self._snapshot_files(shop_id) if version < keep_from)
+
+        for path in paths:
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def delete(self, shop_id: int):
+        """Drop a shop's index from memory and remove its files"""
+        self.pop(shop_id)
+        paths = [self.manifest_path(shop_id), self.legacy_index_path(shop_id)]
+        paths.extend(path for _, path in self._snapshot_files(shop_id))
+        for path in paths:
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def pop(self, shop_id: int):
+        """Drop a shop's index from memory"""
+        with self._lock:
+            self._indices.pop(shop_id, None)
+            self._sizes.pop(shop_id, None)
+            self._versions.pop(shop_id, None)
+            self._dirty.discard(shop_id)
+
+    def _read(self, path: Path):
+        """Read an index, memory-mapped when allowed"""
+        mmap = self.read_only and self.use_mmap
+        exact = ExactVectorStore.load(path, mmap=mmap) if ExactVectorStore.exists(path) else None
+
+        if mmap:
+            # Index types without mmap support are read into memory as usual
+            raw = faiss.read_index(str(path), faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+            index = ShopIndex.from_faiss(raw, exact)
+            return index, index.index_type == "IVFPQ"
+        return ShopIndex.load(str(path), exact), False
+
+    @staticmethod
+    def _estimate_bytes(index: ShopIndex, path: Optional[Path] = None, mmapped: bool = False) -> int:
+        """Approximate heap bytes held by an index"""
+        exact_bytes = index.exact.heap_bytes if index.exact is not None else 0
+        if mmapped:
+            # Only the ID map and coarse centroids stay on the heap
+            ivf = faiss.extract_index_ivf(index.index)
+            return index.ntotal * 8 + ivf.nlist * index.dimension * 4 + exact_bytes
+        if path is not None and path.exists():
+            return path.stat().st_size + exact_bytes
+        return index.ntotal * index.bytes_per_vector() + exact_bytes
+
+    def _insert(self, shop_id: int, index: ShopIndex, size_bytes: int):
+        self._indices[shop_id] = index
+        self._indices.move_to_end(shop_id)
+        self._sizes[shop_id] = size_bytes
+        self._evict(keep=shop_id)
+
+    def _evict(self, keep: int):
+        """Evict least recently used clean indices until under budget"""
+        for shop_id in list(self._indices.keys()):
+            if self.resident_bytes <= self.budget_bytes:
+                break
+            if shop_id == keep or shop_id in self._dirty:
+                continue
+            del self._indices[shop_id]
+            del self._sizes[shop_id]
+            self._versions.pop(shop_id, None)
+            self.evictions += 1
+            logger.info(f"Evicted FAISS index for shop {shop_id}")
+
+    @property
+    def resident_bytes(self) -> int:
+        return sum(self._sizes.values())
+
+    def get_stats(self) -> dict:
+        """Resident versus on-disk shops and eviction counters"""
+        with self._lock:
+            return {
+                "resident_shops": len(self._indices),
+                "on_disk_shops": len(self.on_disk_shops()),
+                "resident_mb": round(self.resident_bytes / (1024 * 1024), 2),
+                "budget_mb": round(self.budget_bytes / (1024 * 1024), 2),
+                "loads": self.loads,
+                "evictions": self.evictions,
+                "reloads": self.reloads
+            }
@@ -0,0 +1,203 @@
+"""
+Selectable inference backends for the CLIP image encoder
+
+Supported backends:
+- torch: eager open_clip model
+- torchscript: traced image encoder
+- onnx: ONNX Runtime FP32
+- onnx-int8: ONNX Runtime with dynamically quantized INT8 weights
+
+Non-eager backends load an artifact produced by `python ml_tools.py export`.
+"""
+
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Optional, Tuple, Union
+import numpy as np
+import torch
+import structlog
+
+from config import settings
+
+logger = structlog.get_logger()
+
+BACKENDS = ("torch", "torchscript", "onnx", "onnx-int8")
+
+_ARTIFACT_SUFFIXES = {
+    "torchscript": ".torchscript.pt",
+    "onnx": ".onnx",
+    "onnx-int8": ".int8.onnx",
+}
+
+def get_artifact_dir() -> Path:
+    """Directory for exported model artifacts, next to FAISS_DIR by default"""
+    if settings.MODEL_ARTIFACT_DIR:
+        return Path(settings.MODEL_ARTIFACT_DIR)
+    return Path(settings.FAISS_DIR).parent / "models"
+
+def get_weights_cache_path() -> Path:
+    """Pre-serialized pretrained weights, loaded instead of resolving 'openai' online"""
+    model_slug = settings.CLIP_MODEL.replace("/", "-")
+    return get_artifact_dir() / f"{model_slug}.openai.pt"
+
+def get_artifact_path(backend: str) -> Path:
+    """Path of the exported artifact for a backend"""
+    if backend not in _ARTIFACT_SUFFIXES:
+        raise ValueError(f"Backend {backend} has no exported artifact")
+    model_slug = settings.CLIP_MODEL.replace("/", "-")
+    return get_artifact_dir() / f"{model_slug}{_ARTIFACT_SUFFIXES[backend]}"
+
+class _VisualEncoder(torch.nn.Module):
+    """Module exposing only encode_image, for tracing and ONNX export"""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, image: torch.Tensor) -> torch.Tensor:
+        return self.model.encode_image(image)
+
+class ImageEncoder(ABC):
+    """Base class: maps a preprocessed image batch to unnormalized features"""
+
+    name = "base"
+
+    @abstractmethod
+    def encode(self, image_tensor: torch.Tensor) -> np.ndarray:
+        ...
+
+class TorchImageEncoder(ImageEncoder):
+    """Eager PyTorch open_clip image encoder"""
+
+    name = "torch"
+
+    def __init__(self, model):
+        self.model = model
+
+    def encode(self, image_tensor: torch.Tensor) -> np.ndarray:
+        with torch.no_grad():
+            features = self.model.encode_image(image_tensor)
+        return features.float().cpu().numpy()
+
+class TorchScriptImageEncoder(ImageEncoder):
+    """Traced TorchScript image encoder"""
+
+    name = "torchscript"
+
+    def __init__(self, artifact_path: Path, device: torch.device):
+        self.device = device
+        self.module = torch.jit.load(str(artifact_path), map_location=device)
+        self.module.eval()
+
+    def encode(self, image_tensor: torch.Tensor) -> np.ndarray:
+        with torch.no_grad():
+            features = self.module(image_tensor.to(self.device))
+        return features.float().cpu().numpy()
+
+class OnnxImageEncoder(ImageEncoder):
+    """ONNX Runtime image encoder (FP32 or INT8 artifact)"""
+
+    def __init__(self, artifact_path: Path, name: str = "onnx"):
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise RuntimeError("onnxruntime is required for ONNX inference backends")
+
+        self.name = name
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if settings.TORCH_INTRA_OP_THREADS > 0:
+            options.intra_op_num_threads = settings.TORCH_INTRA_OP_THREADS
+
+        self.session = ort.InferenceSession(
+            str(artifact_path),
+            sess_options=options,
+            providers=["CPUExecutionProvider"]
+        )
+        self.input_name = self.session.get_inputs()[0].name
+
+    def encode(self, image_tensor: torch.Tensor) -> np.ndarray:
+        image_array = image_tensor.detach().cpu().numpy().astype(np.float32)
+        features = self.session.run(None, {self.input_name: image_array})[0]
+        return features.astype(np.float32)
+
+def create_image_encoder(backend: str, model, device: torch.device) -> ImageEncoder:
+    """Create the image encoder for a backend
+
+    A missing artifact is an error rather than a silent switch to eager
+    torch: cached and stored embeddings are keyed by the configured
+    backend, so they would otherwise be filed under the wrong one.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown inference backend: {backend}")
+
+    if backend == "torch":
+        return TorchImageEncoder(model)
+
+    artifact_path = get_artifact_path(backend)
+    if not artifact_path.exists():
+        raise FileNotFoundError(
+            f"Missing {backend} artifact {artifact_path}, run `python ml_tools.py export "
+            f"--backend {backend}` or set INFERENCE_BACKEND=torch"
+        )
+
+    if backend == "torchscript":
+        encoder = TorchScriptImageEncoder(artifact_path, device)
+    else:
+        encoder = OnnxImageEncoder(artifact_path, name=backend)
+
+    logger.info(f"Loaded {backend} image encoder from {artifact_path}")
+    return encoder
+
+def export_artifact(
+    model,
+    backend: str,
+    image_size: Union[int, Tuple[int, int]],
+    output_path: Optional[Path] = None
+) -> Path:
+    """Export the image encoder of an eager model for a backend"""
+    if isinstance(image_size, int):
+        image_size = (image_size, image_size)
+
+    output_path = output_path or get_artifact_path(backend)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+
+    encoder = _VisualEncoder(model).eval()
+    example = torch.randn(1, 3, *image_size)
+
+    if backend == "torchscript":
+        with torch.no_grad():
+            traced = torch.jit.trace(encoder, example)
+        traced.save(str(output_path))
+
+    elif backend == "onnx":
+        with torch.no_grad():
+            torch.onnx.export(
+                encoder,
+                example,
+                str(output_path),
+                input_names=["image"],
+                output_names=["features"],
+                dynamic_axes={"image": {0: "batch"}, "features": {0: "batch"}},
+                opset_version=14
+            )
+
+    elif backend == "onnx-int8":
+        try:
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+        except ImportError:
+            raise RuntimeError("onnxruntime is required to quantize the ONNX model")
+
+        # Dynamic quantization derives activation scales at runtime, so it
+        # only needs the FP32 graph rather than a calibration set
+        fp32_path = get_artifact_path("onnx")
+        if not fp32_path.exists():
+            export_artifact(model, "onnx", image_size)
+
+        quantize_dynamic(str(fp32_path), str(output_path), weight_type=QuantType.QInt8)
+
+    else:
+        raise ValueError(f"Backend {backend} has no exported artifact")
+
+    logger.info(f"Exported {backend} image encoder to {output_path}")
+    return output_path
@@ -0,0 +1,232 @@
+"""
+Staged ingestion: concurrent stages connected by bounded queues
+
+Each stage has its own worker count and inbox. A full inbox blocks the
+stage feeding it, so a slow stage (usually embedding) throttles the
+stages upstream instead of letting decoded images pile up in memory.
+Per-stage counters and queue depths are snapshotted to a JSON file under
+TMP_DIR, one file per shop, which the job status endpoint reads.
+"""
+
+import asyncio
+import json
+import os
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional
+import numpy as np
+import structlog
+
+from atomic_files import atomic_replace
+from config import settings
+
+logger = structlog.get_logger()
+
+# Tells one worker that its stage has no more input
+_DONE = object()
+
+class IngestItem:
+    """One product image moving through the stages"""
+
+    __slots__ = ("product_data", "image_data", "content_hash", "image", "embedding", "reused", "error")
+
+    def __init__(self, product_data: Dict):
+        self.product_data = product_data
+        self.image_data: Optional[bytes] = None
+        self.content_hash: Optional[str] = None
+        self.image: Optional[np.ndarray] = None
+        self.embedding: Optional[np.ndarray] = None
+        self.reused = False
+        self.error: Optional[str] = None
+
+    @property
+    def product_id(self) -> str:
+        return self.product_data["product_id"]
+
+class StageStats:
+    """Counters for one stage"""
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.processed = 0
+        self.failed = 0
+        self.batches = 0
+        self.busy_seconds = 0.0
+        self.started_at = time.monotonic()
+        self.finished_at: Optional[float] = None
+
+    def as_dict(self) -> Dict:
+        elapsed = (self.finished_at or time.monotonic()) - self.started_at
+        return {
+            "workers": self.workers,
+            "processed": self.processed,
+            "failed": self.failed,
+            "batches": self.batches,
+            "items_per_second": round(self.processed / elapsed, 2) if elapsed > 0 else 0.0,
+            # Share of worker time spent in the handler rather than waiting on queues
+            "utilization": round(self.busy_seconds / (elapsed * self.workers), 3) if elapsed > 0 else 0.0,
+            "finished": self.finished_at is not None
+        }
+
+class Stage:
+    """Workers that take items (or batches of items) from a bounded inbox
+
+    The handler receives a list of items and forwards them to downstream
+    inboxes itself, so items can skip stages they do not need.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        handler: Callable[[List[IngestItem]], Awaitable[None]],
+        workers: int = 1,
+        queue_size: int = 0,
+        batch_size: int = 1
+    ):
+        self.name = name
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.batch_size = max(1, batch_size)
+        self.inbox: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.stats = StageStats(self.workers)
+
+    async def _work(self):
+        done = False
+        while not done:
+            item = await self.inbox.get()
+            if item is _DONE:
+                return
+
+            # Take whatever else is already waiting, up to a full batch
+            batch = [item]
+            while len(batch) < self.batch_size and not self.inbox.empty():
+                item = self.inbox.get_nowait()
+                if item is _DONE:
+                    done = True
+                    break
+                batch.append(item)
+
+            failed_before = sum(item.error is not None for item in batch)
+            start_time = time.perf_counter()
+            await self.handler(batch)
+            self.stats.busy_seconds += time.perf_counter() - start_time
+            self.stats.batches += 1
+            self.stats.processed += len(batch)
+            self.stats.failed += sum(item.error is not None for item in batch) - failed_before
+
+    async def run(self):
+        self.stats.started_at = time.monotonic()
+        await asyncio.gather(*(self._work() for _ in range(self.workers)))
+        self.stats.finished_at = time.monotonic()
+
+    async def close(self):
+        """Stop the workers once the items queued so far are handled"""
+        for _ in range(self.workers):
+            await self.inbox.put(_DONE)
+
+    def queue_stats(self) -> Dict:
+        return {"depth": self.inbox.qsize(), "size": self.inbox.maxsize}
+
+class SourceStage(Stage):
+    """First stage: one producer coroutine instead of an inbox"""
+
+    def __init__(self, name: str, producer: Callable[[], Awaitable[None]]):
+        super().__init__(name, handler=None)
+        self.producer = producer
+
+    async def run(self):
+        self.stats.started_at = time.monotonic()
+        start_time = time.perf_counter()
+        await self.producer()
+        self.stats.busy_seconds = time.perf_counter() - start_time
+        self.stats.finished_at = time.monotonic()
+
+    async def close(self):
+        pass
+
+    def queue_stats(self) -> Dict:
+        return {"depth": 0, "size": 0}
+
+def progress_path(shop_id: int) -> Path:
+    return Path(settings.TMP_DIR) / f"index_progress_shop_{shop_id}.json"
+
+def read_progress(shop_id: int, job_id: int) -> Optional[Dict]:
+    """Latest stage snapshot of a job, if it was the shop's most recent run"""
+    try:
+        with open(progress_path(shop_id)) as f:
+            progress = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    return progress if progress.get("job_id") == job_id else None
+
+class IngestPipeline:
+    """Runs stages in order, closing each stage once every stage before it finished
+
+    Items a stage forwards past its direct successor must go to a later
+    stage, so closing stages in order never drops an item.
+    """
+
+    def __init__(self, shop_id: int, job_id: int, stages: List[Stage]):
+        self.shop_id = shop_id
+        self.job_id = job_id
+        self.stages = stages
+        self.started_at = time.monotonic()
+
+    def snapshot(self) -> Dict:
+        return {
+            "job_id": self.job_id,
+            "updated_at": datetime.utcnow().isoformat(),
+            "elapsed_seconds": round(time.monotonic() - self.started_at, 1),
+            "stages": {
+                stage.name: {**stage.stats.as_dict(), "queue": stage.queue_stats()}
+                for stage in self.stages
+            }
+        }
+
+    def write_progress(self):
+        path = progress_path(self.shop_id)
+        tmp_path = path.with_name(f"{path.name}.tmp-{os.getpid()}")
+        with open(tmp_path, "w") as f:
+            json.dump(self.snapshot(), f)
+        atomic_replace(tmp_path, path)
+
+    async def _report_periodically(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.write_progress()
+            except OSError as e:
+                logger.warning(f"Could not write ingest progress: {str(e)}")
+
+    async def run(self):
+        tasks = {asyncio.ensure_future(stage.run()): position for position, stage in enumerate(self.stages)}
+        reporter = asyncio.ensure_future(self._report_periodically(settings.INGEST_PROGRESS_INTERVAL_SECONDS))
+        finished = [False] * len(self.stages)
+        closed = 1  # the source stage has no inbox
+
+        try:
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    # Re-raise a stage failure so the other stages are cancelled
+                    task.result()
+                    finished[tasks[task]] = True
+
+                while closed < len(self.stages) and all(finished[:closed]):
+                    await self.stages[closed].close()
+                    closed += 1
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            reporter.cancel()
+            try:
+                self.write_progress()
+            except OSError as e:
+                logger.warning(f"Could not write ingest progress: {str(e)}")
+
+        logger.info(f"Ingest pipeline finished for shop {self.shop_id}", stages=self.snapshot()["stages"])
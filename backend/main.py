@@ -8,15 +8,25 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import HTMLResponse, RedirectResponse
 from fastapi.security import HTTPBearer
 import os
+import time
+import asyncio
+import importlib
+import json
+from typing import Dict, List, Optional
 from dotenv import load_dotenv
 import structlog
 
 from config import settings
 from database import engine, SessionLocal, Base
 from models import Shop, Product, IndexJob, SearchLog
-from ml_pipeline import MLPipeline
 from shopify_client import ShopifyClient
+import shopify_rate_limit
 from auth import verify_shop_token
+from image_preprocessing import query_regions
+from query_fusion import FUSION_METHODS
+from similar_products import SimilarProductsStore
+from product_attributes import ProductFilter
+from ingest_pipeline import read_progress
 
 # Load environment variables
 load_dotenv()
@@ -43,8 +53,13 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Initialize ML pipeline
-ml_pipeline = MLPipeline()
+# ML pipeline, created in the background after startup so liveness does
+# not wait for torch/open_clip/faiss imports and model loading
+ml_pipeline = None
+ml_startup_error: Optional[str] = None
+
+# Precomputed similar products, served without the ML pipeline
+similar_store = SimilarProductsStore(settings.FAISS_DIR)
 
 # Security
 security = HTTPBearer()
@@ -57,12 +72,61 @@ def get_db():
     finally:
         db.close()
 
+def get_ready_pipeline():
+    """Return the ML pipeline or fail with 503 while it is still starting"""
+    if ml_pipeline is None or not ml_pipeline.is_ready():
+        raise HTTPException(status_code=503, detail="ML pipeline not ready")
+    return ml_pipeline
+
+async def initialize_ml_pipeline():
+    """Import and initialize the ML pipeline without blocking the app"""
+    global ml_pipeline, ml_startup_error
+    
+    try:
+        loop = asyncio.get_running_loop()
+        
+        # Heavy imports (torch, open_clip, faiss) happen off the event loop
+        start_time = time.perf_counter()
+        ml_pipeline_module = await loop.run_in_executor(None, importlib.import_module, "ml_pipeline")
+        import_ms = (time.perf_counter() - start_time) * 1000
+        
+        pipeline = ml_pipeline_module.MLPipeline(read_only=True)
+        ml_pipeline = pipeline
+        await pipeline.initialize()
+        
+        logger.info("ML pipeline ready", import_ms=round(import_ms, 1))
+        
+        if settings.INDEX_RELOAD_INTERVAL_SECONDS > 0:
+            app.state.index_reload_task = asyncio.create_task(reload_indices_periodically(pipeline))
+        
+    except Exception as e:
+        ml_startup_error = str(e)
+        logger.error(f"ML pipeline startup failed: {str(e)}")
+
+async def reload_indices_periodically(pipeline):
+    """Poll index manifests and swap in snapshots saved by the indexing worker"""
+    while True:
+        await asyncio.sleep(settings.INDEX_RELOAD_INTERVAL_SECONDS)
+        try:
+            await pipeline.reload_indices()
+        except Exception as e:
+            logger.error(f"Index reload failed: {str(e)}")
+
 @app.on_event("startup")
 async def startup_event():
-    """Initialize ML models on startup"""
+    """Start ML initialization in the background"""
     logger.info("Starting up Visual Search API")
-    await ml_pipeline.initialize()
-    logger.info("ML pipeline initialized successfully")
+    app.state.ml_startup_task = asyncio.create_task(initialize_ml_pipeline())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop ML executors on shutdown"""
+    reload_task = getattr(app.state, "index_reload_task", None)
+    if reload_task is not None:
+        reload_task.cancel()
+    
+    if ml_pipeline is not None:
+        ml_pipeline.executors.shutdown()
 
 @app.get("/")
 async def root():
@@ -71,14 +135,29 @@ async def root():
 
 @app.get("/health")
 async def health_check():
-    """Detailed health check"""
+    """Liveness check with pipeline details, answers before the model is loaded"""
+    pipeline_ready = ml_pipeline is not None and ml_pipeline.is_ready()
     return {
         "status": "healthy",
-        "ml_pipeline": ml_pipeline.is_ready(),
+        "ml_pipeline": pipeline_ready,
+        "ml_startup_error": ml_startup_error,
+        "query_batching": ml_pipeline.query_batcher.get_stats() if ml_pipeline else None,
+        "query_cache": ml_pipeline.query_cache.get_stats() if ml_pipeline and ml_pipeline.query_cache else None,
+        "text_batching": ml_pipeline.text_batcher.get_stats() if ml_pipeline else None,
+        "text_cache": ml_pipeline.text_cache.get_stats() if ml_pipeline and ml_pipeline.text_cache else None,
+        "indices": ml_pipeline.indices.get_stats() if ml_pipeline else None,
+        "similar_products": similar_store.get_stats(),
+        "shopify_rate_limits": shopify_rate_limit.get_stats(),
         "database": "connected",
         "version": "0.1.0"
     }
 
+@app.get("/ready")
+async def readiness_check():
+    """Readiness check, flips to 200 once the ML pipeline can serve searches"""
+    get_ready_pipeline()
+    return {"status": "ready"}
+
 # Auth endpoints
 @app.get("/auth/install")
 async def install_redirect(shop: str):
@@ -197,66 +276,183 @@ async def get_index_status(
         "product_count": product_count,
         "started_at": latest_job.started_at,
         "finished_at": latest_job.finished_at,
-        "error": latest_job.error
+        "error": latest_job.error,
+        # Per-stage throughput and queue depths of the staged ingestion
+        "pipeline": read_progress(shop.id, latest_job.id)
     }
 
+@app.post("/admin/index/params")
+async def update_index_params(
+    shop_domain: str = Form(...),
+    index_type: Optional[str] = Form(None),
+    nprobe: Optional[int] = Form(None),
+    ef_search: Optional[int] = Form(None),
+    storage: Optional[str] = Form(None),
+    pq_code_size: Optional[int] = Form(None),
+    rerank_factor: Optional[int] = Form(None),
+    reduce_dim: Optional[int] = Form(None),
+    reduce_method: Optional[str] = Form(None),
+    reduce_scope: Optional[str] = Form(None),
+    db: SessionLocal = Depends(get_db)
+):
+    """Set per-shop index type, vector storage, projection and search-time knobs
+
+    Index type, storage and projection changes take effect at the shop's next index save.
+    """
+    pipeline = get_ready_pipeline()
+    
+    shop = db.query(Shop).filter(Shop.shop_domain == shop_domain).first()
+    if not shop:
+        raise HTTPException(status_code=404, detail="Shop not found")
+    
+    try:
+        params = pipeline.set_search_params(
+            shop.id,
+            index_type=index_type,
+            nprobe=nprobe,
+            ef_search=ef_search,
+            storage=storage,
+            pq_code_size=pq_code_size,
+            rerank_factor=rerank_factor,
+            reduce_dim=reduce_dim,
+            reduce_method=reduce_method,
+            reduce_scope=reduce_scope
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    return {"shop_domain": shop_domain, "params": params}
+
+def load_products(db, shop_id: int, product_ids: List[str]) -> Dict[str, Product]:
+    """Fetch products for search hits in one query"""
+    products = db.query(Product).filter(
+        Product.shop_id == shop_id,
+        Product.product_id.in_(set(product_ids))
+    ).all()
+    return {p.product_id: p for p in products}
+
+def format_results(results: List[Dict], product_lookup: Dict[str, Product], shop_domain: str) -> List[Dict]:
+    """Search hits with product metadata, dropping products no longer in the DB"""
+    formatted_results = []
+    for result in results:
+        product = product_lookup.get(result["product_id"])
+        if product:
+            formatted_results.append({
+                "product_id": product.product_id,
+                "title": product.title,
+                "handle": product.handle,
+                "image": product.image_url,
+                "url": f"https://{shop_domain}.myshopify.com/products/{product.handle}",
+                "score": result["score"]
+            })
+            if "duplicates" in result:
+                formatted_results[-1]["duplicates"] = result["duplicates"]
+    return formatted_results
+
+def product_filter_from_form(
+    in_stock: Optional[bool],
+    min_price: Optional[float],
+    max_price: Optional[float],
+    product_type: Optional[str],
+    vendor: Optional[str],
+    tag: Optional[str]
+) -> ProductFilter:
+    """Search filter from request fields, rejecting empty price bands"""
+    if min_price is not None and max_price is not None and min_price > max_price:
+        raise HTTPException(status_code=400, detail="min_price must not exceed max_price")
+    return ProductFilter(
+        in_stock=in_stock,
+        min_price=min_price,
+        max_price=max_price,
+        product_type=product_type or None,
+        vendor=vendor or None,
+        tag=tag or None
+    )
+
+async def read_search_image(image: UploadFile) -> bytes:
+    """Validate and read an uploaded query image"""
+    if not image.content_type or not image.content_type.startswith('image/'):
+        raise HTTPException(status_code=400, detail="Invalid image format")
+    
+    image_data = await image.read()
+    if len(image_data) > 8 * 1024 * 1024:  # 8MB limit
+        raise HTTPException(status_code=400, detail="Image too large (max 8MB)")
+    return image_data
+
 # Search endpoint
 @app.post("/search")
 async def visual_search(
     shop_domain: str = Form(...),
     image: UploadFile = File(...),
     limit: int = Form(24),
+    crop_mode: str = Form("center"),
+    grid_size: int = Form(2),
+    boxes: Optional[str] = Form(None),
+    fusion: str = Form("max"),
+    collapse: Optional[bool] = Form(None),
+    in_stock: Optional[bool] = Form(None),
+    min_price: Optional[float] = Form(None),
+    max_price: Optional[float] = Form(None),
+    product_type: Optional[str] = Form(None),
+    vendor: Optional[str] = Form(None),
+    tag: Optional[str] = Form(None),
     db: SessionLocal = Depends(get_db)
 ):
-    """Perform visual search using uploaded image"""
-    import time
+    """Perform visual search using uploaded image
+    
+    crop_mode "grid" adds grid_size x grid_size tiles and "boxes" adds the
+    JSON list of [x0, y0, x1, y1] fractions in `boxes`; crops are embedded
+    and searched as one batch and fused with `fusion` (max or rrf).
+    `collapse` folds near-duplicate products into one result (single-crop
+    searches only; defaults to COLLAPSE_DUPLICATES). Stock, price band,
+    product type, vendor and tag filters are applied inside the index scan.
+    """
     start_time = time.time()
     
     try:
+        pipeline = get_ready_pipeline()
+        
+        # Resolve query regions before touching the DB
+        try:
+            regions = query_regions(crop_mode, grid_size, json.loads(boxes) if boxes else None)
+        except (TypeError, ValueError) as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        if len(regions) > settings.QUERY_CROP_MAX_REGIONS:
+            raise HTTPException(status_code=400, detail=f"Too many crops (max {settings.QUERY_CROP_MAX_REGIONS})")
+        if fusion not in FUSION_METHODS:
+            raise HTTPException(status_code=400, detail=f"Unknown fusion method: {fusion}")
+        product_filter = product_filter_from_form(in_stock, min_price, max_price, product_type, vendor, tag)
+        
         # Verify shop
         shop = db.query(Shop).filter(Shop.shop_domain == shop_domain).first()
         if not shop:
             raise HTTPException(status_code=404, detail="Shop not found")
         
-        # Validate image
-        if not image.content_type.startswith('image/'):
-            raise HTTPException(status_code=400, detail="Invalid image format")
-        
-        # Read image data
-        image_data = await image.read()
-        if len(image_data) > 8 * 1024 * 1024:  # 8MB limit
-            raise HTTPException(status_code=400, detail="Image too large (max 8MB)")
+        # Validate and read image
+        image_data = await read_search_image(image)
         
         # Perform visual search
-        results = await ml_pipeline.search_similar_products(
-            shop_id=shop.id,
-            image_data=image_data,
-            limit=limit
-        )
+        if len(regions) == 1:
+            results = await pipeline.search_similar_products(
+                shop_id=shop.id,
+                image_data=image_data,
+                limit=limit,
+                collapse=collapse,
+                product_filter=product_filter
+            )
+        else:
+            results = await pipeline.search_similar_products_multi_crop(
+                shop_id=shop.id,
+                image_data=image_data,
+                regions=regions,
+                limit=limit,
+                fusion=fusion,
+                product_filter=product_filter
+            )
         
         # Hydrate results with product metadata
-        product_ids = [r["product_id"] for r in results]
-        products = db.query(Product).filter(
-            Product.shop_id == shop.id,
-            Product.product_id.in_(product_ids)
-        ).all()
-        
-        # Create product lookup
-        product_lookup = {p.product_id: p for p in products}
-        
-        # Format results
-        formatted_results = []
-        for result in results:
-            product = product_lookup.get(result["product_id"])
-            if product:
-                formatted_results.append({
-                    "product_id": product.product_id,
-                    "title": product.title,
-                    "handle": product.handle,
-                    "image": product.image_url,
-                    "url": f"https://{shop_domain}.myshopify.com/products/{product.handle}",
-                    "score": result["score"]
-                })
+        product_lookup = load_products(db, shop.id, [r["product_id"] for r in results])
+        formatted_results = format_results(results, product_lookup, shop_domain)
         
         # Log search
         latency_ms = int((time.time() - start_time) * 1000)
@@ -277,10 +473,194 @@ async def visual_search(
             "total_results": len(formatted_results)
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Search error: {str(e)}")
         raise HTTPException(status_code=500, detail="Search failed")
 
+@app.post("/search/text")
+async def text_search(
+    shop_domain: str = Form(...),
+    q: str = Form(...),
+    limit: int = Form(24),
+    in_stock: Optional[bool] = Form(None),
+    min_price: Optional[float] = Form(None),
+    max_price: Optional[float] = Form(None),
+    product_type: Optional[str] = Form(None),
+    vendor: Optional[str] = Form(None),
+    tag: Optional[str] = Form(None),
+    db: SessionLocal = Depends(get_db)
+):
+    """Search a shop's product images with a text query, optionally filtered like /search"""
+    start_time = time.time()
+    
+    try:
+        pipeline = get_ready_pipeline()
+        
+        if not q.strip():
+            raise HTTPException(status_code=400, detail="Empty query")
+        if len(q) > 512:
+            raise HTTPException(status_code=400, detail="Query too long (max 512 characters)")
+        product_filter = product_filter_from_form(in_stock, min_price, max_price, product_type, vendor, tag)
+        
+        shop = db.query(Shop).filter(Shop.shop_domain == shop_domain).first()
+        if not shop:
+            raise HTTPException(status_code=404, detail="Shop not found")
+        
+        results = await pipeline.search_products_by_text(
+            shop_id=shop.id,
+            text=q,
+            limit=limit,
+            product_filter=product_filter
+        )
+        
+        product_lookup = load_products(db, shop.id, [r["product_id"] for r in results])
+        formatted_results = format_results(results, product_lookup, shop_domain)
+        
+        latency_ms = int((time.time() - start_time) * 1000)
+        search_log = SearchLog(
+            shop_id=shop.id,
+            latency_ms=latency_ms,
+            top_score=results[0]["score"] if results else 0.0,
+            results_count=len(formatted_results)
+        )
+        db.add(search_log)
+        db.commit()
+        
+        logger.info(f"Text search completed for {shop_domain}: {len(formatted_results)} results in {latency_ms}ms")
+        
+        return {
+            "results": formatted_results,
+            "latency_ms": latency_ms,
+            "total_results": len(formatted_results)
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Text search error: {str(e)}")
+        raise HTTPException(status_code=500, detail="Search failed")
+
+@app.post("/search/batch")
+async def visual_search_batch(
+    shop_domain: str = Form(...),
+    images: List[UploadFile] = File(...),
+    limit: int = Form(24),
+    collapse: Optional[bool] = Form(None),
+    in_stock: Optional[bool] = Form(None),
+    min_price: Optional[float] = Form(None),
+    max_price: Optional[float] = Form(None),
+    product_type: Optional[str] = Form(None),
+    vendor: Optional[str] = Form(None),
+    tag: Optional[str] = Form(None),
+    db: SessionLocal = Depends(get_db)
+):
+    """Visual search for several images with one forward pass, index search and product query
+    
+    `collapse` and the product filters work as in /search and apply to every image.
+    """
+    start_time = time.time()
+    
+    try:
+        pipeline = get_ready_pipeline()
+        
+        if len(images) > settings.SEARCH_BATCH_MAX_IMAGES:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Too many images (max {settings.SEARCH_BATCH_MAX_IMAGES})"
+            )
+        product_filter = product_filter_from_form(in_stock, min_price, max_price, product_type, vendor, tag)
+        
+        shop = db.query(Shop).filter(Shop.shop_domain == shop_domain).first()
+        if not shop:
+            raise HTTPException(status_code=404, detail="Shop not found")
+        
+        image_data_list = [await read_search_image(image) for image in images]
+        
+        batch_results = await pipeline.search_similar_products_batch(
+            shop_id=shop.id,
+            image_data_list=image_data_list,
+            limit=limit,
+            collapse=collapse,
+            product_filter=product_filter
+        )
+        
+        # One product query for the hits of every image
+        product_lookup = load_products(
+            db,
+            shop.id,
+            [r["product_id"] for results in batch_results if results for r in results]
+        )
+        
+        latency_ms = int((time.time() - start_time) * 1000)
+        response_results = []
+        search_logs = []
+        for position, results in enumerate(batch_results):
+            if results is None:
+                response_results.append({"index": position, "error": "Invalid image format"})
+                continue
+            
+            formatted_results = format_results(results, product_lookup, shop_domain)
+            response_results.append({
+                "index": position,
+                "results": formatted_results,
+                "total_results": len(formatted_results)
+            })
+            search_logs.append(SearchLog(
+                shop_id=shop.id,
+                latency_ms=latency_ms,
+                top_score=results[0]["score"] if results else 0.0,
+                results_count=len(formatted_results)
+            ))
+        
+        # Log every query with one commit
+        db.add_all(search_logs)
+        db.commit()
+        
+        logger.info(f"Batch visual search completed for {shop_domain}: {len(images)} images in {latency_ms}ms")
+        
+        return {
+            "results": response_results,
+            "latency_ms": latency_ms
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Batch search error: {str(e)}")
+        raise HTTPException(status_code=500, detail="Search failed")
+
+@app.get("/similar/{shop_domain}/{product_id}")
+async def similar_products(
+    shop_domain: str,
+    product_id: str,
+    limit: int = 12,
+    db: SessionLocal = Depends(get_db)
+):
+    """Visually similar products from the shop's precomputed neighbor table"""
+    shop = db.query(Shop).filter(Shop.shop_domain == shop_domain).first()
+    if not shop:
+        raise HTTPException(status_code=404, detail="Shop not found")
+    
+    try:
+        lookup_id = int(product_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid product ID")
+    
+    results = similar_store.get(shop.id, lookup_id, limit)
+    if results is None:
+        raise HTTPException(status_code=404, detail="No similar products for this product")
+    
+    product_lookup = load_products(db, shop.id, [r["product_id"] for r in results])
+    formatted_results = format_results(results, product_lookup, shop_domain)
+    
+    return {
+        "product_id": product_id,
+        "results": formatted_results,
+        "total_results": len(formatted_results)
+    }
+
 # Embedded app HTML
 @app.get("/admin")
 async def admin_interface():
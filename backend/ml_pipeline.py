@@ -4,31 +4,143 @@ ML Pipeline for Visual Search using OpenCLIP and FAISS
 
 import os
 import io
+import json
+import time
 import asyncio
 import numpy as np
 from typing import List, Dict, Optional, Tuple
 from PIL import Image
 import torch
 import open_clip
-import faiss
 import structlog
 from pathlib import Path
 
 from config import settings
+from batching import MicroBatcher
+from executors import InferenceExecutors
+from inference_backends import ImageEncoder, create_image_encoder, get_weights_cache_path
+from image_preprocessing import FULL_IMAGE, FastPreprocessor, Region, decode_scale, region_box
+from embedding_cache import (
+    EmbeddingCache, content_hash, create_embedding_cache, embedding_namespace, normalize_query_text
+)
+from vector_index import (
+    ShopIndex, load_global_transform, resolve_index_type, resolve_storage, validate_pq_code_size, validate_reduction
+)
+from index_registry import ShopIndexRegistry
+from query_fusion import fuse_rankings
+from near_duplicates import DuplicateClusterStore, collapse_results, find_duplicate_clusters, redundant_count
+from product_attributes import ProductAttributeStore, ProductFilter
 
 logger = structlog.get_logger()
 
+def load_clip_model(device: torch.device):
+    """Load the eager OpenCLIP model and its preprocessing transform"""
+    weights_path = get_weights_cache_path()
+    
+    if weights_path.exists():
+        # OpenAI weights were trained with QuickGELU, which a plain
+        # checkpoint path does not imply
+        model, _, preprocess = open_clip.create_model_and_transforms(
+            settings.CLIP_MODEL,
+            pretrained=str(weights_path),
+            force_quick_gelu=True
+        )
+    else:
+        model, _, preprocess = open_clip.create_model_and_transforms(
+            settings.CLIP_MODEL,
+            pretrained='openai'
+        )
+        _save_weights_cache(model, weights_path)
+    
+    model = model.to(device)
+    model.eval()
+    return model, preprocess
+
+def _save_weights_cache(model, weights_path: Path):
+    """Serialize pretrained weights locally so later starts skip resolution"""
+    try:
+        weights_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = weights_path.with_suffix(f".tmp-{os.getpid()}")
+        torch.save(model.state_dict(), str(tmp_path))
+        os.replace(tmp_path, weights_path)
+        logger.info(f"Cached model weights at {weights_path}")
+    except Exception as e:
+        logger.warning(f"Could not cache model weights: {str(e)}")
+
+def get_preprocess_config(model) -> Tuple[Tuple[int, int], Tuple[float, ...], Tuple[float, ...]]:
+    """Input size and normalization constants of a loaded OpenCLIP model"""
+    visual = model.visual
+    image_size = visual.image_size
+    if isinstance(image_size, int):
+        image_size = (image_size, image_size)
+    mean = getattr(visual, "image_mean", None) or open_clip.OPENAI_DATASET_MEAN
+    std = getattr(visual, "image_std", None) or open_clip.OPENAI_DATASET_STD
+    return tuple(image_size), tuple(mean), tuple(std)
+
 class MLPipeline:
     """Main ML pipeline for visual search functionality"""
     
-    def __init__(self):
+    def __init__(self, read_only: bool = False):
         self.model = None
         self.preprocess = None
         self.tokenizer = None
+        self.encoder: Optional[ImageEncoder] = None
+        self.fast_preprocessor: Optional[FastPreprocessor] = None
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        self.faiss_indices: Dict[int, faiss.Index] = {}  # shop_id -> index
         self.ready = False
         
+        # Per-shop indices, loaded on first use (memory-mapped when read-only)
+        self.indices = ShopIndexRegistry(
+            settings.FAISS_DIR,
+            budget_bytes=settings.INDEX_MEMORY_BUDGET_MB * 1024 * 1024,
+            read_only=read_only,
+            use_mmap=settings.INDEX_MMAP,
+            on_load=self._apply_search_params
+        )
+        
+        # Keeps decode and inference off the event loop
+        self.executors = InferenceExecutors()
+        
+        # Coalesces concurrent search queries into one forward pass
+        self.query_batcher = MicroBatcher(
+            self._embed_images,
+            window_ms=settings.QUERY_BATCH_WINDOW_MS,
+            max_batch_size=settings.QUERY_BATCH_MAX_SIZE,
+            name="query_batcher",
+            executor=self.executors.inference_pool
+        )
+        
+        # Query embeddings keyed by uploaded image hash
+        self.query_cache: Optional[EmbeddingCache] = create_embedding_cache(
+            settings.QUERY_CACHE_BACKEND,
+            max_entries=settings.QUERY_CACHE_MAX_ENTRIES,
+            max_mb=settings.QUERY_CACHE_MAX_MB,
+            ttl_seconds=settings.QUERY_CACHE_TTL_SECONDS,
+            path=settings.QUERY_CACHE_PATH or str(Path(settings.TMP_DIR) / "query_cache.sqlite")
+        )
+        
+        # Text queries: coalesced like image queries, LRU-cached by normalized text
+        self.text_batcher = MicroBatcher(
+            self._embed_texts,
+            window_ms=settings.QUERY_BATCH_WINDOW_MS,
+            max_batch_size=settings.TEXT_BATCH_MAX_SIZE,
+            name="text_batcher",
+            executor=self.executors.inference_pool
+        )
+        self.text_cache: Optional[EmbeddingCache] = create_embedding_cache(
+            settings.TEXT_CACHE_BACKEND,
+            max_entries=settings.TEXT_CACHE_MAX_ENTRIES,
+            max_mb=settings.TEXT_CACHE_MAX_MB,
+            ttl_seconds=0
+        )
+        self._text_inflight: Dict[str, asyncio.Future] = {}
+        
+        # Near-duplicate clusters used to collapse search results
+        self.duplicates = DuplicateClusterStore(settings.FAISS_DIR)
+        
+        # Product attributes that search filters select on
+        self.attributes = ProductAttributeStore(settings.FAISS_DIR)
+        
         # Ensure data directories exist
         os.makedirs(settings.FAISS_DIR, exist_ok=True)
         os.makedirs(settings.TMP_DIR, exist_ok=True)
@@ -37,167 +149,477 @@ class MLPipeline:
         """Initialize ML models and components"""
         try:
             logger.info(f"Initializing ML pipeline on device: {self.device}")
+            timings = {}
+            loop = asyncio.get_running_loop()
             
             # Load OpenCLIP model
-            self.model, _, self.preprocess = open_clip.create_model_and_transforms(
-                settings.CLIP_MODEL,
-                pretrained='openai'
-            )
-            self.model = self.model.to(self.device)
-            self.model.eval()
+            start_time = time.perf_counter()
+            self.model, self.preprocess = await loop.run_in_executor(None, load_clip_model, self.device)
+            timings["model_load_ms"] = (time.perf_counter() - start_time) * 1000
+            
+            # Select image encoder backend
+            start_time = time.perf_counter()
+            self.encoder = create_image_encoder(settings.INFERENCE_BACKEND, self.model, self.device)
+            timings["encoder_ms"] = (time.perf_counter() - start_time) * 1000
             
-            # Load tokenizer for text (future multi-modal search)
+            # Start executors with the model's preprocessing configuration
+            image_size, mean, std = get_preprocess_config(self.model)
+            if settings.FAST_PREPROCESS:
+                self.fast_preprocessor = FastPreprocessor(image_size, mean, std)
+            self.executors.start(image_size, mean=mean, std=std)
+            
+            # Load tokenizer for text search
             self.tokenizer = open_clip.get_tokenizer(settings.CLIP_MODEL)
             
-            # Load existing FAISS indices
-            await self._load_existing_indices()
+            # Shop indices load lazily on first search
+            timings["on_disk_shops"] = len(self.indices.on_disk_shops())
+            
+            # Pay allocator and first-call costs before real traffic
+            if settings.MODEL_WARMUP:
+                start_time = time.perf_counter()
+                await self._warm_up(image_size)
+                timings["warmup_ms"] = (time.perf_counter() - start_time) * 1000
             
             self.ready = True
-            logger.info("ML pipeline initialized successfully")
+            logger.info(
+                "ML pipeline initialized successfully",
+                **{name: round(value, 1) for name, value in timings.items()}
+            )
             
         except Exception as e:
             logger.error(f"Failed to initialize ML pipeline: {str(e)}")
             raise
     
+    async def _warm_up(self, image_size: Tuple[int, int]):
+        """Run synthetic batches through the encoder at the sizes used in serving"""
+        if self.fast_preprocessor is not None:
+            blank = np.zeros((image_size[0], image_size[1], 3), dtype=np.uint8)
+        else:
+            blank = np.zeros((3, image_size[0], image_size[1]), dtype=np.float32)
+        
+        for batch_size in sorted({1, settings.QUERY_BATCH_MAX_SIZE}):
+            await self.executors.run_inference(self._embed_images, [blank] * batch_size)
+        
+        await self.executors.run_inference(self._embed_texts, ["a photo of a product"])
+    
     def is_ready(self) -> bool:
         """Check if ML pipeline is ready"""
-        return self.ready and self.model is not None
-    
-    async def _load_existing_indices(self):
-        """Load existing FAISS indices from disk"""
-        try:
-            faiss_dir = Path(settings.FAISS_DIR)
-            for index_file in faiss_dir.glob("shop_*.index"):
-                shop_id = int(index_file.stem.split('_')[1])
-                index = faiss.read_index(str(index_file))
-                self.faiss_indices[shop_id] = index
-                logger.info(f"Loaded FAISS index for shop {shop_id}: {index.ntotal} vectors")
-        except Exception as e:
-            logger.warning(f"Error loading existing indices: {str(e)}")
+        return self.ready and self.model is not None and self.encoder is not None
     
-    def _preprocess_image(self, image_data: bytes) -> torch.Tensor:
+    def _preprocess_image(self, image_data: bytes) -> np.ndarray:
         """Preprocess image for CLIP model"""
         try:
+            # Fast path: draft decode + resize/crop, normalized later per batch
+            if self.fast_preprocessor is not None:
+                return self.fast_preprocessor.load_and_crop(image_data)
+            
             # Open and convert image
             image = Image.open(io.BytesIO(image_data)).convert('RGB')
             
             # Apply CLIP preprocessing
-            image_tensor = self.preprocess(image).unsqueeze(0)
-            return image_tensor.to(self.device)
+            return self.preprocess(image).numpy()
             
         except Exception as e:
             logger.error(f"Image preprocessing error: {str(e)}")
             raise ValueError("Invalid image format")
     
-    def _generate_embedding(self, image_tensor: torch.Tensor) -> np.ndarray:
-        """Generate embedding vector from preprocessed image"""
+    def _preprocess_regions(self, image_data: bytes, regions: List[Region], scale: float) -> List[np.ndarray]:
+        """Decode an image once, at the given draft scale, and preprocess each region as a separate crop"""
         try:
-            with torch.no_grad():
-                # Generate image features
-                image_features = self.model.encode_image(image_tensor)
-                
-                # Normalize features
-                image_features = image_features / image_features.norm(dim=-1, keepdim=True)
-                
-                # Convert to numpy
-                embedding = image_features.cpu().numpy().astype(np.float32)
-                return embedding.flatten()
-                
+            if self.fast_preprocessor is not None:
+                return list(self.fast_preprocessor.load_and_crop_regions(image_data, regions, scale))
+            
+            image = Image.open(io.BytesIO(image_data)).convert('RGB')
+            width, height = image.size
+            return [self.preprocess(image.crop(region_box(region, width, height))).numpy() for region in regions]
+            
+        except Exception as e:
+            logger.error(f"Image preprocessing error: {str(e)}")
+            raise ValueError("Invalid image format")
+    
+    async def _preprocess_image_async(self, image_data: bytes) -> np.ndarray:
+        """Preprocess image off the event loop"""
+        if self.executors.decode_pool is not None:
+            return await self.executors.run_decode(image_data)
+        
+        return await self.executors.run_inference(self._preprocess_image, image_data)
+    
+    async def _preprocess_images(self, image_data_list: List[bytes]) -> Tuple[List[np.ndarray], List[int]]:
+        """Preprocess several images concurrently, skipping invalid ones"""
+        outcomes = await asyncio.gather(
+            *(self._preprocess_image_async(image_data) for image_data in image_data_list),
+            return_exceptions=True
+        )
+        
+        images = []
+        valid_positions = []
+        
+        for position, outcome in enumerate(outcomes):
+            if isinstance(outcome, ValueError):
+                continue
+            if isinstance(outcome, BaseException):
+                raise outcome
+            images.append(outcome)
+            valid_positions.append(position)
+        
+        return images, valid_positions
+    
+    def _to_model_input(self, images: List[np.ndarray]) -> torch.Tensor:
+        """Stack preprocessed images into one model input batch"""
+        batch = np.stack(images)
+        if self.fast_preprocessor is not None:
+            batch = self.fast_preprocessor.normalize(batch)
+        return torch.from_numpy(batch).to(self.device)
+    
+    def _generate_embeddings(self, image_tensor: torch.Tensor) -> np.ndarray:
+        """Generate normalized embeddings for a batch of preprocessed images"""
+        try:
+            # Generate image features with the selected backend
+            image_features = self.encoder.encode(image_tensor)
+            
+            # Normalize features
+            image_features = image_features / np.linalg.norm(image_features, axis=1, keepdims=True)
+            return image_features.astype(np.float32)
+            
         except Exception as e:
             logger.error(f"Embedding generation error: {str(e)}")
             raise
     
+    def _embed_images(self, images: List[np.ndarray]) -> np.ndarray:
+        """Run one forward pass over preprocessed images"""
+        return self._generate_embeddings(self._to_model_input(images))
+    
+    def _embed_texts(self, texts: List[str]) -> np.ndarray:
+        """Run one text encoder pass over query strings"""
+        tokens = self.tokenizer(texts).to(self.device)
+        with torch.no_grad():
+            features = self.model.encode_text(tokens).float().cpu().numpy()
+        features = features / np.linalg.norm(features, axis=1, keepdims=True)
+        return features.astype(np.float32)
+    
+    async def preprocess_product_image(self, image_data: bytes) -> np.ndarray:
+        """Decode and preprocess a product image off the event loop"""
+        return await self._preprocess_image_async(image_data)
+    
+    async def embed_product_images(self, images: List[np.ndarray]) -> np.ndarray:
+        """Embed preprocessed product images with one forward pass"""
+        if not self.is_ready():
+            raise RuntimeError("ML pipeline not initialized")
+        return await self.executors.run_inference(self._embed_images, images)
+    
     async def process_product_image(self, image_data: bytes) -> np.ndarray:
         """Process a single product image and return embedding"""
         if not self.is_ready():
             raise RuntimeError("ML pipeline not initialized")
         
         # Preprocess image
-        image_tensor = self._preprocess_image(image_data)
+        image = await self._preprocess_image_async(image_data)
         
         # Generate embedding
-        embedding = self._generate_embedding(image_tensor)
+        embeddings = await self.executors.run_inference(self._embed_images, [image])
+        
+        return embeddings[0]
+    
+    async def embed_query(self, image_data: bytes) -> np.ndarray:
+        """Embed a search query image, batched with concurrent queries"""
+        if not self.is_ready():
+            raise RuntimeError("ML pipeline not initialized")
+        
+        # Repeat queries skip decode and inference entirely
+        cache_key = self._query_cache_key(image_data)
+        if self.query_cache is not None:
+            cached = self.query_cache.get(cache_key)
+            if cached is not None:
+                return cached
+        
+        image = await self._preprocess_image_async(image_data)
+        embedding = await self.query_batcher.submit(image)
+        
+        if self.query_cache is not None:
+            self.query_cache.put(cache_key, embedding)
+        return embedding
+    
+    async def embed_queries(self, image_data_list: List[bytes]) -> Tuple[np.ndarray, List[int]]:
+        """Embed several query images in one forward pass
+        
+        Returns the embeddings of valid images and their positions in the input.
+        """
+        if not self.is_ready():
+            raise RuntimeError("ML pipeline not initialized")
+        
+        cache_keys = [self._query_cache_key(image_data) for image_data in image_data_list]
+        embeddings: Dict[int, np.ndarray] = {}
+        if self.query_cache is not None:
+            for position, cache_key in enumerate(cache_keys):
+                cached = self.query_cache.get(cache_key)
+                if cached is not None:
+                    embeddings[position] = cached
         
+        misses = [position for position in range(len(image_data_list)) if position not in embeddings]
+        if misses:
+            images, valid = await self._preprocess_images([image_data_list[position] for position in misses])
+            if images:
+                # Already a batch, so skip the micro-batcher window
+                batch = await self.executors.run_inference(self._embed_images, images)
+                for row, valid_position in enumerate(valid):
+                    position = misses[valid_position]
+                    embeddings[position] = batch[row]
+                    if self.query_cache is not None:
+                        self.query_cache.put(cache_keys[position], batch[row])
+        
+        positions = sorted(embeddings)
+        if not positions:
+            return np.empty((0, settings.EMBEDDING_DIMENSION), dtype=np.float32), []
+        return np.stack([embeddings[position] for position in positions]), positions
+    
+    async def embed_query_regions(self, image_data: bytes, regions: List[Region]) -> np.ndarray:
+        """Embed several crops of one query image in one forward pass"""
+        if not self.is_ready():
+            raise RuntimeError("ML pipeline not initialized")
+        
+        # Every crop comes from one decode, at a scale set by the smallest region
+        scale = decode_scale(regions)
+        cache_keys = [self._query_cache_key(image_data, region, scale) for region in regions]
+        embeddings: Dict[int, np.ndarray] = {}
+        if self.query_cache is not None:
+            for position, cache_key in enumerate(cache_keys):
+                cached = self.query_cache.get(cache_key)
+                if cached is not None:
+                    embeddings[position] = cached
+        
+        misses = [position for position in range(len(regions)) if position not in embeddings]
+        if misses:
+            crops = await self.executors.run_inference(
+                self._preprocess_regions, image_data, [regions[position] for position in misses], scale
+            )
+            batch = await self.executors.run_inference(self._embed_images, crops)
+            for row, position in enumerate(misses):
+                embeddings[position] = batch[row]
+                if self.query_cache is not None:
+                    self.query_cache.put(cache_keys[position], batch[row])
+        
+        return np.stack([embeddings[position] for position in range(len(regions))])
+    
+    async def embed_text(self, text: str) -> np.ndarray:
+        """Embed a text query, batched with concurrent queries"""
+        if not self.is_ready():
+            raise RuntimeError("ML pipeline not initialized")
+        
+        query = normalize_query_text(text)
+        cache_key = f"text:{settings.CLIP_MODEL}:{query}"
+        if self.text_cache is not None:
+            cached = self.text_cache.get(cache_key)
+            if cached is not None:
+                return cached
+        
+        # Identical queries in flight share one encode
+        inflight = self._text_inflight.get(cache_key)
+        if inflight is not None:
+            return await asyncio.shield(inflight)
+        
+        future = asyncio.ensure_future(self.text_batcher.submit(query))
+        self._text_inflight[cache_key] = future
+        try:
+            embedding = await asyncio.shield(future)
+        finally:
+            self._text_inflight.pop(cache_key, None)
+        
+        if self.text_cache is not None:
+            self.text_cache.put(cache_key, embedding)
         return embedding
     
-    def get_or_create_index(self, shop_id: int) -> faiss.Index:
+    def _query_cache_key(self, image_data: bytes, region: Region = FULL_IMAGE, scale: float = 1.0) -> str:
+        """Cache key for a query image (or region of it) under the current model configuration
+        
+        Draft decoding makes the pixels depend on the decode scale, so the
+        whole image decoded for a multi-crop query is a different input than
+        a plain query of the same bytes.
+        """
+        region_key = ",".join(f"{v:.4f}" for v in region)
+        return f"{embedding_namespace()}:{content_hash(image_data)}:{region_key}@{scale:.4f}"
+    
+    def get_or_create_index(self, shop_id: int) -> ShopIndex:
         """Get existing FAISS index for shop or create new one"""
-        if shop_id not in self.faiss_indices:
-            # Create new flat index
-            index = faiss.IndexFlatIP(settings.EMBEDDING_DIMENSION)  # Inner product for cosine similarity
-            self.faiss_indices[shop_id] = index
+        index = self.indices.get(shop_id)
+        if index is None:
+            # Create new ID-mapped flat index (inner product for cosine similarity)
+            index = ShopIndex.create(settings.EMBEDDING_DIMENSION)
+            self._apply_search_params(shop_id, index)
+            self.indices.put(shop_id, index)
             logger.info(f"Created new FAISS index for shop {shop_id}")
         
-        return self.faiss_indices[shop_id]
+        return index
+    
+    def get_index(self, shop_id: int) -> Optional[ShopIndex]:
+        """Get shop's FAISS index, loading it from disk on first use"""
+        return self.indices.get(shop_id)
+    
+    async def reload_indices(self) -> int:
+        """Swap in index snapshots saved by other processes since they were loaded"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.indices.refresh)
     
     def add_product_embedding(self, shop_id: int, product_id: str, embedding: np.ndarray):
         """Add product embedding to shop's FAISS index"""
+        self.upsert_embeddings(shop_id, [product_id], embedding.reshape(1, -1))
+    
+    def upsert_embeddings(self, shop_id: int, ids: List[str], vectors: np.ndarray):
+        """Insert or replace product embeddings in one batched call"""
         try:
             index = self.get_or_create_index(shop_id)
             
-            # Normalize embedding for cosine similarity
-            embedding = embedding / np.linalg.norm(embedding)
-            embedding = embedding.reshape(1, -1).astype(np.float32)
+            # Normalize embeddings for cosine similarity
+            vectors = vectors.reshape(len(ids), -1).astype(np.float32)
+            vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
             
-            # Add to index with product_id as ID
-            index.add_with_ids(embedding, np.array([int(product_id)]))
+            index.upsert(ids, vectors)
+            self.indices.mark_dirty(shop_id)
             
-            logger.debug(f"Added embedding for product {product_id} to shop {shop_id} index")
+            logger.debug(f"Upserted {len(ids)} embeddings in shop {shop_id} index")
             
         except Exception as e:
-            logger.error(f"Error adding embedding: {str(e)}")
+            logger.error(f"Error upserting embeddings: {str(e)}")
             raise
     
+    def remove_products(self, shop_id: int, ids: List[str]) -> int:
+        """Remove products from shop's FAISS index in one batched call"""
+        index = self.indices.get(shop_id)
+        if index is None or not ids:
+            return 0
+        
+        removed = index.remove(ids)
+        self.indices.mark_dirty(shop_id)
+        logger.info(f"Removed {removed} products from shop {shop_id} index")
+        return removed
+    
     def save_index(self, shop_id: int):
         """Save FAISS index to disk"""
         try:
-            if shop_id in self.faiss_indices:
-                index_path = Path(settings.FAISS_DIR) / f"shop_{shop_id}.index"
-                faiss.write_index(self.faiss_indices[shop_id], str(index_path))
-                logger.info(f"Saved FAISS index for shop {shop_id}: {index_path}")
+            index = self.indices.peek(shop_id)
+            if index is not None:
+                # Switch to the index type and storage the catalog size and params call for
+                params = self.get_search_params(shop_id)
+                reduce_dim = int(params["reduce_dim"])
+                transform = None
+                if reduce_dim and params["reduce_scope"] == "global":
+                    transform = load_global_transform(params["reduce_method"], reduce_dim)
+                    if transform is None:
+                        logger.warning(f"No global {params['reduce_method']}{reduce_dim} projection, training per shop")
+                
+                index.optimize(
+                    params["index_type"],
+                    params["storage"],
+                    int(params["pq_code_size"]),
+                    reduce_dim,
+                    params["reduce_method"],
+                    transform
+                )
+                
+                # Versioned snapshot, picked up by serving processes on their next poll
+                index_path = self.indices.save(shop_id)
+                logger.info(f"Saved {index.index_type} FAISS index for shop {shop_id}: {index_path}")
         except Exception as e:
             logger.error(f"Error saving index: {str(e)}")
     
+    def _search_params_path(self, shop_id: int) -> Path:
+        return Path(settings.FAISS_DIR) / f"shop_{shop_id}.params.json"
+    
+    def get_search_params(self, shop_id: int) -> Dict:
+        """Per-shop index type and search knobs, with global defaults"""
+        params = {
+            "index_type": settings.FAISS_INDEX_TYPE,
+            "nprobe": settings.FAISS_NPROBE,
+            "ef_search": settings.FAISS_EF_SEARCH,
+            "storage": settings.FAISS_STORAGE,
+            "pq_code_size": settings.IVFPQ_CODE_SIZE,
+            "rerank_factor": settings.FAISS_RERANK_FACTOR,
+            "reduce_dim": settings.FAISS_REDUCE_DIM,
+            "reduce_method": settings.FAISS_REDUCE_METHOD,
+            "reduce_scope": settings.FAISS_REDUCE_SCOPE
+        }
+        params_path = self._search_params_path(shop_id)
+        if params_path.exists():
+            try:
+                params.update(json.loads(params_path.read_text()))
+            except (OSError, ValueError) as e:
+                logger.warning(f"Invalid search params for shop {shop_id}: {str(e)}")
+        return params
+    
+    def set_search_params(self, shop_id: int, **overrides) -> Dict:
+        """Persist per-shop overrides and apply them to the loaded index"""
+        if overrides.get("index_type") is not None:
+            resolve_index_type(overrides["index_type"], 0)  # raises ValueError if unknown
+        if overrides.get("storage") is not None:
+            resolve_storage("Flat", overrides["storage"])
+        if overrides.get("reduce_scope") not in (None, "shop", "global"):
+            raise ValueError(f"Unknown reduction scope: {overrides['reduce_scope']}")
+        
+        params = self.get_search_params(shop_id)
+        params.update({name: value for name, value in overrides.items() if value is not None})
+        
+        # PQ sub-vectors split the stored (possibly reduced) dimension
+        validate_reduction(int(params["reduce_dim"]), params["reduce_method"], settings.EMBEDDING_DIMENSION)
+        if resolve_storage(params["index_type"], params["storage"]) == "pq":
+            validate_pq_code_size(
+                int(params["pq_code_size"]),
+                int(params["reduce_dim"]) or settings.EMBEDDING_DIMENSION
+            )
+        
+        params_path = self._search_params_path(shop_id)
+        tmp_path = params_path.with_suffix(f".tmp-{os.getpid()}")
+        tmp_path.write_text(json.dumps(params))
+        os.replace(tmp_path, params_path)
+        
+        index = self.indices.peek(shop_id)
+        if index is not None:
+            self._apply_search_params(shop_id, index)
+        return params
+    
+    def _apply_search_params(self, shop_id: int, index: ShopIndex):
+        params = self.get_search_params(shop_id)
+        index.nprobe = int(params["nprobe"])
+        index.ef_search = int(params["ef_search"])
+        index.rerank_factor = int(params["rerank_factor"])
+    
     async def search_similar_products(
         self, 
         shop_id: int, 
         image_data: bytes, 
-        limit: int = 24
+        limit: int = 24,
+        collapse: Optional[bool] = None,
+        product_filter: Optional[ProductFilter] = None
     ) -> List[Dict]:
-        """Search for visually similar products"""
+        """Search for visually similar products
+        
+        With collapse, near-duplicate products count once: each result keeps
+        the best-scoring member of its cluster and reports how many others
+        were folded into it. product_filter restricts the index scan to
+        matching products.
+        """
         try:
             if not self.is_ready():
                 raise RuntimeError("ML pipeline not initialized")
             
-            # Check if shop has index
-            if shop_id not in self.faiss_indices:
+            # Check if shop has index (loaded from disk off the event loop)
+            loop = asyncio.get_running_loop()
+            index = await loop.run_in_executor(None, self.get_index, shop_id)
+            if index is None:
                 logger.warning(f"No index found for shop {shop_id}")
                 return []
             
-            index = self.faiss_indices[shop_id]
-            if index.ntotal == 0:
+            if index.live_count == 0:
                 logger.warning(f"Empty index for shop {shop_id}")
                 return []
             
-            # Process query image
-            embedding = await self.process_product_image(image_data)
+            # Process query image (coalesced with concurrent queries)
+            embedding = await self.embed_query(image_data)
             
             # Normalize for cosine similarity
             embedding = embedding / np.linalg.norm(embedding)
             embedding = embedding.reshape(1, -1).astype(np.float32)
             
-            # Search in FAISS index
-            k = min(limit, index.ntotal)
-            scores, indices = index.search(embedding, k)
-            
-            # Format results
-            results = []
-            for i in range(k):
-                if scores[0][i] > 0:  # Only return positive similarities
-                    results.append({
-                        "product_id": str(indices[0][i]),
-                        "score": float(scores[0][i])
-                    })
+            results = await self._search_embeddings(shop_id, index, embedding, limit, collapse, product_filter)
+            results = results[0]
             
             logger.info(f"Visual search completed for shop {shop_id}: {len(results)} results")
             return results
@@ -206,30 +628,242 @@ class MLPipeline:
             logger.error(f"Search error: {str(e)}")
             raise
     
+    async def _search_embeddings(
+        self,
+        shop_id: int,
+        index: ShopIndex,
+        embeddings: np.ndarray,
+        limit: int,
+        collapse: Optional[bool] = None,
+        product_filter: Optional[ProductFilter] = None
+    ) -> List[List[Dict]]:
+        """Results per normalized query embedding, filtered and collapsed as requested"""
+        if collapse is None:
+            collapse = settings.COLLAPSE_DUPLICATES
+        clusters = self.duplicates.get(shop_id) if collapse else None
+        allowed = self._allowed_ids(shop_id, product_filter)
+        
+        if clusters is not None:
+            return await self._search_collapsed(index, embeddings, clusters, limit, allowed)
+        
+        scores, indices = await self.executors.run_inference(index.search, embeddings, limit, allowed)
+        return [self._format_results(scores[row], indices[row]) for row in range(len(embeddings))]
+    
+    async def _search_collapsed(
+        self,
+        index: ShopIndex,
+        embeddings: np.ndarray,
+        clusters: np.ndarray,
+        limit: int,
+        allowed: Optional[np.ndarray] = None
+    ) -> List[List[Dict]]:
+        """Top distinct results per query, over-fetching only as far as duplicates require
+        
+        At most `redundant` hits can be folded away, so limit + redundant
+        candidates always suffice; the search starts with a smaller margin
+        and widens only for queries the first pass left short.
+        """
+        redundant = redundant_count(clusters)
+        k = limit + min(redundant, limit)
+        results: List[List[Dict]] = [[] for _ in range(len(embeddings))]
+        pending = np.arange(len(embeddings))
+        
+        while len(pending):
+            scores, indices = await self.executors.run_inference(index.search, embeddings[pending], k, allowed)
+            widest = k >= index.live_count or k - limit >= redundant
+            short = []
+            for row, query in enumerate(pending.tolist()):
+                results[query] = collapse_results(scores[row], indices[row], clusters, limit)
+                if len(results[query]) < limit and not widest:
+                    short.append(query)
+            pending = np.array(short, dtype=np.int64)
+            k = min(limit + redundant, k * 2)
+        
+        return results
+    
+    def _allowed_ids(self, shop_id: int, product_filter: Optional[ProductFilter]) -> Optional[np.ndarray]:
+        """Product IDs a filtered search may return, None when unfiltered"""
+        if product_filter is None or not product_filter.active:
+            return None
+        
+        allowed = self.attributes.matching_ids(shop_id, product_filter)
+        if allowed is None:
+            # Attributes are written by the first indexing run after upgrade
+            logger.warning(f"No product attributes for shop {shop_id}, filtered search matches nothing")
+            return np.empty(0, dtype=np.int64)
+        return allowed
+    
+    async def find_duplicates(self, shop_id: int, threshold: Optional[float] = None) -> Optional[np.ndarray]:
+        """Recompute and save a shop's near-duplicate clusters"""
+        index = self.get_index(shop_id)
+        if index is None:
+            return None
+        
+        # Long-running, so kept off the inference pool that serves queries
+        loop = asyncio.get_running_loop()
+        clusters = await loop.run_in_executor(
+            None,
+            find_duplicate_clusters,
+            index,
+            threshold if threshold is not None else settings.DUPLICATE_THRESHOLD,
+            settings.DUPLICATE_BLOCK_SIZE
+        )
+        self.duplicates.save(shop_id, clusters)
+        return clusters
+    
+    async def search_products_by_text(
+        self,
+        shop_id: int,
+        text: str,
+        limit: int = 24,
+        product_filter: Optional[ProductFilter] = None
+    ) -> List[Dict]:
+        """Search a shop's image index with a CLIP text query"""
+        try:
+            if not self.is_ready():
+                raise RuntimeError("ML pipeline not initialized")
+            
+            loop = asyncio.get_running_loop()
+            index = await loop.run_in_executor(None, self.get_index, shop_id)
+            if index is None or index.live_count == 0:
+                logger.warning(f"No indexed products for shop {shop_id}")
+                return []
+            
+            embedding = await self.embed_text(text)
+            scores, indices = await self.executors.run_inference(
+                index.search, embedding.reshape(1, -1), limit, self._allowed_ids(shop_id, product_filter)
+            )
+            results = self._format_results(scores[0], indices[0])
+            
+            logger.info(f"Text search completed for shop {shop_id}: {len(results)} results")
+            return results
+            
+        except Exception as e:
+            logger.error(f"Text search error: {str(e)}")
+            raise
+    
+    async def search_similar_products_batch(
+        self,
+        shop_id: int,
+        image_data_list: List[bytes],
+        limit: int = 24,
+        collapse: Optional[bool] = None,
+        product_filter: Optional[ProductFilter] = None
+    ) -> List[Optional[List[Dict]]]:
+        """Search for several query images with one forward pass and one index search
+        
+        Returns one result list per image, or None for images that failed to
+        decode. collapse and product_filter apply to every image, as in
+        search_similar_products.
+        """
+        try:
+            if not self.is_ready():
+                raise RuntimeError("ML pipeline not initialized")
+            
+            loop = asyncio.get_running_loop()
+            index = await loop.run_in_executor(None, self.get_index, shop_id)
+            
+            embeddings, positions = await self.embed_queries(image_data_list)
+            batch_results: List[Optional[List[Dict]]] = [None] * len(image_data_list)
+            
+            if index is None or index.live_count == 0:
+                logger.warning(f"No indexed products for shop {shop_id}")
+                for position in positions:
+                    batch_results[position] = []
+                return batch_results
+            
+            if positions:
+                # One search over the whole query matrix
+                results = await self._search_embeddings(
+                    shop_id, index, embeddings, limit, collapse, product_filter
+                )
+                for row, position in enumerate(positions):
+                    batch_results[position] = results[row]
+            
+            logger.info(f"Batch visual search completed for shop {shop_id}: {len(positions)} queries")
+            return batch_results
+            
+        except Exception as e:
+            logger.error(f"Batch search error: {str(e)}")
+            raise
+    
+    async def search_similar_products_multi_crop(
+        self,
+        shop_id: int,
+        image_data: bytes,
+        regions: List[Region],
+        limit: int = 24,
+        fusion: str = "max",
+        product_filter: Optional[ProductFilter] = None
+    ) -> List[Dict]:
+        """Search with several crops of one image and fuse the per-crop rankings"""
+        try:
+            if not self.is_ready():
+                raise RuntimeError("ML pipeline not initialized")
+            
+            loop = asyncio.get_running_loop()
+            index = await loop.run_in_executor(None, self.get_index, shop_id)
+            if index is None or index.live_count == 0:
+                logger.warning(f"No indexed products for shop {shop_id}")
+                return []
+            
+            # All crops share one forward pass and one index search
+            embeddings = await self.embed_query_regions(image_data, regions)
+            scores, indices = await self.executors.run_inference(
+                index.search, embeddings, limit, self._allowed_ids(shop_id, product_filter)
+            )
+            results = fuse_rankings(scores, indices, fusion, limit, settings.QUERY_FUSION_RRF_K)
+            
+            logger.info(
+                f"Multi-crop visual search completed for shop {shop_id}: "
+                f"{len(regions)} crops, {len(results)} results"
+            )
+            return results
+            
+        except Exception as e:
+            logger.error(f"Search error: {str(e)}")
+            raise
+    
+    @staticmethod
+    def _format_results(scores: np.ndarray, labels: np.ndarray) -> List[Dict]:
+        """Search hits for one query, keeping only positive similarities"""
+        return [
+            {"product_id": str(label), "score": float(score)}
+            for score, label in zip(scores, labels)
+            if label >= 0 and score > 0
+        ]
+    
     def get_index_stats(self, shop_id: int) -> Dict:
         """Get statistics for shop's FAISS index"""
-        if shop_id not in self.faiss_indices:
-            return {"indexed_products": 0, "index_size_mb": 0}
+        index = self.get_index(shop_id)
+        if index is None:
+            return {"indexed_products": 0, "tombstoned_products": 0, "index_size_mb": 0}
         
-        index = self.faiss_indices[shop_id]
-        index_size_mb = index.ntotal * settings.EMBEDDING_DIMENSION * 4 / (1024 * 1024)  # 4 bytes per float32
+        stats = index.get_stats()
+        index_size_mb = index.ntotal * stats["bytes_per_vector"] / (1024 * 1024)
         
         return {
-            "indexed_products": index.ntotal,
+            "index_type": index.index_type,
+            "storage": stats["storage"],
+            "dimension": stats["dimension"],
+            "indexed_products": index.live_count,
+            "tombstoned_products": len(index.tombstones),
+            "bytes_per_vector": stats["bytes_per_vector"],
+            "exact_bytes_per_vector": stats["exact_bytes_per_vector"],
             "index_size_mb": round(index_size_mb, 2)
         }
     
     def remove_shop_index(self, shop_id: int):
         """Remove shop's index from memory and disk"""
         try:
-            # Remove from memory
-            if shop_id in self.faiss_indices:
-                del self.faiss_indices[shop_id]
+            # Remove from memory and disk
+            self.indices.delete(shop_id)
+            self.duplicates.delete(shop_id)
+            self.attributes.delete(shop_id)
             
-            # Remove from disk
-            index_path = Path(settings.FAISS_DIR) / f"shop_{shop_id}.index"
-            if index_path.exists():
-                index_path.unlink()
+            for path in (self._search_params_path(shop_id), Path(settings.FAISS_DIR) / f"shop_{shop_id}.similar.npy"):
+                if path.exists():
+                    path.unlink()
             
             logger.info(f"Removed index for shop {shop_id}")
             
@@ -242,20 +876,38 @@ class MLPipeline:
         product_data: List[Tuple[str, bytes]]
     ) -> Dict[str, np.ndarray]:
         """Process multiple images in batch for efficiency"""
+        if not self.is_ready():
+            raise RuntimeError("ML pipeline not initialized")
+        
         results = {}
+        batch_size = settings.EMBEDDING_BATCH_SIZE
         
         try:
-            for product_id, image_data in product_data:
-                try:
-                    embedding = await self.process_product_image(image_data)
-                    results[product_id] = embedding
-                    
-                    # Add to FAISS index immediately
-                    self.add_product_embedding(shop_id, product_id, embedding)
-                    
-                except Exception as e:
-                    logger.error(f"Error processing product {product_id}: {str(e)}")
+            for start in range(0, len(product_data), batch_size):
+                chunk = product_data[start:start + batch_size]
+                
+                # Decode and preprocess the chunk, skipping corrupt images
+                images, valid_positions = await self._preprocess_images(
+                    [image_data for _, image_data in chunk]
+                )
+                
+                skipped = len(chunk) - len(valid_positions)
+                if skipped:
+                    logger.error(f"Skipped {skipped} invalid images in batch for shop {shop_id}")
+                
+                if not images:
                     continue
+                
+                # One forward pass for the whole chunk
+                embeddings = await self.executors.run_inference(self._embed_images, images)
+                
+                for row, position in enumerate(valid_positions):
+                    results[chunk[position][0]] = embeddings[row]
+            
+            # Add all vectors to FAISS index in one call
+            if results:
+                product_ids = list(results.keys())
+                self.upsert_embeddings(shop_id, product_ids, np.stack(list(results.values())))
             
             # Save index after batch
             self.save_index(shop_id)
@@ -265,4 +917,4 @@ class MLPipeline:
             
         except Exception as e:
             logger.error(f"Batch processing error: {str(e)}")
-            raise
\ No newline at end of file
+            raise
@@ -0,0 +1,275 @@
+"""
+Command line tools for the ML pipeline
+
+Usage:
+    python ml_tools.py cache-weights
+    python ml_tools.py export --backend onnx-int8
+    python ml_tools.py parity --samples ./data/samples
+    python ml_tools.py reduction-report --shop-id 1 --dims 128 256
+    python ml_tools.py train-transform --method pca --dim 256
+    python ml_tools.py build-similar --shop-id 1
+    python ml_tools.py find-duplicates --shop-id 1 --threshold 0.97
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+from typing import List
+import faiss
+import numpy as np
+import torch
+from PIL import Image
+
+from config import settings
+from exact_vectors import ExactVectorStore
+from inference_backends import (
+    BACKENDS, TorchImageEncoder, create_image_encoder, export_artifact, get_artifact_path, get_weights_cache_path
+)
+from index_registry import ShopIndexRegistry
+from near_duplicates import DuplicateClusterStore, find_duplicate_clusters
+from ml_pipeline import load_clip_model
+from similar_products import SimilarProductsStore, build_table
+from vector_index import (
+    INDEX_TYPES, REDUCE_METHODS, STORAGE_MODES, ShopIndex, build_index, explained_variance,
+    global_transform_path, resolve_storage, train_projection
+)
+
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png", ".webp"}
+
+def _load_sample_batch(samples_dir: Path, preprocess, limit: int) -> torch.Tensor:
+    """Preprocess sample images into one batch"""
+    paths = sorted(p for p in samples_dir.iterdir() if p.suffix.lower() in IMAGE_SUFFIXES)[:limit]
+    if not paths:
+        raise SystemExit(f"No sample images found in {samples_dir}")
+    return torch.stack([preprocess(Image.open(p).convert('RGB')) for p in paths])
+
+def _normalize(features: np.ndarray) -> np.ndarray:
+    return features / np.linalg.norm(features, axis=1, keepdims=True)
+
+def cache_weights_command(args):
+    """Pre-serialize pretrained weights so servers start without resolving them"""
+    load_clip_model(torch.device("cpu"))
+    print(get_weights_cache_path())
+
+def export_command(args):
+    """Export encoder artifacts next to FAISS_DIR"""
+    device = torch.device("cpu")
+    model, _ = load_clip_model(device)
+
+    backends: List[str] = args.backend or [b for b in BACKENDS if b != "torch"]
+    for backend in backends:
+        path = export_artifact(model, backend, model.visual.image_size)
+        print(f"{backend}: {path} ({path.stat().st_size / (1024 * 1024):.1f} MB)")
+
+def parity_command(args):
+    """Report cosine drift of each backend's embeddings against the eager model"""
+    device = torch.device("cpu")
+    model, preprocess = load_clip_model(device)
+    batch = _load_sample_batch(Path(args.samples), preprocess, args.limit)
+
+    reference = _normalize(TorchImageEncoder(model).encode(batch))
+
+    backends: List[str] = args.backend or list(BACKENDS)
+    print(f"{'backend':<12} {'mean_cos':>9} {'min_cos':>9} {'max_drift':>10} {'ms/image':>9}")
+
+    for backend in backends:
+        if backend != "torch" and not get_artifact_path(backend).exists():
+            print(f"{backend:<12} missing artifact, run export first")
+            continue
+
+        encoder = create_image_encoder(backend, model, device)
+        encoder.encode(batch[:1])  # warm-up
+
+        start_time = time.perf_counter()
+        embeddings = _normalize(encoder.encode(batch))
+        ms_per_image = (time.perf_counter() - start_time) * 1000 / len(batch)
+
+        cosine = np.sum(embeddings * reference, axis=1)
+        print(
+            f"{backend:<12} {cosine.mean():>9.5f} {cosine.min():>9.5f} "
+            f"{1.0 - cosine.min():>10.5f} {ms_per_image:>9.1f}"
+        )
+
+def _shop_vectors(registry: ShopIndexRegistry, shop_id: int):
+    """(ids, full-precision vectors) of a shop's saved index"""
+    index = registry.get(shop_id)
+    if index is None:
+        raise SystemExit(f"No index found for shop {shop_id}")
+    return index.live_vectors()
+
+def _recall(labels: np.ndarray, truth: np.ndarray) -> float:
+    hits = sum(len(set(row) & set(truth_row)) for row, truth_row in zip(labels.tolist(), truth.tolist()))
+    return hits / truth.size
+
+def reduction_report_command(args):
+    """Explained variance and recall@k of reduced indices against the unreduced exact index"""
+    registry = ShopIndexRegistry(settings.FAISS_DIR, budget_bytes=sys.maxsize, read_only=True, use_mmap=False)
+    ids, vectors = _shop_vectors(registry, args.shop_id)
+    if len(ids) <= args.k:
+        raise SystemExit(f"Shop {args.shop_id} has only {len(ids)} vectors")
+
+    # Catalog vectors double as queries, as visually similar product lookups would
+    rng = np.random.default_rng(0)
+    queries = vectors[rng.choice(len(ids), min(args.queries, len(ids)), replace=False)]
+
+    exact = faiss.IndexFlatIP(vectors.shape[1])
+    exact.add(vectors)
+    _, truth_rows = exact.search(queries, args.k)
+    truth = ids[truth_rows]
+
+    print(
+        f"shop={args.shop_id} vectors={len(ids)} index_type={args.index_type} storage={args.storage} "
+        f"method={args.method} k={args.k}"
+    )
+    print(f"{'dim':>5} {'explained':>10} {'recall':>8} {'reranked':>9} {'bytes/vec':>10} {'ms/query':>9}")
+
+    for reduce_dim in [0] + args.dims:
+        transform = None
+        explained = 1.0
+        if reduce_dim:
+            transform = train_projection(vectors, reduce_dim, args.method, args.code_size)
+            explained = explained_variance(transform, vectors)
+
+        index = ShopIndex(build_index(
+            vectors.shape[1], args.index_type, ids, vectors, args.storage, args.code_size, transform
+        ))
+        index.rerank_factor = args.rerank_factor
+        lossy = reduce_dim or resolve_storage(args.index_type, args.storage) != "float32"
+        if lossy:
+            index.exact = ExactVectorStore.from_arrays(ids, vectors)
+
+        _, candidate_labels = index.ann_search(queries, args.k)
+        start_time = time.perf_counter()
+        _, labels = index.search(queries, args.k)
+        ms_per_query = (time.perf_counter() - start_time) * 1000 / len(queries)
+
+        print(
+            f"{reduce_dim or vectors.shape[1]:>5} {explained:>10.4f} {_recall(candidate_labels, truth):>8.4f} "
+            f"{_recall(labels, truth):>9.4f} {index.bytes_per_vector():>10} {ms_per_query:>9.3f}"
+        )
+
+def train_transform_command(args):
+    """Train a projection shared by all shops from a sample of their vectors"""
+    registry = ShopIndexRegistry(settings.FAISS_DIR, budget_bytes=0, read_only=True, use_mmap=False)
+    shop_ids = args.shop_id or registry.on_disk_shops()
+    per_shop = max(1, args.sample // max(1, len(shop_ids)))
+
+    rng = np.random.default_rng(0)
+    samples = []
+    for shop_id in shop_ids:
+        _, vectors = _shop_vectors(registry, shop_id)
+        if len(vectors) > per_shop:
+            vectors = vectors[rng.choice(len(vectors), per_shop, replace=False)]
+        samples.append(vectors)
+        registry.pop(shop_id)
+
+    vectors = np.concatenate(samples)
+    transform = train_projection(vectors, args.dim, args.method, args.code_size)
+
+    path = global_transform_path(args.method, args.dim)
+    faiss.write_VectorTransform(transform, str(path))
+    print(
+        f"{path}: {args.method} {vectors.shape[1]}->{args.dim} from {len(vectors)} vectors "
+        f"of {len(shop_ids)} shops, explained variance {explained_variance(transform, vectors):.4f}"
+    )
+
+def build_similar_command(args):
+    """Rebuild shops' similar-products tables from their saved indices"""
+    registry = ShopIndexRegistry(settings.FAISS_DIR, budget_bytes=0, read_only=True, use_mmap=False)
+    store = SimilarProductsStore(settings.FAISS_DIR)
+
+    for shop_id in args.shop_id or registry.on_disk_shops():
+        index = registry.get(shop_id)
+        if index is None:
+            print(f"shop {shop_id}: no index")
+            continue
+
+        start_time = time.perf_counter()
+        table = build_table(index, args.k, settings.SIMILAR_SEARCH_BATCH_SIZE)
+        store.save(shop_id, table)
+        registry.pop(shop_id)
+        print(
+            f"shop {shop_id}: {len(table)} products, k={args.k}, "
+            f"{table.nbytes / (1024 * 1024):.1f} MB in {time.perf_counter() - start_time:.1f}s"
+        )
+
+def find_duplicates_command(args):
+    """Cluster near-duplicate products of shops' saved indices"""
+    registry = ShopIndexRegistry(settings.FAISS_DIR, budget_bytes=0, read_only=True, use_mmap=False)
+    store = DuplicateClusterStore(settings.FAISS_DIR)
+
+    for shop_id in args.shop_id or registry.on_disk_shops():
+        index = registry.get(shop_id)
+        if index is None:
+            print(f"shop {shop_id}: no index")
+            continue
+
+        start_time = time.perf_counter()
+        clusters = find_duplicate_clusters(index, args.threshold, args.block_size)
+        if not args.dry_run:
+            store.save(shop_id, clusters)
+        registry.pop(shop_id)
+        print(
+            f"shop {shop_id}: {len(np.unique(clusters['cluster']))} clusters, {len(clusters)} of "
+            f"{index.live_count} products at threshold {args.threshold} in {time.perf_counter() - start_time:.1f}s"
+        )
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Visual search ML tools")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    cache_parser = subparsers.add_parser("cache-weights", help="Cache pretrained weights locally")
+    cache_parser.set_defaults(func=cache_weights_command)
+
+    export_parser = subparsers.add_parser("export", help="Export inference backend artifacts")
+    export_parser.add_argument("--backend", action="append", choices=[b for b in BACKENDS if b != "torch"])
+    export_parser.set_defaults(func=export_command)
+
+    parity_parser = subparsers.add_parser("parity", help="Compare backend embeddings with the eager model")
+    parity_parser.add_argument("--samples", required=True, help="Directory of sample images")
+    parity_parser.add_argument("--backend", action="append", choices=list(BACKENDS))
+    parity_parser.add_argument("--limit", type=int, default=64)
+    parity_parser.set_defaults(func=parity_command)
+
+    report_parser = subparsers.add_parser(
+        "reduction-report", help="Explained variance and recall of reduced dimensions for a shop"
+    )
+    report_parser.add_argument("--shop-id", type=int, required=True)
+    report_parser.add_argument("--dims", type=int, nargs="+", default=[128, 256])
+    report_parser.add_argument("--method", choices=REDUCE_METHODS, default="pca")
+    report_parser.add_argument("--index-type", choices=[t for t in INDEX_TYPES if t != "auto"], default="Flat")
+    report_parser.add_argument("--storage", choices=STORAGE_MODES, default="float32")
+    report_parser.add_argument("--code-size", type=int, default=None)
+    report_parser.add_argument("--rerank-factor", type=int, default=settings.FAISS_RERANK_FACTOR)
+    report_parser.add_argument("--queries", type=int, default=500)
+    report_parser.add_argument("--k", type=int, default=24)
+    report_parser.set_defaults(func=reduction_report_command)
+
+    transform_parser = subparsers.add_parser(
+        "train-transform", help="Train a global projection for FAISS_REDUCE_SCOPE=global"
+    )
+    transform_parser.add_argument("--method", choices=REDUCE_METHODS, default="pca")
+    transform_parser.add_argument("--dim", type=int, required=True)
+    transform_parser.add_argument("--shop-id", type=int, action="append", help="Defaults to every shop on disk")
+    transform_parser.add_argument("--sample", type=int, default=100000, help="Total vectors to sample")
+    transform_parser.add_argument("--code-size", type=int, default=None)
+    transform_parser.set_defaults(func=train_transform_command)
+
+    similar_parser = subparsers.add_parser("build-similar", help="Rebuild similar-products tables")
+    similar_parser.add_argument("--shop-id", type=int, action="append", help="Defaults to every shop on disk")
+    similar_parser.add_argument("--k", type=int, default=settings.SIMILAR_PRODUCTS_K)
+    similar_parser.set_defaults(func=build_similar_command)
+
+    duplicates_parser = subparsers.add_parser("find-duplicates", help="Cluster near-duplicate products")
+    duplicates_parser.add_argument("--shop-id", type=int, action="append", help="Defaults to every shop on disk")
+    duplicates_parser.add_argument("--threshold", type=float, default=settings.DUPLICATE_THRESHOLD)
+    duplicates_parser.add_argument("--block-size", type=int, default=settings.DUPLICATE_BLOCK_SIZE)
+    duplicates_parser.add_argument("--dry-run", action="store_true", help="Report clusters without saving them")
+    duplicates_parser.set_defaults(func=find_duplicates_command)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,184 @@
+"""
+Near-duplicate product clusters from thresholded range search
+
+Each shop has one shop_{id}.duplicates.npy file listing the products that
+belong to a cluster of two or more, sorted by product ID, with the
+smallest product ID of the cluster as its label. Products missing from
+the file are unique.
+"""
+
+import os
+import threading
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+import numpy as np
+import structlog
+
+from atomic_files import atomic_replace
+
+if TYPE_CHECKING:
+    from vector_index import ShopIndex
+
+logger = structlog.get_logger()
+
+CLUSTER_DTYPE = np.dtype([("id", "<i8"), ("cluster", "<i8")])
+
+class UnionFind:
+    """Disjoint sets over product IDs, tracking only IDs that were joined"""
+
+    def __init__(self):
+        self.parent: Dict[int, int] = {}
+
+    def find(self, item: int) -> int:
+        root = item
+        while self.parent.get(root, root) != root:
+            root = self.parent[root]
+        # Path compression
+        while item != root:
+            self.parent[item], item = root, self.parent.get(item, item)
+        return root
+
+    def union(self, a: int, b: int):
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a == root_b:
+            return
+        # Smallest ID becomes the root, so it labels the cluster
+        if root_b < root_a:
+            root_a, root_b = root_b, root_a
+        self.parent[root_b] = root_a
+        self.parent.setdefault(root_a, root_a)
+
+    def clusters(self) -> np.ndarray:
+        table = np.zeros(len(self.parent), dtype=CLUSTER_DTYPE)
+        for row, item in enumerate(sorted(self.parent)):
+            table[row] = (item, self.find(item))
+        return table
+
+def find_duplicate_clusters(index: "ShopIndex", threshold: float, block_size: int) -> np.ndarray:
+    """Cluster products whose vectors are more similar than threshold
+
+    Live vectors are read and range-searched block by block, so peak
+    memory is one block of queries and its matches on top of the index.
+    """
+    union_find = UnionFind()
+    pairs = 0
+    n_products = 0
+    searcher = index
+
+    for ids, vectors in index.iter_live_vectors(block_size):
+        n_products += len(ids)
+        try:
+            matches = searcher.range_search(vectors, threshold)
+        except RuntimeError as e:
+            if searcher is not index:
+                raise
+            # Some index types (HNSW in older FAISS) lack range search
+            logger.warning(f"{index.index_type} range search failed ({str(e)}), using an exact index")
+            searcher = _exact_index(index, block_size)
+            matches = searcher.range_search(vectors, threshold)
+
+        for product_id, (labels, _) in zip(ids.tolist(), matches):
+            for label in labels.tolist():
+                if label != product_id:
+                    union_find.union(product_id, label)
+                    pairs += 1
+
+    table = union_find.clusters()
+    logger.info(
+        f"Found {len(np.unique(table['cluster']))} duplicate clusters covering {len(table)} "
+        f"of {n_products} products ({pairs} pairs above {threshold})"
+    )
+    return table
+
+def _exact_index(index: "ShopIndex", block_size: int) -> "ShopIndex":
+    """Temporary flat index over the live vectors, filled block by block"""
+    from vector_index import ShopIndex
+
+    exact = ShopIndex.create(index.dimension)
+    for ids, vectors in index.iter_live_vectors(block_size):
+        exact.upsert(ids, vectors)
+    return exact
+
+def collapse_results(
+    scores: np.ndarray,
+    labels: np.ndarray,
+    clusters: Optional[np.ndarray],
+    limit: int
+) -> List[Dict]:
+    """Best-scoring product per duplicate cluster, up to limit results"""
+    results: List[Dict] = []
+    positions: Dict[int, int] = {}
+
+    for score, label in zip(scores.tolist(), labels.tolist()):
+        if label < 0 or score <= 0:
+            continue
+        cluster = cluster_of(clusters, label)
+        if cluster in positions:
+            results[positions[cluster]]["duplicates"] += 1
+            continue
+        if len(results) == limit:
+            continue
+        positions[cluster] = len(results)
+        results.append({"product_id": str(label), "score": float(score), "duplicates": 0})
+
+    return results
+
+def cluster_of(clusters: Optional[np.ndarray], product_id: int) -> int:
+    """Cluster label of a product, its own ID when unique"""
+    if clusters is None or not len(clusters):
+        return product_id
+    row = int(np.searchsorted(clusters["id"], product_id))
+    if row < len(clusters) and clusters["id"][row] == product_id:
+        return int(clusters["cluster"][row])
+    return product_id
+
+def redundant_count(clusters: Optional[np.ndarray]) -> int:
+    """Products that collapsing can remove: members beyond one per cluster"""
+    if clusters is None or not len(clusters):
+        return 0
+    return len(clusters) - len(np.unique(clusters["cluster"]))
+
+class DuplicateClusterStore:
+    """Reads and writes per-shop cluster files, reloading files that changed"""
+
+    def __init__(self, faiss_dir: str):
+        self.faiss_dir = Path(faiss_dir)
+        self._clusters: Dict[int, Tuple[float, np.ndarray]] = {}
+        self._lock = threading.Lock()
+
+    def path(self, shop_id: int) -> Path:
+        return self.faiss_dir / f"shop_{shop_id}.duplicates.npy"
+
+    def get(self, shop_id: int) -> Optional[np.ndarray]:
+        """A shop's clusters, or None if the analysis has not run"""
+        path = self.path(shop_id)
+        try:
+            mtime = path.stat().st_mtime
+        except FileNotFoundError:
+            return None
+
+        with self._lock:
+            cached = self._clusters.get(shop_id)
+            if cached is not None and cached[0] == mtime:
+                return cached[1]
+
+        # Only duplicate members are stored, so the table is small
+        clusters = np.load(path)
+        with self._lock:
+            self._clusters[shop_id] = (mtime, clusters)
+        return clusters
+
+    def save(self, shop_id: int, clusters: np.ndarray):
+        path = self.path(shop_id)
+        tmp_path = path.with_name(f"{path.name}.tmp-{os.getpid()}")
+        with open(tmp_path, "wb") as f:
+            np.save(f, clusters)
+        atomic_replace(tmp_path, path)
+
+    def delete(self, shop_id: int):
+        with self._lock:
+            self._clusters.pop(shop_id, None)
+        try:
+            self.path(shop_id).unlink()
+        except FileNotFoundError:
+            pass
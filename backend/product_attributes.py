@@ -0,0 +1,162 @@
+"""
+Per-shop product attributes for filtered search
+
+Each shop has one shop_{id}.attributes.npz file with columns sorted by
+product ID: stock status, lowest variant price, and dictionary-encoded
+product type, vendor and tags (tags as offsets into one flat code array).
+Filters evaluate to the sorted array of matching product IDs, which the
+index turns into a FAISS ID selector.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+import numpy as np
+import structlog
+
+from atomic_files import atomic_replace
+
+logger = structlog.get_logger()
+
+class ProductFilter(NamedTuple):
+    """Search restrictions; None fields do not filter"""
+    in_stock: Optional[bool] = None
+    min_price: Optional[float] = None
+    max_price: Optional[float] = None
+    product_type: Optional[str] = None
+    vendor: Optional[str] = None
+    tag: Optional[str] = None
+
+    @property
+    def active(self) -> bool:
+        return any(value is not None for value in self)
+
+def normalize_attribute(value: str) -> str:
+    return " ".join(value.split()).casefold()
+
+def _encode(values: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """(codes, vocabulary) with -1 for empty values"""
+    vocabulary = sorted({value for value in values if value})
+    lookup = {value: code for code, value in enumerate(vocabulary)}
+    codes = np.array([lookup.get(value, -1) for value in values], dtype=np.int32)
+    return codes, np.array(vocabulary, dtype=str)
+
+def build_attribute_table(products: Iterable[Dict]) -> Dict[str, np.ndarray]:
+    """Columns for product data dicts as produced by ShopifyClient.extract_product_data"""
+    rows = sorted(products, key=lambda product: int(product["product_id"]))
+
+    tag_lists = [sorted({normalize_attribute(tag) for tag in product.get("tags", []) if tag.strip()}) for product in rows]
+    tag_codes, tags = _encode([tag for product_tags in tag_lists for tag in product_tags])
+    product_types, product_type_vocabulary = _encode(
+        [normalize_attribute(product.get("product_type") or "") for product in rows]
+    )
+    vendors, vendor_vocabulary = _encode([normalize_attribute(product.get("vendor") or "") for product in rows])
+
+    return {
+        "ids": np.array([int(product["product_id"]) for product in rows], dtype=np.int64),
+        "in_stock": np.array([bool(product.get("in_stock", True)) for product in rows], dtype=bool),
+        "price": np.array(
+            [np.nan if product.get("price") is None else product["price"] for product in rows], dtype=np.float32
+        ),
+        "product_type": product_types,
+        "vendor": vendors,
+        "tag_offsets": np.concatenate([[0], np.cumsum([len(t) for t in tag_lists])]).astype(np.int64),
+        "tag_codes": tag_codes,
+        "product_types": product_type_vocabulary,
+        "vendors": vendor_vocabulary,
+        "tags": tags,
+    }
+
+def _code_of(vocabulary: np.ndarray, value: str) -> int:
+    """Vocabulary position of a value, or -1 if no product has it"""
+    value = normalize_attribute(value)
+    position = int(np.searchsorted(vocabulary, value))
+    if position < len(vocabulary) and vocabulary[position] == value:
+        return position
+    return -1
+
+def matching_ids(table: Dict[str, np.ndarray], product_filter: ProductFilter) -> np.ndarray:
+    """Sorted product IDs that satisfy every active field of the filter"""
+    mask = np.ones(len(table["ids"]), dtype=bool)
+
+    if product_filter.in_stock is not None:
+        mask &= table["in_stock"] == product_filter.in_stock
+    # Unknown (NaN) prices fail any price bound
+    if product_filter.min_price is not None:
+        mask &= table["price"] >= product_filter.min_price
+    if product_filter.max_price is not None:
+        mask &= table["price"] <= product_filter.max_price
+    if product_filter.product_type is not None:
+        mask &= table["product_type"] == _code_of(table["product_types"], product_filter.product_type)
+    if product_filter.vendor is not None:
+        mask &= table["vendor"] == _code_of(table["vendors"], product_filter.vendor)
+    if product_filter.tag is not None:
+        code = _code_of(table["tags"], product_filter.tag)
+        rows = np.repeat(np.arange(len(mask)), np.diff(table["tag_offsets"]))
+        tagged = np.zeros(len(mask), dtype=bool)
+        tagged[rows[table["tag_codes"] == code]] = True
+        mask &= tagged
+
+    return table["ids"][mask]
+
+class ProductAttributeStore:
+    """Reads and writes per-shop attribute tables, reloading files that changed"""
+
+    def __init__(self, faiss_dir: str, max_open_tables: int = 256):
+        self.faiss_dir = Path(faiss_dir)
+        self.max_open_tables = max_open_tables
+        self._tables: "OrderedDict[int, Tuple[float, Dict[str, np.ndarray]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def table_path(self, shop_id: int) -> Path:
+        return self.faiss_dir / f"shop_{shop_id}.attributes.npz"
+
+    def load(self, shop_id: int) -> Optional[Dict[str, np.ndarray]]:
+        path = self.table_path(shop_id)
+        try:
+            mtime = path.stat().st_mtime
+        except FileNotFoundError:
+            with self._lock:
+                self._tables.pop(shop_id, None)
+            return None
+
+        with self._lock:
+            cached = self._tables.get(shop_id)
+            if cached is not None and cached[0] == mtime:
+                self._tables.move_to_end(shop_id)
+                return cached[1]
+
+        with np.load(path) as archive:
+            table = {name: archive[name] for name in archive.files}
+        with self._lock:
+            self._tables[shop_id] = (mtime, table)
+            self._tables.move_to_end(shop_id)
+            while len(self._tables) > self.max_open_tables:
+                self._tables.popitem(last=False)
+        return table
+
+    def matching_ids(self, shop_id: int, product_filter: ProductFilter) -> Optional[np.ndarray]:
+        """Product IDs passing the filter, or None if the shop has no attributes yet"""
+        table = self.load(shop_id)
+        if table is None:
+            return None
+        return matching_ids(table, product_filter)
+
+    def save(self, shop_id: int, table: Dict[str, np.ndarray]):
+        path = self.table_path(shop_id)
+        tmp_path = path.with_name(f"{path.name}.tmp-{os.getpid()}")
+        # A file object keeps np.savez from appending another suffix
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **table)
+        atomic_replace(tmp_path, path)
+        logger.info(f"Saved attributes of {len(table['ids'])} products for shop {shop_id}")
+
+    def delete(self, shop_id: int):
+        with self._lock:
+            self._tables.pop(shop_id, None)
+        try:
+            self.table_path(shop_id).unlink()
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,42 @@
+"""
+Fusion of per-crop search results into one ranking per query image
+"""
+
+from typing import Dict, List
+import numpy as np
+
+FUSION_METHODS = ("max", "rrf")
+
+def fuse_rankings(
+    scores: np.ndarray,
+    labels: np.ndarray,
+    method: str = "max",
+    limit: int = 24,
+    rrf_k: int = 60
+) -> List[Dict]:
+    """Merge (crops x k) search results into the top products
+
+    max ranks a product by its best similarity over crops; rrf sums
+    1 / (rrf_k + rank) over the crops that retrieved it, favouring products
+    several crops agree on. Each hit reports its best similarity as score.
+    """
+    if method not in FUSION_METHODS:
+        raise ValueError(f"Unknown fusion method: {method}")
+
+    best: Dict[int, float] = {}
+    fused: Dict[int, float] = {}
+
+    for crop_scores, crop_labels in zip(scores, labels):
+        rank = 0
+        for score, label in zip(crop_scores.tolist(), crop_labels.tolist()):
+            # Only positive similarities count, as for single-image search
+            if label < 0 or score <= 0:
+                continue
+            rank += 1
+            best[label] = max(best.get(label, score), score)
+            if method == "rrf":
+                fused[label] = fused.get(label, 0.0) + 1.0 / (rrf_k + rank)
+
+    ranking = fused if method == "rrf" else best
+    top = sorted(ranking, key=lambda label: ranking[label], reverse=True)[:limit]
+    return [{"product_id": str(label), "score": float(best[label])} for label in top]
@@ -4,22 +4,143 @@ Shopify API client for managing products and authentication
 
 import httpx
 import asyncio
-from typing import List, Dict, Optional
+import json
+import random
+import time
+from typing import AsyncIterator, List, Dict, NamedTuple, Optional
 import structlog
-from urllib.parse import urlencode
+from urllib.parse import urlencode, urlsplit
 
 from config import settings
+from shopify_rate_limit import REST_DRAIN_SECONDS, parse_call_limit, parse_retry_after, shop_bucket
 
 logger = structlog.get_logger()
 
+# Product fields used by indexing; the rest of the product JSON is never read
+PRODUCT_FIELDS = "id,title,handle,images,variants,product_type,vendor,tags"
+
+# Bulk export of the same fields; nested connections come back as child
+# lines that follow their product and point to it through __parentId
+BULK_PRODUCTS_QUERY = """
+{
+  products {
+    edges {
+      node {
+        id
+        title
+        handle
+        productType
+        vendor
+        tags
+        images {
+          edges {
+            node {
+              id
+              url
+            }
+          }
+        }
+        variants {
+          edges {
+            node {
+              id
+              price
+              inventoryQuantity
+              inventoryPolicy
+              inventoryItem {
+                tracked
+              }
+            }
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
+BULK_RUN_MUTATION = """
+mutation RunBulkQuery($query: String!) {
+  bulkOperationRunQuery(query: $query) {
+    bulkOperation { id status }
+    userErrors { field message }
+  }
+}
+"""
+
+BULK_STATUS_QUERY = """
+query BulkOperationStatus($id: ID!) {
+  node(id: $id) {
+    ... on BulkOperation { id status errorCode objectCount url }
+  }
+}
+"""
+
+# Responses worth retrying for image downloads
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+class ImageDownload(NamedTuple):
+    """Outcome of one image download; exactly one of data and error is set"""
+    url: str
+    data: Optional[bytes] = None
+    error: Optional[Exception] = None
+
+def _numeric_id(value) -> str:
+    """Numeric ID from a REST integer or a GraphQL gid://shopify/Type/123"""
+    return str(value).rsplit("/", 1)[-1]
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
 class ShopifyClient:
-    """Client for interacting with Shopify Admin API"""
+    """Client for interacting with Shopify Admin API
+    
+    Admin API calls and image downloads share one pooled HTTP client,
+    created on first use and released by aclose().
+    """
     
     def __init__(self, shop_domain: Optional[str] = None, access_token: Optional[str] = None):
         self.shop_domain = shop_domain
         self.access_token = access_token
-        self.base_url = f"https://{shop_domain}.myshopify.com" if shop_domain else None
+        self.base_url = (
+            settings.SHOPIFY_API_BASE_URL or f"https://{shop_domain}.myshopify.com"
+        ) if shop_domain else None
         self.api_version = "2023-10"
+        self._client: Optional[httpx.AsyncClient] = None
+        self._host_limits: Dict[str, asyncio.Semaphore] = {}
+    
+    def _http(self) -> httpx.AsyncClient:
+        """Long-lived client with keep-alive connections (HTTP/2 when h2 is installed)"""
+        if self._client is None:
+            http2 = settings.HTTP2 and _http2_available()
+            if settings.HTTP2 and not http2:
+                logger.warning("h2 is not installed, using HTTP/1.1 for Shopify requests")
+            self._client = httpx.AsyncClient(
+                http2=http2,
+                timeout=settings.HTTP_TIMEOUT_SECONDS,
+                limits=httpx.Limits(
+                    max_connections=settings.HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=settings.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=settings.HTTP_KEEPALIVE_EXPIRY_SECONDS
+                )
+            )
+        return self._client
+    
+    async def aclose(self):
+        """Close pooled connections"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+    
+    async def __aenter__(self) -> "ShopifyClient":
+        return self
+    
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
     
     async def exchange_code_for_token(self, shop_domain: str, code: str) -> str:
         """Exchange OAuth authorization code for access token"""
@@ -53,7 +174,56 @@ class ShopifyClient:
             "Content-Type": "application/json"
         }
     
-    async def get_products(self, limit: int = 250, page_info: Optional[str] = None) -> Dict:
+    async def _request(
+        self,
+        method: str,
+        url: str,
+        api: str = "rest",
+        cost: float = 1.0,
+        **kwargs
+    ) -> httpx.Response:
+        """Send an Admin API request through the shop's rate limit bucket
+        
+        Waits for room in the bucket first, updates it from the
+        call-limit header, and retries 429 responses after Retry-After.
+        """
+        bucket = shop_bucket(self.shop_domain, api)
+        headers = self._get_headers()
+        
+        for attempt in range(settings.SHOPIFY_API_RETRIES + 1):
+            delay = bucket.reserve(cost)
+            try:
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                response = await self._http().request(method, url, headers=headers, **kwargs)
+            except BaseException:
+                bucket.release(cost)
+                raise
+            
+            # GraphQL reports its budget in the response body instead, see _graphql
+            call_limit = None
+            if api == "rest":
+                call_limit = parse_call_limit(response.headers.get("x-shopify-shop-api-call-limit"))
+            if call_limit is not None:
+                used, capacity = call_limit
+                bucket.settle(cost, used, capacity, capacity / REST_DRAIN_SECONDS)
+            else:
+                bucket.settle(cost)
+            
+            if response.status_code == 429 and attempt < settings.SHOPIFY_API_RETRIES:
+                retry_after = bucket.throttle(parse_retry_after(response.headers.get("retry-after")))
+                logger.warning(f"Shopify throttled {bucket.name}, retrying in {retry_after:.1f}s")
+                continue
+            
+            response.raise_for_status()
+            return response
+    
+    async def get_products(
+        self,
+        limit: int = 250,
+        page_info: Optional[str] = None,
+        fields: Optional[str] = PRODUCT_FIELDS
+    ) -> Dict:
         """Get products from Shopify using pagination"""
         try:
             url = f"{self.base_url}/admin/api/{self.api_version}/products.json"
@@ -61,104 +231,326 @@ class ShopifyClient:
             params = {"limit": min(limit, 250)}  # Shopify max is 250
             if page_info:
                 params["page_info"] = page_info
+            if fields:
+                params["fields"] = fields
             
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.get(
-                    url,
-                    params=params,
-                    headers=self._get_headers()
-                )
-                response.raise_for_status()
-                
-                data = response.json()
-                
-                # Extract pagination info from Link header
-                next_page_info = None
-                link_header = response.headers.get("Link", "")
-                if "rel=\"next\"" in link_header:
-                    # Parse page_info from Link header
-                    next_link = [link for link in link_header.split(",") if "rel=\"next\"" in link][0]
-                    next_page_info = next_link.split("page_info=")[1].split("&")[0].split(">")[0]
-                
-                return {
-                    "products": data.get("products", []),
-                    "next_page_info": next_page_info
-                }
+            response = await self._request("GET", url, params=params)
+            
+            data = response.json()
+            
+            # Extract pagination info from Link header
+            next_page_info = None
+            link_header = response.headers.get("Link", "")
+            if "rel=\"next\"" in link_header:
+                # Parse page_info from Link header
+                next_link = [link for link in link_header.split(",") if "rel=\"next\"" in link][0]
+                next_page_info = next_link.split("page_info=")[1].split("&")[0].split(">")[0]
+            
+            return {
+                "products": data.get("products", []),
+                "next_page_info": next_page_info
+            }
                 
         except Exception as e:
             logger.error(f"Error fetching products: {str(e)}")
             raise
     
-    async def get_all_products(self) -> List[Dict]:
-        """Get all products from a shop using pagination"""
-        all_products = []
-        page_info = None
+    async def get_products_count(self) -> int:
+        """Number of products in the shop, without fetching them"""
+        try:
+            url = f"{self.base_url}/admin/api/{self.api_version}/products/count.json"
+            
+            response = await self._request("GET", url)
+            
+            return int(response.json()["count"])
+            
+        except Exception as e:
+            logger.error(f"Error fetching product count: {str(e)}")
+            raise
+    
+    async def iter_products(self, limit: int = 250) -> AsyncIterator[List[Dict]]:
+        """Yield pages of products as they arrive
+        
+        The next page is requested as soon as the current one arrives, so it
+        downloads while the caller works on the current page. At most two
+        pages are held at once, however large the catalog.
+        """
+        next_page: Optional[asyncio.Future] = asyncio.ensure_future(self.get_products(limit=limit))
+        fetched = 0
         
         try:
-            while True:
-                result = await self.get_products(page_info=page_info)
-                products = result["products"]
+            while next_page is not None:
+                result = await next_page
+                next_page = None
                 
+                products = result["products"]
                 if not products:
                     break
                 
-                all_products.extend(products)
-                page_info = result["next_page_info"]
-                
-                logger.info(f"Fetched {len(products)} products (total: {len(all_products)})")
+                if result["next_page_info"]:
+                    next_page = asyncio.ensure_future(
+                        self.get_products(limit=limit, page_info=result["next_page_info"])
+                    )
                 
-                if not page_info:
-                    break
-                
-                # Rate limiting - Shopify allows 2 requests per second
-                await asyncio.sleep(0.5)
-            
-            logger.info(f"Fetched total {len(all_products)} products from shop")
-            return all_products
+                fetched += len(products)
+                logger.info(f"Fetched {len(products)} products (total: {fetched})")
+                yield products
             
         except Exception as e:
-            logger.error(f"Error fetching all products: {str(e)}")
+            logger.error(f"Error fetching products: {str(e)}")
             raise
+        finally:
+            # The caller stopped early or failed
+            if next_page is not None:
+                next_page.cancel()
     
-    async def download_image(self, image_url: str) -> bytes:
-        """Download product image"""
-        try:
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.get(image_url)
-                response.raise_for_status()
+    async def _graphql(self, query: str, variables: Optional[Dict] = None, cost: float = 10.0) -> Dict:
+        """Run an Admin GraphQL query and return its data
+        
+        cost is the expected query cost, booked against the shop's GraphQL
+        bucket until the response reports the real cost and budget.
+        """
+        url = f"{self.base_url}/admin/api/{self.api_version}/graphql.json"
+        bucket = shop_bucket(self.shop_domain, "graphql")
+        
+        for attempt in range(settings.SHOPIFY_API_RETRIES + 1):
+            response = await self._request(
+                "POST",
+                url,
+                api="graphql",
+                cost=cost,
+                json={"query": query, "variables": variables or {}}
+            )
+            body = response.json()
+            
+            query_cost = (body.get("extensions") or {}).get("cost") or {}
+            throttle_status = query_cost.get("throttleStatus")
+            if throttle_status:
+                bucket.observe(
+                    throttle_status["maximumAvailable"] - throttle_status["currentlyAvailable"],
+                    throttle_status["maximumAvailable"],
+                    throttle_status["restoreRate"]
+                )
+            if query_cost.get("requestedQueryCost"):
+                cost = float(query_cost["requestedQueryCost"])
+            
+            errors = body.get("errors") or []
+            throttled = any((error.get("extensions") or {}).get("code") == "THROTTLED" for error in errors)
+            if throttled and attempt < settings.SHOPIFY_API_RETRIES:
+                # With a reported throttleStatus the next reservation already waits for enough budget
+                retry_after = bucket.throttle(0.0 if throttle_status else None)
+                logger.warning(f"Shopify throttled {bucket.name}, retrying in {retry_after:.1f}s")
+                continue
+            
+            if errors:
+                raise ValueError(f"GraphQL errors: {errors}")
+            return body["data"]
+    
+    async def run_bulk_products_query(self) -> Optional[str]:
+        """Start a bulk product export and wait for it; returns the JSONL URL
+        
+        The URL is None when the shop has no products.
+        """
+        data = await self._graphql(BULK_RUN_MUTATION, {"query": BULK_PRODUCTS_QUERY}, cost=10.0)
+        result = data["bulkOperationRunQuery"]
+        if result["userErrors"]:
+            raise ValueError(f"Bulk operation rejected: {result['userErrors']}")
+        
+        operation_id = result["bulkOperation"]["id"]
+        logger.info(f"Started bulk operation {operation_id}")
+        
+        deadline = time.monotonic() + settings.SHOPIFY_BULK_TIMEOUT_SECONDS
+        while True:
+            await asyncio.sleep(settings.SHOPIFY_BULK_POLL_INTERVAL_SECONDS)
+            operation = (await self._graphql(BULK_STATUS_QUERY, {"id": operation_id}, cost=1.0))["node"]
+            status = operation["status"]
+            
+            if status == "COMPLETED":
+                logger.info(f"Bulk operation {operation_id} exported {operation.get('objectCount')} objects")
+                return operation.get("url")
+            if status in ("FAILED", "CANCELED", "EXPIRED"):
+                raise ValueError(f"Bulk operation {operation_id} {status.lower()}: {operation.get('errorCode')}")
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Bulk operation {operation_id} still {status.lower()}")
+    
+    async def iter_bulk_products(self, page_size: int = 250) -> AsyncIterator[List[Dict]]:
+        """Yield pages of products from a bulk export, like iter_products
+        
+        The JSONL file is streamed line by line; only the product being
+        assembled and the current page are held in memory. Products come
+        out with their images and variants as lists, in the bulk shape
+        that extract_product_data accepts.
+        """
+        url = await self.run_bulk_products_query()
+        if not url:
+            return
+        
+        page: List[Dict] = []
+        product: Optional[Dict] = None
+        fetched = 0
+        
+        # Signed storage URL: no Shopify auth headers
+        async with self._http().stream("GET", url) as response:
+            response.raise_for_status()
+            
+            async for line in response.aiter_lines():
+                if not line.strip():
+                    continue
+                node = json.loads(line)
+                parent_id = node.pop("__parentId", None)
+                
+                if parent_id is None:
+                    if product is not None:
+                        page.append(product)
+                    product = {**node, "images": [], "variants": []}
+                    if len(page) >= page_size:
+                        fetched += len(page)
+                        logger.info(f"Streamed {len(page)} bulk products (total: {fetched})")
+                        yield page
+                        page = []
+                    continue
                 
-                # Validate content type
-                content_type = response.headers.get("content-type", "")
-                if not content_type.startswith("image/"):
-                    raise ValueError(f"Invalid content type: {content_type}")
+                if product is None or parent_id != product["id"]:
+                    # Children always follow their parent in bulk output
+                    logger.warning(f"Skipping bulk line for unexpected parent {parent_id}")
+                    continue
                 
-                return response.content
+                if "url" in node:
+                    product["images"].append(node)
+                else:
+                    product["variants"].append(node)
+        
+        if product is not None:
+            page.append(product)
+        if page:
+            fetched += len(page)
+            logger.info(f"Streamed {len(page)} bulk products (total: {fetched})")
+            yield page
+    
+    async def get_all_products(self) -> List[Dict]:
+        """Get all products from a shop using pagination"""
+        all_products = []
+        async for products in self.iter_products():
+            all_products.extend(products)
+        
+        logger.info(f"Fetched total {len(all_products)} products from shop")
+        return all_products
+    
+    def _host_limit(self, url: str) -> asyncio.Semaphore:
+        """Caps concurrent downloads from one host"""
+        host = urlsplit(url).netloc
+        if host not in self._host_limits:
+            self._host_limits[host] = asyncio.Semaphore(settings.IMAGE_DOWNLOAD_PER_HOST)
+        return self._host_limits[host]
+    
+    async def download_image(self, image_url: str) -> bytes:
+        """Download product image, retrying transient failures with jittered backoff"""
+        try:
+            for attempt in range(settings.IMAGE_DOWNLOAD_RETRIES + 1):
+                try:
+                    async with self._host_limit(image_url):
+                        return await self._fetch_image(image_url)
+                except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                    retryable = (
+                        isinstance(e, httpx.TransportError)
+                        or e.response.status_code in RETRY_STATUS_CODES
+                    )
+                    if not retryable or attempt == settings.IMAGE_DOWNLOAD_RETRIES:
+                        raise
+                    await asyncio.sleep(self._retry_delay(e, attempt))
                 
         except Exception as e:
             logger.error(f"Error downloading image {image_url}: {str(e)}")
             raise
     
+    async def _fetch_image(self, image_url: str) -> bytes:
+        """One download attempt, streamed so oversized images are cut off early"""
+        max_bytes = int(settings.IMAGE_DOWNLOAD_MAX_MB * 1024 * 1024)
+        
+        async with self._http().stream("GET", image_url) as response:
+            response.raise_for_status()
+            
+            # Validate content type
+            content_type = response.headers.get("content-type", "")
+            if not content_type.startswith("image/"):
+                raise ValueError(f"Invalid content type: {content_type}")
+            
+            content_length = response.headers.get("content-length")
+            if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+                raise ValueError(f"Image too large: {content_length} bytes")
+            
+            chunks = []
+            size = 0
+            async for chunk in response.aiter_bytes():
+                size += len(chunk)
+                if size > max_bytes:
+                    raise ValueError(f"Image too large: over {max_bytes} bytes")
+                chunks.append(chunk)
+            return b"".join(chunks)
+    
+    @staticmethod
+    def _retry_delay(error: Exception, attempt: int) -> float:
+        """Retry-After when the server sent one, else full-jitter exponential backoff"""
+        if isinstance(error, httpx.HTTPStatusError):
+            retry_after = error.response.headers.get("retry-after", "")
+            try:
+                return min(float(retry_after), 60.0)
+            except ValueError:
+                pass
+        return random.uniform(0, settings.IMAGE_DOWNLOAD_BACKOFF_SECONDS * 2 ** attempt)
+    
+    async def download_images(self, image_urls: List[str]) -> AsyncIterator[ImageDownload]:
+        """Download images concurrently, yielding each result as it finishes
+        
+        At most IMAGE_DOWNLOAD_CONCURRENCY downloads are in flight, and at
+        most IMAGE_DOWNLOAD_PER_HOST against one host. Failures are yielded
+        as results rather than raised, so one bad image does not stop the rest.
+        """
+        async def download(url: str) -> ImageDownload:
+            try:
+                return ImageDownload(url, data=await self.download_image(url))
+            except Exception as e:
+                return ImageDownload(url, error=e)
+        
+        pending = set()
+        urls = iter(image_urls)
+        try:
+            while True:
+                # Top up the window instead of creating a task per URL up front
+                for url in urls:
+                    pending.add(asyncio.ensure_future(download(url)))
+                    if len(pending) >= settings.IMAGE_DOWNLOAD_CONCURRENCY:
+                        break
+                if not pending:
+                    return
+                
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+        finally:
+            # The consumer stopped early
+            for task in pending:
+                task.cancel()
+    
     async def get_shop_info(self) -> Dict:
         """Get shop information"""
         try:
             url = f"{self.base_url}/admin/api/{self.api_version}/shop.json"
             
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.get(url, headers=self._get_headers())
-                response.raise_for_status()
-                
-                return response.json()["shop"]
+            response = await self._request("GET", url)
+            
+            return response.json()["shop"]
                 
         except Exception as e:
             logger.error(f"Error fetching shop info: {str(e)}")
             raise
     
     def extract_product_data(self, product: Dict) -> List[Dict]:
-        """Extract relevant data from Shopify product"""
+        """Extract relevant data from a REST or bulk-export Shopify product"""
         product_data = []
         
         try:
-            product_id = str(product["id"])
+            product_id = _numeric_id(product["id"])
             title = product.get("title", "")
             handle = product.get("handle", "")
             
@@ -169,16 +561,18 @@ class ShopifyClient:
                 # Skip products without images
                 return product_data
             
-            # Use first image for Phase 0
+            # Use first image for Phase 0 (REST "src", GraphQL "url")
             image = images[0]
-            image_url = image.get("src", "")
+            image_url = image.get("src") or image.get("url") or ""
             
             if image_url:
                 product_data.append({
                     "product_id": product_id,
                     "title": title,
                     "handle": handle,
-                    "image_url": image_url
+                    "image_url": image_url,
+                    "image_updated_at": image.get("updated_at", ""),
+                    **self._extract_filter_attributes(product)
                 })
             
         except Exception as e:
@@ -186,6 +580,46 @@ class ShopifyClient:
         
         return product_data
     
+    @staticmethod
+    def _extract_filter_attributes(product: Dict) -> Dict:
+        """Stock, lowest price, type, vendor and tags used by filtered search"""
+        variants = product.get("variants") or []
+        
+        prices = []
+        for variant in variants:
+            try:
+                prices.append(float(variant.get("price")))
+            except (TypeError, ValueError):
+                continue
+        
+        in_stock = any(ShopifyClient._variant_available(variant) for variant in variants) if variants else True
+        
+        tags = product.get("tags") or []
+        if isinstance(tags, str):
+            tags = tags.split(",")
+        
+        return {
+            "in_stock": in_stock,
+            "price": min(prices) if prices else None,
+            "product_type": product.get("product_type") or product.get("productType") or "",
+            "vendor": product.get("vendor") or "",
+            "tags": [tag.strip() for tag in tags if tag.strip()]
+        }
+    
+    @staticmethod
+    def _variant_available(variant: Dict) -> bool:
+        """Untracked inventory and overselling count as available"""
+        if "inventoryPolicy" in variant or "inventoryItem" in variant:
+            # GraphQL bulk shape
+            tracked = (variant.get("inventoryItem") or {}).get("tracked", True)
+            policy = (variant.get("inventoryPolicy") or "").lower()
+            quantity = variant.get("inventoryQuantity") or 0
+        else:
+            tracked = bool(variant.get("inventory_management"))
+            policy = variant.get("inventory_policy") or ""
+            quantity = variant.get("inventory_quantity") or 0
+        return not tracked or policy == "continue" or quantity > 0
+    
     async def validate_shop_access(self) -> bool:
         """Validate that we have valid access to the shop"""
         try:
@@ -0,0 +1,154 @@
+"""
+Per-shop leaky-bucket limits for the Shopify Admin API
+
+Shopify meters REST calls and GraphQL query cost in per-shop buckets that
+drain at a fixed rate. Each bucket here mirrors one of them: it starts from
+the documented standard-plan size and rate, then follows what responses
+report (X-Shopify-Shop-Api-Call-Limit, GraphQL throttleStatus), so Plus
+shops run at their larger limits. Buckets are shared by every client and
+indexing job in the process; jobs run their own event loops in separate
+threads, hence a thread lock rather than an asyncio one.
+"""
+
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from config import settings
+
+# Shopify buckets drain completely in this many seconds (40/2 per second, 400/20 on Plus)
+REST_DRAIN_SECONDS = 20.0
+
+def parse_call_limit(header: str) -> Optional[Tuple[int, int]]:
+    """(used, capacity) from an X-Shopify-Shop-Api-Call-Limit value like "32/40" """
+    try:
+        used, capacity = header.split("/")
+        return int(used), int(capacity)
+    except (AttributeError, ValueError):
+        return None
+
+def parse_retry_after(header: Optional[str]) -> Optional[float]:
+    try:
+        return max(0.0, float(header))
+    except (TypeError, ValueError):
+        return None
+
+class LeakyBucket:
+    """Client-side estimate of one Shopify bucket
+
+    reserve() books a request's cost and returns how long to wait before
+    sending it, so concurrent callers are spaced out instead of all firing
+    at once. settle() replaces the estimate with the level the server
+    reported once the response arrives.
+    """
+
+    def __init__(self, name: str, capacity: float, leak_rate: float):
+        self.name = name
+        self.capacity = float(capacity)
+        self.leak_rate = float(leak_rate)
+        self.level = 0.0  # as last reported by Shopify, drained since
+        self.pending = 0.0  # booked by requests the server has not counted yet
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+        self.throttled = 0
+        self._lock = threading.Lock()
+
+    def _leak(self, now: float):
+        self.level = max(0.0, self.level - (now - self.updated_at) * self.leak_rate)
+        self.updated_at = now
+
+    def _limit(self) -> float:
+        return self.capacity * (1.0 - settings.SHOPIFY_RATE_LIMIT_HEADROOM)
+
+    def reserve(self, cost: float = 1.0) -> float:
+        """Book a request; returns the seconds to wait before sending it"""
+        with self._lock:
+            now = time.monotonic()
+            self._leak(now)
+            excess = self.level + self.pending + cost - self._limit()
+            self.pending += cost
+            return max(excess / self.leak_rate if excess > 0 else 0.0, self.blocked_until - now)
+
+    def release(self, cost: float = 1.0):
+        """Drop a booking whose request was never answered"""
+        with self._lock:
+            self.pending = max(0.0, self.pending - cost)
+
+    def settle(
+        self,
+        cost: float,
+        level: Optional[float] = None,
+        capacity: Optional[float] = None,
+        leak_rate: Optional[float] = None
+    ):
+        """Account for an answered request, adopting the server's numbers when given"""
+        with self._lock:
+            self._leak(time.monotonic())
+            self.pending = max(0.0, self.pending - cost)
+            if capacity:
+                self.capacity = float(capacity)
+            if leak_rate:
+                self.leak_rate = float(leak_rate)
+            # The server's level already includes this request
+            self.level = float(level) if level is not None else self.level + cost
+
+    def observe(self, level: float, capacity: float, leak_rate: float):
+        """Adopt a bucket state reported outside of a request's own response"""
+        self.settle(0.0, level, capacity, leak_rate)
+
+    def throttle(self, retry_after: Optional[float] = None) -> float:
+        """Record a throttled response; returns how long to wait before retrying
+
+        Without a Retry-After the bucket is assumed full and the wait is
+        how long it takes to drain below the limit.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._leak(now)
+            self.throttled += 1
+            if retry_after is None:
+                self.level = max(self.level, self.capacity)
+                retry_after = (self.level - self._limit()) / self.leak_rate
+            self.blocked_until = max(self.blocked_until, now + retry_after)
+            return retry_after
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            self._leak(time.monotonic())
+            return {
+                "level": round(self.level, 1),
+                "pending": self.pending,
+                "capacity": self.capacity,
+                "leak_rate": self.leak_rate,
+                "throttled": self.throttled
+            }
+
+_buckets: Dict[Tuple[str, str], LeakyBucket] = {}
+_buckets_lock = threading.Lock()
+
+def shop_bucket(shop_domain: str, api: str) -> LeakyBucket:
+    """The process-wide bucket of a shop's "rest" or "graphql" API"""
+    key = (shop_domain, api)
+    with _buckets_lock:
+        bucket = _buckets.get(key)
+        if bucket is None:
+            if api == "graphql":
+                bucket = LeakyBucket(
+                    f"{shop_domain}/graphql",
+                    settings.SHOPIFY_GRAPHQL_BUCKET_SIZE,
+                    settings.SHOPIFY_GRAPHQL_RESTORE_RATE
+                )
+            else:
+                bucket = LeakyBucket(
+                    f"{shop_domain}/rest",
+                    settings.SHOPIFY_REST_BUCKET_SIZE,
+                    settings.SHOPIFY_REST_BUCKET_SIZE / REST_DRAIN_SECONDS
+                )
+            _buckets[key] = bucket
+        return bucket
+
+def get_stats() -> Dict[str, Dict]:
+    """Bucket levels and throttled-response counts by bucket, for /health"""
+    with _buckets_lock:
+        buckets = list(_buckets.values())
+    return {bucket.name: bucket.get_stats() for bucket in buckets}
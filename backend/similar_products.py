@@ -0,0 +1,234 @@
+"""
+Precomputed "visually similar" neighbor tables for product pages
+
+Each shop has one shop_{id}.similar.npy file: a structured array sorted by
+product ID with the top-K neighbor IDs and float16 scores per product.
+Serving memory-maps it and binary-searches the ID column, so a lookup
+touches a handful of pages and needs neither the model nor FAISS.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Tuple
+import numpy as np
+import structlog
+
+from atomic_files import atomic_replace
+
+if TYPE_CHECKING:
+    # Serving only reads tables, without importing FAISS
+    from vector_index import ShopIndex
+
+logger = structlog.get_logger()
+
+def table_dtype(k: int) -> np.dtype:
+    return np.dtype([("id", "<i8"), ("neighbors", "<i8", (k,)), ("scores", "<f2", (k,))])
+
+def _sorted_live_vectors(index: "ShopIndex") -> Tuple[np.ndarray, np.ndarray]:
+    ids, vectors = index.live_vectors()
+    order = np.argsort(ids)
+    return ids[order], np.ascontiguousarray(vectors[order], dtype=np.float32)
+
+def _top_k(labels: np.ndarray, scores: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Top k of candidate lists by score, padding with -1"""
+    scores = np.where(labels < 0, -np.inf, scores)
+    order = np.argsort(-scores, axis=1, kind="stable")[:, :k]
+    labels = np.take_along_axis(labels, order, axis=1)
+    scores = np.take_along_axis(scores, order, axis=1)
+    if labels.shape[1] < k:
+        pad = k - labels.shape[1]
+        labels = np.pad(labels, ((0, 0), (0, pad)), constant_values=-1)
+        scores = np.pad(scores, ((0, 0), (0, pad)), constant_values=-np.inf)
+    return labels, scores
+
+def _search_rows(
+    index: "ShopIndex",
+    row_ids: np.ndarray,
+    row_vectors: np.ndarray,
+    k: int,
+    batch_size: int
+) -> np.ndarray:
+    """Neighbor rows for products, searching the index in query blocks"""
+    table = np.zeros(len(row_ids), dtype=table_dtype(k))
+    table["id"] = row_ids
+
+    for start in range(0, len(row_ids), batch_size):
+        end = start + batch_size
+        # One extra neighbor because each product finds itself
+        scores, labels = index.search(row_vectors[start:end], k + 1)
+        labels = np.where(labels == row_ids[start:end, None], -1, labels)
+        labels, scores = _top_k(labels, scores, k)
+        table["neighbors"][start:end] = labels
+        table["scores"][start:end] = scores
+
+    return table
+
+def build_table(index: "ShopIndex", k: int, batch_size: int) -> np.ndarray:
+    """Neighbor table for every live product of a shop"""
+    ids, vectors = _sorted_live_vectors(index)
+    return _search_rows(index, ids, vectors, k, batch_size)
+
+def refresh_table(
+    table: Optional[np.ndarray],
+    index: "ShopIndex",
+    changed_ids: Iterable[int],
+    removed_ids: Iterable[int],
+    k: int,
+    batch_size: int,
+    full_rebuild_ratio: float
+) -> np.ndarray:
+    """Update a neighbor table after products were added, changed or removed
+
+    Rows of changed products, and rows that listed a changed or removed
+    product, are searched again. Every other row only needs the changed
+    products scored against it, which is an exact dot product.
+    """
+    ids, vectors = _sorted_live_vectors(index)
+    changed = np.intersect1d(np.fromiter((int(i) for i in changed_ids), dtype=np.int64), ids)
+    removed = np.fromiter((int(i) for i in removed_ids), dtype=np.int64)
+
+    if (
+        table is None
+        or table.dtype != table_dtype(k)
+        or len(changed) + len(removed) > full_rebuild_ratio * max(len(ids), 1)
+    ):
+        return _search_rows(index, ids, vectors, k, batch_size)
+
+    dirty = np.union1d(changed, removed)
+    table = np.array(table)
+    table = table[np.isin(table["id"], ids) & ~np.isin(table["id"], changed)]
+
+    touched = np.isin(table["neighbors"], dirty).any(axis=1)
+    recompute_ids = np.union1d(
+        np.union1d(changed, table["id"][touched]),
+        np.setdiff1d(ids, table["id"])
+    )
+    table = table[~touched]
+
+    if len(changed) and len(table):
+        changed_vectors = vectors[np.searchsorted(ids, changed)]
+        row_vectors = vectors[np.searchsorted(ids, table["id"])]
+        for start in range(0, len(table), batch_size):
+            end = start + batch_size
+            rows = table[start:end]
+            similarities = row_vectors[start:end] @ changed_vectors.T
+            labels, scores = _top_k(
+                np.concatenate([rows["neighbors"], np.broadcast_to(changed, similarities.shape)], axis=1),
+                np.concatenate([rows["scores"].astype(np.float32), similarities], axis=1),
+                k
+            )
+            table["neighbors"][start:end] = labels
+            table["scores"][start:end] = scores
+
+    if len(recompute_ids):
+        recomputed = _search_rows(index, recompute_ids, vectors[np.searchsorted(ids, recompute_ids)], k, batch_size)
+        table = np.concatenate([table, recomputed])
+        table = table[np.argsort(table["id"], kind="stable")]
+
+    return table
+
+class SimilarProductsStore:
+    """Reads and writes per-shop neighbor tables, reopening files that changed"""
+
+    def __init__(self, faiss_dir: str, max_open_tables: int = 256):
+        self.faiss_dir = Path(faiss_dir)
+        self.max_open_tables = max_open_tables
+        self._tables: "OrderedDict[int, Tuple[float, np.ndarray]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Counters for monitoring
+        self.hits = 0
+        self.misses = 0
+
+    def table_path(self, shop_id: int) -> Path:
+        return self.faiss_dir / f"shop_{shop_id}.similar.npy"
+
+    def _open(self, shop_id: int) -> Optional[np.ndarray]:
+        """Memory-mapped table, reopened when the file was replaced"""
+        path = self.table_path(shop_id)
+        try:
+            mtime = path.stat().st_mtime
+        except FileNotFoundError:
+            with self._lock:
+                self._tables.pop(shop_id, None)
+            return None
+
+        with self._lock:
+            cached = self._tables.get(shop_id)
+            if cached is not None and cached[0] == mtime:
+                self._tables.move_to_end(shop_id)
+                return cached[1]
+
+        table = np.load(path, mmap_mode="r")
+        with self._lock:
+            self._tables[shop_id] = (mtime, table)
+            self._tables.move_to_end(shop_id)
+            while len(self._tables) > self.max_open_tables:
+                self._tables.popitem(last=False)
+        return table
+
+    def get(self, shop_id: int, product_id: int, limit: int) -> Optional[List[Dict]]:
+        """Neighbors of a product, or None if it has no row"""
+        table = self._open(shop_id)
+        if table is None or not len(table):
+            self.misses += 1
+            return None
+
+        row = int(np.searchsorted(table["id"], product_id))
+        if row >= len(table) or table["id"][row] != product_id:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        entry = table[row]
+        return [
+            {"product_id": str(label), "score": float(score)}
+            for label, score in zip(entry["neighbors"].tolist(), entry["scores"].tolist())
+            if label >= 0
+        ][:limit]
+
+    def load(self, shop_id: int) -> Optional[np.ndarray]:
+        """Table read fully into memory, for refreshing"""
+        path = self.table_path(shop_id)
+        return np.load(path) if path.exists() else None
+
+    def save(self, shop_id: int, table: np.ndarray):
+        """Write a table atomically so readers never map a partial file"""
+        path = self.table_path(shop_id)
+        tmp_path = path.with_name(f"{path.name}.tmp-{os.getpid()}")
+        with open(tmp_path, "wb") as f:
+            np.save(f, table)
+        atomic_replace(tmp_path, path)
+
+    def refresh(
+        self,
+        shop_id: int,
+        index: "ShopIndex",
+        changed_ids: Iterable[int],
+        removed_ids: Iterable[int],
+        k: int,
+        batch_size: int,
+        full_rebuild_ratio: float
+    ) -> int:
+        """Update and save a shop's table, returning its row count"""
+        table = refresh_table(
+            self.load(shop_id), index, changed_ids, removed_ids, k, batch_size, full_rebuild_ratio
+        )
+        self.save(shop_id, table)
+        logger.info(f"Saved similar products table for shop {shop_id}: {len(table)} products, k={k}")
+        return len(table)
+
+    def delete(self, shop_id: int):
+        with self._lock:
+            self._tables.pop(shop_id, None)
+        try:
+            self.table_path(shop_id).unlink()
+        except FileNotFoundError:
+            pass
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            open_tables = len(self._tables)
+        return {"open_tables": open_tables, "hits": self.hits, "misses": self.misses}
@@ -4,20 +4,36 @@ Background tasks for product indexing and processing
 
 import asyncio
 from datetime import datetime
-from typing import List, Dict
+from typing import List, Dict, Set
+import numpy as np
 import structlog
 from sqlalchemy.orm import Session
 
+from config import settings
 from database import SessionLocal
 from models import Shop, Product, IndexJob
-from shopify_client import ShopifyClient
+from shopify_client import ImageDownload, ShopifyClient
 from ml_pipeline import MLPipeline
+from embedding_cache import content_hash
+from embedding_store import ProductEmbeddingStore
+from similar_products import SimilarProductsStore
+from product_attributes import ProductAttributeStore, build_attribute_table
+from ingest_pipeline import IngestItem, IngestPipeline, SourceStage, Stage
 
 logger = structlog.get_logger()
 
 # Initialize ML pipeline for background tasks
 ml_pipeline = MLPipeline()
 
+# Embeddings reused across indexing runs
+embedding_store = ProductEmbeddingStore()
+
+# Precomputed "visually similar" tables served by /similar
+similar_store = SimilarProductsStore(settings.FAISS_DIR)
+
+# Stock, price, type, vendor and tags for filtered search
+attribute_store = ProductAttributeStore(settings.FAISS_DIR)
+
 async def ensure_ml_pipeline():
     """Ensure ML pipeline is initialized"""
     if not ml_pipeline.is_ready():
@@ -30,6 +46,7 @@ def index_products_task(shop_id: int, job_id: int):
 async def _index_products_async(shop_id: int, job_id: int):
     """Async implementation of product indexing"""
     db = SessionLocal()
+    shopify_client = None
     
     try:
         # Ensure ML pipeline is ready
@@ -57,36 +74,35 @@ async def _index_products_async(shop_id: int, job_id: int):
         if not await shopify_client.validate_shop_access():
             raise Exception("Invalid shop access token")
         
-        # Fetch all products
-        shopify_products = await shopify_client.get_all_products()
+        index = ml_pipeline.get_index(shop.id)
+        indexed_before = {str(i) for i in index.product_ids()} if index is not None else set()
         
-        # Update job total
-        job.total = len(shopify_products)
+        # Cheap count call, so progress has a total before the first page arrives
+        try:
+            job.total = await shopify_client.get_products_count()
+        except Exception:
+            # Falls back to the running count of fetched products
+            job.total = 0
+        job.processed = 0
         db.commit()
         
-        if not shopify_products:
+        # Stream the catalog through fetch -> download -> decode -> embed -> index
+        ingest = _ShopIngest(db, shop, job, shopify_client, indexed_before)
+        await ingest.run()
+        processed_count = job.processed
+        seen_product_ids = ingest.seen_product_ids
+        changed_product_ids = ingest.changed_product_ids
+        product_attributes = ingest.product_attributes
+        
+        if not ingest.fetched_products:
             job.status = "done"
             job.finished_at = datetime.utcnow()
             db.commit()
             logger.info(f"No products found for shop {shop.shop_domain}")
             return
         
-        # Process products in batches
-        batch_size = 10
-        processed_count = 0
-        
-        for i in range(0, len(shopify_products), batch_size):
-            batch = shopify_products[i:i + batch_size]
-            await _process_product_batch(db, shop, batch, shopify_client)
-            
-            processed_count += len(batch)
-            job.processed = processed_count
-            db.commit()
-            
-            logger.info(f"Processed {processed_count}/{len(shopify_products)} products for shop {shop.shop_domain}")
-            
-            # Rate limiting
-            await asyncio.sleep(1)
+        # Drop products that are no longer in the catalog
+        stale_product_ids = _remove_stale_products(db, shop, seen_product_ids)
         
         # Complete job
         job.status = "done"
@@ -96,7 +112,21 @@ async def _index_products_async(shop_id: int, job_id: int):
         # Save FAISS index
         ml_pipeline.save_index(shop.id)
         
-        logger.info(f"Completed indexing {processed_count} products for shop {shop.shop_domain}")
+        # Replace the filter attributes with the fresh catalog snapshot
+        attribute_store.save(shop.id, build_attribute_table(product_attributes.values()))
+        
+        # Refresh neighbors of new, re-embedded and removed products
+        if settings.SIMILAR_PRODUCTS_ENABLED:
+            changed_product_ids |= seen_product_ids - indexed_before
+            await _refresh_similar_products(shop, changed_product_ids, stale_product_ids)
+        
+        if settings.DUPLICATE_DETECTION_AFTER_INDEXING:
+            await _refresh_duplicate_clusters(shop)
+        
+        logger.info(
+            f"Completed indexing {processed_count} products for shop {shop.shop_domain}",
+            embedding_store=embedding_store.get_stats()
+        )
         
     except Exception as e:
         logger.error(f"Indexing error for shop {shop_id}: {str(e)}")
@@ -108,84 +138,282 @@ async def _index_products_async(shop_id: int, job_id: int):
         db.commit()
         
     finally:
+        if shopify_client is not None:
+            await shopify_client.aclose()
         db.close()
 
-async def _process_product_batch(
-    db: Session, 
-    shop: Shop, 
-    products: List[Dict], 
-    shopify_client: ShopifyClient
-):
-    """Process a batch of products"""
-    try:
-        for shopify_product in products:
-            await _process_single_product(db, shop, shopify_product, shopify_client)
+class _ShopIngest:
+    """Stage handlers and shared state of one shop's indexing run
+    
+    Images the embedding store already knows skip straight from download
+    to index; failed items also go to index so their product rows are
+    still recorded. Products already indexed with the same image keep
+    their vectors untouched, since replacing a vector in HNSW and IVFPQ
+    indexes leaves a tombstone behind.
+    """
+    
+    def __init__(
+        self,
+        db: Session,
+        shop: Shop,
+        job: IndexJob,
+        shopify_client: ShopifyClient,
+        indexed_product_ids: Set[str]
+    ):
+        self.db = db
+        self.shop = shop
+        self.job = job
+        self.shopify_client = shopify_client
+        self.indexed_product_ids = indexed_product_ids
+        
+        self.fetched_products = 0
+        self.seen_product_ids: Set[str] = set()
+        self.changed_product_ids: Set[str] = set()
+        self.product_attributes: Dict[str, Dict] = {}
+        
+        queue_size = settings.INGEST_QUEUE_SIZE
+        self.fetch = SourceStage("fetch", self._fetch)
+        # Each worker downloads up to IMAGE_DOWNLOAD_CONCURRENCY queued images at once
+        self.download = Stage(
+            "download",
+            self._download,
+            settings.INGEST_DOWNLOAD_WORKERS,
+            queue_size,
+            batch_size=settings.IMAGE_DOWNLOAD_CONCURRENCY
+        )
+        self.decode = Stage("decode", self._decode, settings.INGEST_DECODE_WORKERS, queue_size)
+        # Preprocessed images are large, so only a couple of batches wait for the model
+        self.embed = Stage(
+            "embed",
+            self._embed,
+            settings.INGEST_EMBED_WORKERS,
+            queue_size=2 * settings.EMBEDDING_BATCH_SIZE,
+            batch_size=settings.EMBEDDING_BATCH_SIZE
+        )
+        self.index = Stage("index", self._index, 1, queue_size, batch_size=settings.INGEST_INDEX_BATCH_SIZE)
+        self.pipeline = IngestPipeline(
+            shop.id, job.id, [self.fetch, self.download, self.decode, self.embed, self.index]
+        )
+    
+    async def run(self):
+        await self.pipeline.run()
+    
+    def _use_bulk(self) -> bool:
+        mode = settings.SHOPIFY_INGEST_MODE
+        if mode == "auto":
+            return self.job.total >= settings.SHOPIFY_BULK_MIN_PRODUCTS
+        return mode == "bulk"
+    
+    async def _fetch(self):
+        """Stream catalog pages, queueing each product image as soon as its page arrives"""
+        if self._use_bulk():
+            logger.info(f"Using bulk export for shop {self.shop.shop_domain}")
+            pages = self.shopify_client.iter_bulk_products()
+        else:
+            pages = self.shopify_client.iter_products()
+        
+        async for products in pages:
+            for shopify_product in products:
+                product_data_list = self.shopify_client.extract_product_data(shopify_product)
+                if not product_data_list:
+                    # Products without images are done as soon as they are seen
+                    self.job.processed += 1
+                
+                for product_data in product_data_list:
+                    product_id = product_data["product_id"]
+                    self.seen_product_ids.add(product_id)
+                    self.product_attributes[product_id] = product_data
+                    await self.download.inbox.put(IngestItem(product_data))
             
-    except Exception as e:
-        logger.error(f"Batch processing error: {str(e)}")
-        raise
-
-async def _process_single_product(
-    db: Session,
-    shop: Shop,
-    shopify_product: Dict,
-    shopify_client: ShopifyClient
-):
-    """Process a single product"""
-    try:
-        # Extract product data
-        product_data_list = shopify_client.extract_product_data(shopify_product)
+            self.fetched_products += len(products)
+            self.fetch.stats.processed += len(products)
+            # The count can drift from what is listed while the catalog changes
+            self.job.total = max(self.job.total, self.fetched_products)
+    
+    async def _download(self, items: List[IngestItem]):
+        """Reuse stored embeddings, else download the batch's images concurrently"""
+        pending: Dict[str, List[IngestItem]] = {}
+        for item in items:
+            image_url = item.product_data["image_url"]
+            updated_at = item.product_data.get("image_updated_at", "")
+            
+            # Same image URL and version as a previous run
+            embedding = embedding_store.lookup_reference(image_url, updated_at)
+            if embedding is not None:
+                item.embedding = embedding
+                item.reused = True
+                await self.index.inbox.put(item)
+                continue
+            
+            pending.setdefault(image_url, []).append(item)
         
-        for product_data in product_data_list:
-            product_id = product_data["product_id"]
+        # Each image moves on as soon as its own download finishes
+        async for download in self.shopify_client.download_images(list(pending)):
+            for item in pending[download.url]:
+                await self._downloaded(item, download)
+    
+    async def _downloaded(self, item: IngestItem, download: ImageDownload):
+        if download.error is not None:
+            item.error = str(download.error)
+            await self.index.inbox.put(item)
+            return
+        
+        # Same bytes already embedded, e.g. a photo shared by several products
+        item.content_hash = content_hash(download.data)
+        embedding = embedding_store.lookup_content(item.content_hash)
+        if embedding is not None:
+            embedding_store.store(
+                download.url, item.product_data.get("image_updated_at", ""), item.content_hash, embedding
+            )
+            item.embedding = embedding
+            await self.index.inbox.put(item)
+            return
+        
+        item.image_data = download.data
+        await self.decode.inbox.put(item)
+    
+    async def _decode(self, items: List[IngestItem]):
+        for item in items:
+            try:
+                item.image = await ml_pipeline.preprocess_product_image(item.image_data)
+            except ValueError as e:
+                item.error = str(e)
+            item.image_data = None
             
-            # Check if product already exists
-            existing_product = db.query(Product).filter(
-                Product.shop_id == shop.id,
-                Product.product_id == product_id
-            ).first()
+            await (self.index if item.error else self.embed).inbox.put(item)
+    
+    async def _embed(self, items: List[IngestItem]):
+        """One forward pass per batch"""
+        try:
+            embeddings = await ml_pipeline.embed_product_images([item.image for item in items])
+        except Exception as e:
+            embeddings = None
+            for item in items:
+                item.error = str(e)
+        
+        for row, item in enumerate(items):
+            item.image = None
+            if embeddings is not None:
+                item.embedding = embeddings[row]
+                embedding_store.store(
+                    item.product_data["image_url"],
+                    item.product_data.get("image_updated_at", ""),
+                    item.content_hash,
+                    item.embedding
+                )
+            await self.index.inbox.put(item)
+    
+    async def _index(self, items: List[IngestItem]):
+        """Upsert product rows and vectors with one query, one FAISS call and one commit per batch"""
+        product_ids = [item.product_id for item in items]
+        existing_products = {
+            product.product_id: product
+            for product in self.db.query(Product).filter(
+                Product.shop_id == self.shop.id,
+                Product.product_id.in_(product_ids)
+            )
+        }
+        
+        now = datetime.utcnow()
+        unchanged: Set[str] = set()
+        for item in items:
+            product_data = item.product_data
+            product = existing_products.get(item.product_id)
+            if (
+                item.reused
+                and product is not None
+                and product.image_url == product_data["image_url"]
+                and item.product_id in self.indexed_product_ids
+            ):
+                # Indexed last run from the same image version
+                unchanged.add(item.product_id)
             
-            if existing_product:
+            if product:
                 # Update existing product
-                existing_product.title = product_data["title"]
-                existing_product.handle = product_data["handle"]
-                existing_product.image_url = product_data["image_url"]
-                existing_product.indexed_at = datetime.utcnow()
-                product = existing_product
+                product.title = product_data["title"]
+                product.handle = product_data["handle"]
+                product.image_url = product_data["image_url"]
+                product.indexed_at = now
             else:
                 # Create new product
-                product = Product(
-                    shop_id=shop.id,
-                    product_id=product_id,
+                self.db.add(Product(
+                    shop_id=self.shop.id,
+                    product_id=item.product_id,
                     title=product_data["title"],
                     handle=product_data["handle"],
                     image_url=product_data["image_url"],
-                    indexed_at=datetime.utcnow()
-                )
-                db.add(product)
-            
-            db.commit()
-            
-            # Download and process image
-            if product_data["image_url"]:
-                try:
-                    image_data = await shopify_client.download_image(product_data["image_url"])
-                    
-                    # Generate embedding
-                    embedding = await ml_pipeline.process_product_image(image_data)
-                    
-                    # Add to FAISS index
-                    ml_pipeline.add_product_embedding(shop.id, product_id, embedding)
-                    
-                    logger.debug(f"Processed product {product_id}: {product_data['title']}")
-                    
-                except Exception as e:
-                    logger.error(f"Error processing image for product {product_id}: {str(e)}")
-                    continue
+                    indexed_at=now
+                ))
             
+            if item.error:
+                logger.error(f"Error processing image for product {item.product_id}: {item.error}")
+        
+        embedded = [
+            item for item in items
+            if item.embedding is not None and item.product_id not in unchanged
+        ]
+        if embedded:
+            ml_pipeline.upsert_embeddings(
+                self.shop.id,
+                [item.product_id for item in embedded],
+                np.stack([item.embedding for item in embedded])
+            )
+            self.changed_product_ids.update(item.product_id for item in embedded)
+        
+        self.job.processed += len(items)
+        self.db.commit()
+        
+        logger.info(f"Processed {self.job.processed}/{self.job.total} products for shop {self.shop.shop_domain}")
+
+def _remove_stale_products(db: Session, shop: Shop, seen_product_ids: Set[str]) -> List[str]:
+    """Delete products missing from the latest catalog from the index and database"""
+    index = ml_pipeline.get_index(shop.id)
+    indexed_ids = {str(i) for i in index.product_ids()} if index is not None else set()
+    stale_ids = list(indexed_ids - seen_product_ids)
+    
+    if not stale_ids:
+        return stale_ids
+    
+    ml_pipeline.remove_products(shop.id, stale_ids)
+    db.query(Product).filter(
+        Product.shop_id == shop.id,
+        Product.product_id.in_(stale_ids)
+    ).delete(synchronize_session=False)
+    db.commit()
+    
+    logger.info(f"Removed {len(stale_ids)} stale products for shop {shop.shop_domain}")
+    return stale_ids
+
+async def _refresh_similar_products(shop: Shop, changed_product_ids: Set[str], removed_product_ids: List[str]):
+    """Update the shop's similar-products table off the event loop"""
+    index = ml_pipeline.get_index(shop.id)
+    if index is None:
+        return
+    
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(
+            None,
+            similar_store.refresh,
+            shop.id,
+            index,
+            [int(i) for i in changed_product_ids],
+            [int(i) for i in removed_product_ids],
+            settings.SIMILAR_PRODUCTS_K,
+            settings.SIMILAR_SEARCH_BATCH_SIZE,
+            settings.SIMILAR_FULL_REBUILD_RATIO
+        )
+    except Exception as e:
+        # The index is saved already; a stale table only affects recommendations
+        logger.error(f"Similar products refresh failed for shop {shop.shop_domain}: {str(e)}")
+
+async def _refresh_duplicate_clusters(shop: Shop):
+    """Recompute the shop's near-duplicate clusters"""
+    try:
+        await ml_pipeline.find_duplicates(shop.id)
     except Exception as e:
-        logger.error(f"Error processing product: {str(e)}")
-        raise
+        # Stale clusters only affect how search results are collapsed
+        logger.error(f"Duplicate detection failed for shop {shop.shop_domain}: {str(e)}")
 
 # Celery task wrapper (if using Celery)
 try:
@@ -0,0 +1,15 @@
+"""
+Shared test setup: required settings get placeholder values so modules
+that import config can load without a .env file
+"""
+
+import os
+
+for name, value in {
+    "SHOPIFY_API_KEY": "test-key",
+    "SHOPIFY_API_SECRET": "test-secret",
+    "APP_URL": "http://localhost:8000",
+    "DATABASE_URL": "sqlite://",
+    "SECRET_KEY": "test-secret-key",
+}.items():
+    os.environ.setdefault(name, value)
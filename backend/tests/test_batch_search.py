@@ -0,0 +1,86 @@
+"""
+Batch visual search applies the same filters and duplicate collapsing as
+single-image search
+"""
+
+import numpy as np
+import pytest
+
+pytest.importorskip("faiss")
+pytest.importorskip("open_clip")
+
+from config import settings
+from near_duplicates import CLUSTER_DTYPE
+from product_attributes import ProductFilter, build_attribute_table
+
+SHOP_ID = 1
+N_PRODUCTS = 200
+
+def _vectors(n: int, dimension: int) -> np.ndarray:
+    vectors = np.random.default_rng(0).standard_normal((n, dimension)).astype(np.float32)
+    # Product 2 is a near copy of product 0
+    vectors[2] = vectors[0] + 0.01 * vectors[2]
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+@pytest.fixture
+def pipeline(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "FAISS_DIR", str(tmp_path / "faiss"))
+    monkeypatch.setattr(settings, "TMP_DIR", str(tmp_path / "tmp"))
+    monkeypatch.setattr(settings, "QUERY_CACHE_BACKEND", "none")
+
+    from ml_pipeline import MLPipeline
+
+    pipeline = MLPipeline()
+    # Embeddings come from the stubs below, so no model is loaded
+    pipeline.ready, pipeline.model, pipeline.encoder = True, object(), object()
+
+    vectors = _vectors(N_PRODUCTS, settings.EMBEDDING_DIMENSION)
+    product_ids = [str(1000 + row) for row in range(N_PRODUCTS)]
+    pipeline.upsert_embeddings(SHOP_ID, product_ids, vectors)
+    pipeline.attributes.save(SHOP_ID, build_attribute_table(
+        {"product_id": product_id, "product_type": "shirt" if row % 2 == 0 else "shoe"}
+        for row, product_id in enumerate(product_ids)
+    ))
+    pipeline.duplicates.save(SHOP_ID, np.array([(1000, 1000), (1002, 1000)], dtype=CLUSTER_DTYPE))
+
+    queries = {str(row).encode(): vectors[row] for row in range(4)}
+
+    async def embed_query(image_data):
+        return queries[image_data]
+
+    async def embed_queries(image_data_list):
+        return np.stack([queries[image_data] for image_data in image_data_list]), list(range(len(image_data_list)))
+
+    monkeypatch.setattr(pipeline, "embed_query", embed_query)
+    monkeypatch.setattr(pipeline, "embed_queries", embed_queries)
+    yield pipeline, list(queries)
+    pipeline.executors.shutdown()
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("collapse", [False, True])
+@pytest.mark.parametrize("product_type", [None, "shirt"])
+async def test_batch_matches_single_search(pipeline, collapse, product_type):
+    pipeline, images = pipeline
+    product_filter = ProductFilter(product_type=product_type)
+    limit = 10
+
+    batch_results = await pipeline.search_similar_products_batch(
+        SHOP_ID, images, limit, collapse=collapse, product_filter=product_filter
+    )
+    single_results = [
+        await pipeline.search_similar_products(
+            SHOP_ID, image_data, limit, collapse=collapse, product_filter=product_filter
+        )
+        for image_data in images
+    ]
+
+    assert batch_results == single_results
+    assert all(len(results) == limit for results in batch_results)
+
+    returned = {int(r["product_id"]) for results in batch_results for r in results}
+    if product_type == "shirt":
+        assert all(product_id % 2 == 0 for product_id in returned)
+    if collapse:
+        # Product 1002 folds into 1000, which reports it as a duplicate
+        assert 1002 not in returned
+        assert batch_results[0][0] == {"product_id": "1000", "score": pytest.approx(1.0), "duplicates": 1}
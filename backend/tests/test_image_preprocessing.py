@@ -0,0 +1,182 @@
+"""
+FastPreprocessor parity with the torchvision eval transform open_clip uses
+
+Tolerances, in normalized input units (one 8-bit level is ~0.015):
+- lossless inputs that skip draft decoding must match to float rounding
+- JPEGs decoded at reduced scale must keep cosine >= 0.99 with the
+  reference tensor and a mean absolute difference <= 0.08
+
+What search sees is the embedding, so the same images are also encoded
+with the CLIP model: fast-path embeddings must stay within
+EMBEDDING_TOLERANCE (1 - cosine) of the reference ones. That test is
+skipped when open_clip or the pretrained weights are unavailable.
+"""
+
+import io
+import numpy as np
+import pytest
+from PIL import Image, ImageOps
+
+from image_preprocessing import FULL_IMAGE, FastPreprocessor, decode_scale, query_regions
+
+torch = pytest.importorskip("torch")
+transforms = pytest.importorskip("torchvision.transforms")
+
+IMAGE_SIZE = 224
+
+# open_clip OPENAI_DATASET_MEAN / OPENAI_DATASET_STD
+MEAN = (0.48145466, 0.4578275, 0.40821073)
+STD = (0.26862954, 0.26130258, 0.27577711)
+
+EXIF_ORIENTATION = 0x0112
+
+EMBEDDING_TOLERANCE = 0.02
+
+def _reference_transform():
+    return transforms.Compose([
+        transforms.Resize(IMAGE_SIZE, interpolation=transforms.InterpolationMode.BICUBIC),
+        transforms.CenterCrop(IMAGE_SIZE),
+        transforms.ToTensor(),
+        transforms.Normalize(MEAN, STD),
+    ])
+
+def _synthetic_image(width: int, height: int, mode: str = "RGB") -> Image.Image:
+    """Smooth gradients with a few solid shapes, so crops and orientation matter"""
+    x = np.linspace(0.0, 1.0, width, dtype=np.float32)[None, :]
+    y = np.linspace(0.0, 1.0, height, dtype=np.float32)[:, None]
+    pixels = np.stack([
+        255 * x * np.ones_like(y),
+        255 * y * np.ones_like(x),
+        255 * (0.5 + 0.5 * np.sin(6.0 * x + 3.0 * y)),
+    ], axis=-1)
+    pixels[: height // 3, : width // 4] = (230, 40, 40)
+    pixels[height // 2:, width // 2: width // 2 + max(1, width // 6)] = (20, 20, 200)
+    image = Image.fromarray(pixels.astype(np.uint8), "RGB")
+
+    if mode == "RGBA":
+        alpha = (255 * np.clip(x * 2.0, 0.0, 1.0) * np.ones_like(y)).astype(np.uint8)
+        image.putalpha(Image.fromarray(alpha, "L"))
+    elif mode != "RGB":
+        image = image.convert(mode)
+    return image
+
+def _encode(image: Image.Image, format: str, orientation: int = 1) -> bytes:
+    buffer = io.BytesIO()
+    if format == "JPEG":
+        exif = Image.Exif()
+        if orientation != 1:
+            exif[EXIF_ORIENTATION] = orientation
+        image.save(buffer, format="JPEG", quality=95, exif=exif.tobytes())
+    else:
+        image.save(buffer, format=format)
+    return buffer.getvalue()
+
+def _reference(image_data: bytes) -> np.ndarray:
+    image = ImageOps.exif_transpose(Image.open(io.BytesIO(image_data))).convert("RGB")
+    return _reference_transform()(image).numpy()
+
+def _fast(image_data: bytes) -> np.ndarray:
+    return FastPreprocessor(IMAGE_SIZE, MEAN, STD)([image_data])[0]
+
+def _cosine(a: np.ndarray, b: np.ndarray) -> float:
+    a, b = a.ravel().astype(np.float64), b.ravel().astype(np.float64)
+    return float(a @ b / (np.linalg.norm(a) * np.linalg.norm(b)))
+
+@pytest.mark.parametrize("width, height, mode", [
+    (640, 480, "RGB"),
+    (300, 500, "RGBA"),
+    (225, 1000, "RGB"),
+    (223, 223, "RGB"),
+    (97, 31, "L"),
+])
+def test_lossless_images_match_reference(width, height, mode):
+    image_data = _encode(_synthetic_image(width, height, mode), "PNG")
+
+    fast = _fast(image_data)
+    reference = _reference(image_data)
+
+    assert fast.shape == reference.shape == (3, IMAGE_SIZE, IMAGE_SIZE)
+    assert np.abs(fast - reference).max() < 1e-4
+
+@pytest.mark.parametrize("width, height, mode", [
+    (1200, 800, "RGB"),
+    (800, 1200, "RGB"),
+    (1999, 1001, "RGB"),
+    (300, 300, "RGB"),
+    (1024, 768, "L"),
+])
+def test_draft_decoded_jpegs_stay_within_tolerance(width, height, mode):
+    image_data = _encode(_synthetic_image(width, height, mode), "JPEG")
+
+    fast = _fast(image_data)
+    reference = _reference(image_data)
+
+    assert fast.shape == reference.shape == (3, IMAGE_SIZE, IMAGE_SIZE)
+    assert _cosine(fast, reference) >= 0.99
+    assert np.abs(fast - reference).mean() <= 0.08
+
+@pytest.mark.parametrize("orientation", [3, 6, 8])
+def test_exif_orientation_is_applied(orientation):
+    # Portrait content stored landscape, as phone cameras write it
+    image_data = _encode(_synthetic_image(1000, 600), "JPEG", orientation)
+
+    fast = _fast(image_data)
+    reference = _reference(image_data)
+    unrotated = _reference_transform()(Image.open(io.BytesIO(image_data)).convert("RGB")).numpy()
+
+    assert _cosine(fast, reference) >= 0.99
+    assert np.abs(fast - reference).mean() <= 0.08
+    # Ignoring the tag would give a visibly different crop
+    assert np.abs(fast - unrotated).mean() > 0.08
+
+def test_region_subsets_decode_at_the_full_set_scale():
+    image_data = _encode(_synthetic_image(1200, 800), "JPEG")
+    preprocessor = FastPreprocessor(IMAGE_SIZE, MEAN, STD)
+    regions = query_regions("grid", grid_size=2)
+    scale = decode_scale(regions)
+
+    crops = preprocessor.load_and_crop_regions(image_data, regions)
+    # Cache misses are re-cropped on their own, and must match the full set
+    subset = preprocessor.load_and_crop_regions(image_data, regions[:2], scale)
+    np.testing.assert_array_equal(subset, crops[:2])
+
+    # The whole image of a grid query is decoded at a larger draft scale than a plain query
+    assert regions[0] == FULL_IMAGE and scale > 1.0
+    assert not np.array_equal(crops[0], preprocessor.load_and_crop(image_data))
+
+@pytest.fixture(scope="module")
+def clip_model():
+    pytest.importorskip("open_clip")
+    from ml_pipeline import load_clip_model
+
+    try:
+        return load_clip_model(torch.device("cpu"))
+    except Exception as e:
+        pytest.skip(f"CLIP weights unavailable: {e}")
+
+def test_fast_embeddings_stay_within_tolerance(clip_model):
+    from inference_backends import TorchImageEncoder
+    from ml_pipeline import get_preprocess_config
+
+    model, preprocess = clip_model
+    images = [
+        _encode(_synthetic_image(1200, 800), "JPEG"),
+        _encode(_synthetic_image(800, 1200), "JPEG"),
+        _encode(_synthetic_image(1999, 1001), "JPEG"),
+        _encode(_synthetic_image(1000, 600), "JPEG", orientation=6),
+        _encode(_synthetic_image(300, 500, "RGBA"), "PNG"),
+        _encode(_synthetic_image(97, 31, "L"), "PNG"),
+    ]
+
+    fast_batch = torch.from_numpy(FastPreprocessor(*get_preprocess_config(model))(images))
+    reference_batch = torch.stack([
+        preprocess(ImageOps.exif_transpose(Image.open(io.BytesIO(image_data))).convert("RGB"))
+        for image_data in images
+    ])
+
+    encoder = TorchImageEncoder(model)
+    fast, reference = encoder.encode(fast_batch), encoder.encode(reference_batch)
+    cosine = np.sum(fast * reference, axis=1) / (
+        np.linalg.norm(fast, axis=1) * np.linalg.norm(reference, axis=1)
+    )
+    assert (1.0 - cosine).max() <= EMBEDDING_TOLERANCE
@@ -0,0 +1,104 @@
+"""
+ShopifyClient catalog reads against the fake_shopify.py stand-in
+
+The fake runs on an ephemeral port; REST pages follow its Link headers and
+bulk exports poll its operation status until COMPLETED.
+"""
+
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+import pytest_asyncio
+
+from config import settings
+from fake_shopify import FIRST_PRODUCT_ID, FakeCatalog, FakeShopifyHandler
+from shopify_client import ShopifyClient
+
+N_PRODUCTS = 23
+NO_IMAGE_EVERY = 5
+BULK_POLLS = 2
+
+@pytest.fixture
+def catalog(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeShopifyHandler)
+    server.verbose = False
+    origin = f"http://127.0.0.1:{server.server_address[1]}"
+    catalog = FakeCatalog(origin, N_PRODUCTS, NO_IMAGE_EVERY)
+    monkeypatch.setattr(FakeShopifyHandler, "catalog", catalog, raising=False)
+    monkeypatch.setattr(FakeShopifyHandler, "bulk_polls", BULK_POLLS, raising=False)
+
+    monkeypatch.setattr(settings, "SHOPIFY_API_BASE_URL", origin)
+    monkeypatch.setattr(settings, "SHOPIFY_BULK_POLL_INTERVAL_SECONDS", 0.01)
+    monkeypatch.setattr(settings, "HTTP2", False)
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield catalog
+    server.shutdown()
+    server.server_close()
+
+@pytest_asyncio.fixture
+async def client(catalog):
+    client = ShopifyClient("fake-shop", "test-token")
+    yield client
+    await client.aclose()
+
+def _has_image(position: int) -> bool:
+    return position % NO_IMAGE_EVERY != NO_IMAGE_EVERY - 1
+
+@pytest.mark.asyncio
+async def test_iter_products_follows_link_pagination(client):
+    pages = [page async for page in client.iter_products(limit=10)]
+
+    assert [len(page) for page in pages] == [10, 10, 3]
+    ids = [product["id"] for page in pages for product in page]
+    assert ids == list(range(FIRST_PRODUCT_ID, FIRST_PRODUCT_ID + N_PRODUCTS))
+
+@pytest.mark.asyncio
+async def test_iter_bulk_products_groups_children_under_parents(client):
+    pages = [page async for page in client.iter_bulk_products(page_size=10)]
+
+    # Polled RUNNING BULK_POLLS times, then COMPLETED once
+    assert FakeShopifyHandler._polls == BULK_POLLS + 1
+    assert [len(page) for page in pages] == [10, 10, 3]
+
+    products = [product for page in pages for product in page]
+    for position, product in enumerate(products):
+        product_id = FIRST_PRODUCT_ID + position
+        assert product["id"] == f"gid://shopify/Product/{product_id}"
+        assert len(product["images"]) == int(_has_image(position))
+        assert len(product["variants"]) == 1
+        for child in product["images"] + product["variants"]:
+            assert "__parentId" not in child
+        if product["images"]:
+            assert product["images"][0]["url"].endswith(f"/images/{product_id}.jpg")
+
+@pytest.mark.asyncio
+async def test_extract_product_data_agrees_across_shapes(client):
+    rest = [product async for page in client.iter_products(limit=10) for product in page]
+    bulk = [product async for page in client.iter_bulk_products(page_size=10) for product in page]
+    assert len(rest) == len(bulk) == N_PRODUCTS
+
+    for position, (rest_product, bulk_product) in enumerate(zip(rest, bulk)):
+        rest_data = client.extract_product_data(rest_product)
+        bulk_data = client.extract_product_data(bulk_product)
+        if not _has_image(position):
+            assert rest_data == bulk_data == []
+            continue
+
+        (rest_data,), (bulk_data,) = rest_data, bulk_data
+        # Bulk exports carry no image updated_at
+        assert rest_data.pop("image_updated_at") and bulk_data.pop("image_updated_at") == ""
+        assert rest_data == bulk_data
+        assert rest_data == {
+            "product_id": str(FIRST_PRODUCT_ID + position),
+            "title": f"Product {position}",
+            "handle": f"product-{position}",
+            "image_url": f"{client.base_url}/images/{FIRST_PRODUCT_ID + position}.jpg",
+            "in_stock": position % 4 > 0,
+            "price": float(10 + position % 90),
+            "product_type": ["Shirts", "Shoes", "Bags"][position % 3],
+            "vendor": f"Vendor {position % 7}",
+            "tags": ["fake", f"batch-{position % 10}"],
+        }
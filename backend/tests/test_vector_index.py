@@ -0,0 +1,190 @@
+"""
+ShopIndex builds and searches every index type and storage mode against
+the pinned FAISS version
+"""
+
+import numpy as np
+import pytest
+
+pytest.importorskip("faiss")
+
+from config import settings
+from near_duplicates import find_duplicate_clusters
+from vector_index import ShopIndex
+
+DIMENSION = 64
+N_VECTORS = 2000
+
+def _vectors(n: int, seed: int = 0) -> np.ndarray:
+    vectors = np.random.default_rng(seed).standard_normal((n, DIMENSION)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def _product_ids(n: int) -> np.ndarray:
+    # Sparse, large IDs like Shopify's
+    return 7_000_000_000 + np.arange(n, dtype=np.int64) * 13
+
+def _shop_index(index_type: str, storage: str = "float32", n: int = N_VECTORS):
+    ids, vectors = _product_ids(n), _vectors(n)
+    index = ShopIndex.create(DIMENSION)
+    index.upsert(ids, vectors)
+    index.optimize(index_type, storage)
+    return index, ids, vectors
+
+@pytest.mark.parametrize("index_type", ["Flat", "HNSW", "IVFPQ"])
+def test_index_types_build_and_search(index_type):
+    index, ids, vectors = _shop_index(index_type)
+
+    assert index.index_type == index_type
+    assert index.live_count == N_VECTORS
+
+    scores, labels = index.search(vectors[:20], 10)
+    assert labels.shape == (20, 10)
+    assert (labels >= 0).all()
+    np.testing.assert_array_equal(labels[:, 0], ids[:20])
+    assert (np.diff(scores, axis=1) <= 1e-6).all()
+
+@pytest.mark.parametrize("index_type", ["HNSW", "IVFPQ"])
+def test_search_knobs_apply(index_type):
+    index, ids, vectors = _shop_index(index_type)
+
+    # Each vector sits in the list of its own nearest centroid, so even one probe finds it
+    index.nprobe, index.ef_search = 1, 16
+    _, labels = index.search(vectors[:5], 10)
+    np.testing.assert_array_equal(labels[:, 0], ids[:5])
+
+    index.nprobe, index.ef_search = 64, 256
+    _, labels = index.search(vectors[:5], 10)
+    np.testing.assert_array_equal(labels[:, 0], ids[:5])
+
+@pytest.mark.parametrize("index_type", ["Flat", "HNSW"])
+@pytest.mark.parametrize("storage", ["fp16", "sq8", "pq"])
+def test_compressed_storage_searches(index_type, storage):
+    index, ids, vectors = _shop_index(index_type, storage)
+
+    assert index.storage == storage
+    _, labels = index.search(vectors[:20], 10)
+    np.testing.assert_array_equal(labels[:, 0], ids[:20])
+
+@pytest.mark.parametrize("storage", ["float32", "pq"])
+def test_ann_search_skips_reranking(storage):
+    index, ids, vectors = _shop_index("Flat", storage)
+
+    scores, labels = index.ann_search(vectors[:20], 10)
+    assert labels.shape == (20, 10)
+    assert np.isin(labels, ids).all()
+
+    exact_scores, exact_labels = index.search(vectors[:20], 10)
+    if storage == "float32":
+        np.testing.assert_array_equal(labels, exact_labels)
+    else:
+        # PQ scores are approximations of the re-ranked inner products
+        assert not np.allclose(scores, exact_scores)
+
+def test_auto_picks_type_by_size(monkeypatch):
+    monkeypatch.setattr(settings, "AUTO_INDEX_HNSW_MIN_VECTORS", 500)
+    monkeypatch.setattr(settings, "AUTO_INDEX_IVFPQ_MIN_VECTORS", 1500)
+
+    for n, expected in ((300, "Flat"), (1000, "HNSW"), (N_VECTORS, "IVFPQ")):
+        index, ids, vectors = _shop_index("auto", n=n)
+        assert index.index_type == expected
+        _, labels = index.search(vectors[:5], 5)
+        np.testing.assert_array_equal(labels[:, 0], ids[:5])
+
+@pytest.mark.parametrize("index_type", ["Flat", "HNSW", "IVFPQ"])
+def test_duplicate_range_search(index_type):
+    ids, vectors = _product_ids(N_VECTORS), _vectors(N_VECTORS)
+    near_copy = vectors[0] + 0.01 * _vectors(1, seed=1)[0]
+    vectors[1] = near_copy / np.linalg.norm(near_copy)
+
+    index = ShopIndex.create(DIMENSION)
+    index.upsert(ids, vectors)
+    index.optimize(index_type)
+
+    table = find_duplicate_clusters(index, threshold=0.97, block_size=256)
+    assert set(table["id"].tolist()) == {int(ids[0]), int(ids[1])}
+    assert set(table["cluster"].tolist()) == {int(ids[0])}
+
+@pytest.mark.parametrize("index_type", ["Flat", "HNSW", "IVFPQ"])
+def test_live_count_tracks_upserts_and_removals(index_type):
+    index, ids, vectors = _shop_index(index_type)
+    replacements = _vectors(100, seed=2)
+
+    index.upsert(ids[:100], replacements)
+    index.remove(ids[50:150])
+    index.upsert(ids[60:70], replacements[:10])
+    index.upsert(_product_ids(N_VECTORS + 5)[-5:], _vectors(5, seed=3))
+
+    assert index.live_count == len(index.product_ids()) == N_VECTORS - 100 + 10 + 5
+    _, labels = index.search(replacements[:3], 1)
+    np.testing.assert_array_equal(labels[:, 0], ids[:3])
+
+    index.compact()
+    assert index.live_count == len(index.product_ids()) == N_VECTORS - 100 + 10 + 5
+
+@pytest.mark.parametrize("index_type, storage", [("Flat", "float32"), ("HNSW", "sq8"), ("IVFPQ", "pq")])
+def test_iter_live_vectors_matches_live_vectors(index_type, storage):
+    index, ids, _ = _shop_index(index_type, storage)
+    index.upsert(ids[:100], _vectors(100, seed=2))
+    index.remove(ids[50:150])
+
+    blocks = list(index.iter_live_vectors(300))
+    assert all(len(block_ids) <= 300 for block_ids, _ in blocks)
+
+    block_ids = np.concatenate([block_ids for block_ids, _ in blocks])
+    block_vectors = np.concatenate([vectors for _, vectors in blocks])
+    live_ids, live_vectors = index.live_vectors()
+    order, live_order = np.argsort(block_ids), np.argsort(live_ids)
+    np.testing.assert_array_equal(block_ids[order], live_ids[live_order])
+    np.testing.assert_allclose(block_vectors[order], live_vectors[live_order], atol=1e-6)
+
+FILTERED_CONFIGS = [
+    ("Flat", "float32"),
+    ("Flat", "pq"),
+    ("HNSW", "float32"),
+    ("HNSW", "sq8"),
+    ("IVFPQ", "pq"),
+]
+
+@pytest.mark.parametrize("index_type, storage", FILTERED_CONFIGS)
+@pytest.mark.parametrize("share", [0.01, 0.3])
+@pytest.mark.parametrize("exact_max_ids", [0, 100_000], ids=["selector", "exact"])
+def test_filtered_search_returns_limit_results(monkeypatch, index_type, storage, share, exact_max_ids):
+    monkeypatch.setattr(settings, "FAISS_FILTER_EXACT_MAX_IDS", exact_max_ids)
+    index, ids, vectors = _shop_index(index_type, storage)
+    allowed = np.random.default_rng(4).choice(ids, int(N_VECTORS * share), replace=False)
+    queries = _vectors(10, seed=5)
+    limit = 10
+
+    scores, labels = index.search(queries, limit, allowed)
+
+    assert labels.shape == (len(queries), limit)
+    assert (labels >= 0).all()
+    assert np.isin(labels, allowed).all()
+    assert all(len(set(row)) == limit for row in labels.tolist())
+    assert np.isfinite(scores).all()
+
+    if storage == "float32" and index_type == "Flat":
+        in_filter = np.isin(ids, allowed)
+        truth = ids[in_filter][np.argsort(-(queries @ vectors[in_filter].T), axis=1)[:, :limit]]
+        np.testing.assert_array_equal(labels, truth)
+
+@pytest.mark.parametrize("index_type", ["Flat", "HNSW", "IVFPQ"])
+def test_filtered_search_after_upserts_and_removals(index_type):
+    index, ids, _ = _shop_index(index_type)
+    replacements = _vectors(5, seed=6)
+
+    # HNSW and IVFPQ keep these in the delta index until compaction
+    index.upsert(ids[:5], replacements)
+    index.remove(ids[5:10])
+    allowed = ids[:50]
+
+    _, labels = index.search(replacements, 3, allowed)
+    np.testing.assert_array_equal(labels[:, 0], ids[:5])
+    assert not np.isin(labels, ids[5:10]).any()
+
+    _, labels = index.search(replacements, 10, ids[:8])
+    assert labels.shape == (5, 5)
+    assert set(labels.ravel().tolist()) == set(ids[:5].tolist())
+
+    _, labels = index.search(replacements, 10, ids[5:10])
+    assert labels.shape == (5, 0)
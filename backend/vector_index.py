@@ -0,0 +1,969 @@
+"""
+Per-shop FAISS index with exactly one vector per product ID
+
+Index types:
+- Flat: exact inner-product scan
+- HNSW: graph index, no training
+- IVFPQ: inverted lists with product-quantized codes, trained on the shop's vectors
+- auto: picks one of the above from the shop's vector count
+
+Storage modes for Flat and HNSW vectors (IVFPQ always stores PQ codes):
+- float32: full precision
+- fp16: half-precision scalar quantizer
+- sq8: 8-bit scalar quantizer
+- pq: product quantizer with a configurable code size in bytes
+
+Optional dimensionality reduction (uncentered PCA or OPQ) wraps the index in
+an IndexPreTransform, so adds and searches project vectors to 128/256 dims
+inside FAISS and the projection is saved in the same index file.
+
+Compressed or reduced indices keep full-precision vectors in an
+ExactVectorStore and re-rank their top candidates against it.
+"""
+
+import math
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Set, Tuple
+import numpy as np
+import faiss
+import structlog
+
+from config import settings
+from exact_vectors import ExactVectorStore
+
+logger = structlog.get_logger()
+
+INDEX_TYPES = ("Flat", "HNSW", "IVFPQ", "auto")
+STORAGE_MODES = ("float32", "fp16", "sq8", "pq")
+
+REDUCE_METHODS = ("pca", "opq")
+
+# Projections trained on fewer vectors than this generalize poorly
+REDUCE_MIN_VECTORS = 1024
+
+# Rows sampled to train a projection
+REDUCE_TRAIN_SAMPLE = 100000
+
+_STORAGE_CODES = {"float32": "Flat", "fp16": "SQfp16", "sq8": "SQ8"}
+
+def _as_ids(ids: Iterable) -> np.ndarray:
+    return np.asarray([int(i) for i in ids], dtype=np.int64)
+
+def _merge_top_k(
+    all_scores: List[np.ndarray],
+    all_labels: List[np.ndarray],
+    k: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Merge per-index results by descending score; empty (-1) slots sink to the end"""
+    scores = np.concatenate(all_scores, axis=1)
+    labels = np.concatenate(all_labels, axis=1)
+    scores = np.where(labels < 0, -np.inf, scores)
+
+    order = np.argsort(-scores, axis=1, kind="stable")[:, :k]
+    scores = np.take_along_axis(scores, order, axis=1)
+    labels = np.take_along_axis(labels, order, axis=1)
+    return scores.astype(np.float32), labels
+
+def _exact_top_k(queries: np.ndarray, ids: np.ndarray, vectors: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Brute-force inner-product top-k, padded with -1 when there are fewer than k vectors"""
+    scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+    labels = np.full((len(queries), k), -1, dtype=np.int64)
+    if not len(ids):
+        return scores, labels
+
+    all_scores = queries @ np.asarray(vectors, dtype=np.float32).T
+    take = min(k, len(ids))
+    if take < len(ids):
+        top = np.argpartition(-all_scores, take - 1, axis=1)[:, :take]
+    else:
+        top = np.broadcast_to(np.arange(len(ids)), (len(queries), len(ids)))
+    top_scores = np.take_along_axis(all_scores, top, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind="stable")
+
+    scores[:, :take] = np.take_along_axis(top_scores, order, axis=1)
+    labels[:, :take] = ids[np.take_along_axis(top, order, axis=1)]
+    return scores, labels
+
+def _flat_vectors(index: faiss.Index) -> np.ndarray:
+    """(ntotal, d) view of an IndexFlat's vectors, without copying"""
+    return faiss.rev_swig_ptr(index.get_xb(), index.ntotal * index.d).reshape(index.ntotal, index.d)
+
+def resolve_index_type(configured: str, n_vectors: int) -> str:
+    """Concrete index type for a configured type and catalog size"""
+    if configured not in INDEX_TYPES:
+        raise ValueError(f"Unknown FAISS index type: {configured}")
+
+    if configured != "auto":
+        return configured
+    if n_vectors >= settings.AUTO_INDEX_IVFPQ_MIN_VECTORS:
+        return "IVFPQ"
+    if n_vectors >= settings.AUTO_INDEX_HNSW_MIN_VECTORS:
+        return "HNSW"
+    return "Flat"
+
+def resolve_storage(index_type: str, storage: str) -> str:
+    """Effective storage mode of a concrete index type"""
+    if storage not in STORAGE_MODES:
+        raise ValueError(f"Unknown vector storage mode: {storage}")
+    return "pq" if index_type == "IVFPQ" else storage
+
+def validate_pq_code_size(code_size: int, dimension: int):
+    """PQ splits vectors into code_size sub-vectors of one byte each"""
+    if code_size <= 0 or dimension % code_size:
+        raise ValueError(f"PQ code size must divide the embedding dimension {dimension}, got {code_size}")
+
+def validate_reduction(reduce_dim: int, method: str, dimension: int):
+    if method not in REDUCE_METHODS:
+        raise ValueError(f"Unknown reduction method: {method}")
+    if reduce_dim < 0 or reduce_dim >= dimension:
+        raise ValueError(f"Reduced dimension must be between 1 and {dimension - 1}, or 0 to disable")
+
+def train_projection(
+    vectors: np.ndarray,
+    reduce_dim: int,
+    method: str = "pca",
+    code_size: Optional[int] = None
+) -> faiss.VectorTransform:
+    """Train a projection from the vectors' dimension down to reduce_dim
+
+    PCA is uncentered (top eigenvectors of the second-moment matrix): a
+    centered PCA adds a per-vector offset to inner products and reorders
+    cosine results. OPQ learns a rotation suited to PQ codes.
+    """
+    if len(vectors) > REDUCE_TRAIN_SAMPLE:
+        rows = np.random.default_rng(0).choice(len(vectors), REDUCE_TRAIN_SAMPLE, replace=False)
+        vectors = vectors[rows]
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    dimension = vectors.shape[1]
+
+    if method == "opq":
+        m = math.gcd(code_size or settings.IVFPQ_CODE_SIZE, reduce_dim)
+        transform = faiss.OPQMatrix(dimension, m, reduce_dim)
+        transform.train(vectors)
+        return transform
+
+    moments = vectors.T.astype(np.float64) @ vectors.astype(np.float64)
+    _, eigenvectors = np.linalg.eigh(moments)  # ascending eigenvalues
+    projection = eigenvectors[:, ::-1][:, :reduce_dim].T
+
+    transform = faiss.LinearTransform(dimension, reduce_dim, False)
+    faiss.copy_array_to_vector(np.ascontiguousarray(projection, dtype=np.float32).ravel(), transform.A)
+    transform.is_trained = True
+    transform.set_is_orthonormal()
+    return transform
+
+def explained_variance(transform: faiss.VectorTransform, vectors: np.ndarray) -> float:
+    """Share of the vectors' (uncentered) energy kept by a projection"""
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    projected = transform.apply(vectors)
+    return float(np.sum(projected.astype(np.float64) ** 2) / np.sum(vectors.astype(np.float64) ** 2))
+
+def global_transform_path(method: str, reduce_dim: int) -> Path:
+    """Projection shared by all shops, written by `python ml_tools.py train-transform`"""
+    return Path(settings.FAISS_DIR) / f"global.{method}{reduce_dim}.transform"
+
+def load_global_transform(method: str, reduce_dim: int) -> Optional[faiss.VectorTransform]:
+    path = global_transform_path(method, reduce_dim)
+    if not path.exists():
+        return None
+    return faiss.read_VectorTransform(str(path))
+
+def index_description(
+    index_type: str,
+    n_vectors: int,
+    storage: str = "float32",
+    code_size: Optional[int] = None
+) -> str:
+    """faiss.index_factory description for an index type and storage mode"""
+    code_size = code_size or settings.IVFPQ_CODE_SIZE
+    codes = f"PQ{code_size}" if storage == "pq" else _STORAGE_CODES[storage]
+
+    if index_type == "HNSW":
+        suffix = "" if storage == "float32" else f",{codes}"
+        return f"IDMap2,HNSW{settings.HNSW_M}{suffix}"
+
+    if index_type == "IVFPQ":
+        # ~4*sqrt(n) lists, keeping >= 39 training points per centroid
+        nlist = max(1, min(int(4 * math.sqrt(n_vectors)), n_vectors // 39, 65536))
+        return f"IDMap2,IVF{nlist},PQ{code_size}"
+
+    return f"IDMap2,{codes}"
+
+def build_index(
+    dimension: int,
+    index_type: str,
+    ids: np.ndarray,
+    vectors: np.ndarray,
+    storage: str = "float32",
+    code_size: Optional[int] = None,
+    transform: Optional[faiss.VectorTransform] = None
+) -> faiss.Index:
+    """Create, train if needed, and fill an ID-mapped index
+
+    A trained transform projects vectors before they reach the index.
+    """
+    # PQ needs at least 256 training points for its 8-bit codebooks
+    if index_type == "IVFPQ" and len(ids) < 256:
+        logger.warning(f"Too few vectors ({len(ids)}) to train IVFPQ, using Flat")
+        index_type = "Flat"
+    if storage == "pq" and index_type != "IVFPQ" and len(ids) < 256:
+        logger.warning(f"Too few vectors ({len(ids)}) to train PQ storage, using float32")
+        storage = "float32"
+    if not len(ids):
+        # Quantizers cannot be trained on an empty catalog
+        storage = "float32" if index_type != "IVFPQ" else storage
+
+    description = index_description(index_type, len(ids), resolve_storage(index_type, storage), code_size)
+    if transform is None:
+        index = faiss.index_factory(dimension, description, faiss.METRIC_INNER_PRODUCT)
+    else:
+        sub_index = faiss.index_factory(
+            transform.d_out, description[len("IDMap2,"):], faiss.METRIC_INNER_PRODUCT
+        )
+        index = faiss.IndexIDMap2(faiss.IndexPreTransform(transform, sub_index))
+
+    if not index.is_trained:
+        index.train(vectors)
+    if len(ids):
+        index.add_with_ids(vectors, ids)
+    return index
+
+def _pre_transform(index: faiss.Index) -> Optional[faiss.IndexPreTransform]:
+    base = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+    return base if isinstance(base, faiss.IndexPreTransform) else None
+
+def _inner_index(index: faiss.Index) -> faiss.Index:
+    """Index below the ID map and any projection"""
+    base = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+    if isinstance(base, faiss.IndexPreTransform):
+        return faiss.downcast_index(base.index)
+    return base
+
+def _index_type_of(index: faiss.Index) -> str:
+    base = _inner_index(index)
+    if isinstance(base, faiss.IndexHNSW):
+        return "HNSW"
+    if isinstance(base, faiss.IndexIVF):
+        return "IVFPQ"
+    return "Flat"
+
+def _codes_index(index: faiss.Index) -> faiss.Index:
+    """Sub-index holding the vector codes"""
+    base = _inner_index(index)
+    if isinstance(base, faiss.IndexHNSW):
+        return faiss.downcast_index(base.storage)
+    return base
+
+def _storage_of(index: faiss.Index) -> str:
+    codes = _codes_index(index)
+    if isinstance(codes, (faiss.IndexPQ, faiss.IndexIVFPQ)):
+        return "pq"
+    if isinstance(codes, faiss.IndexScalarQuantizer):
+        return "fp16" if codes.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else "sq8"
+    return "float32"
+
+class ShopIndex:
+    """FAISS IndexIDMap2 wrapper with upsert and delete semantics
+
+    Index types that cannot remove vectors (HNSW) tombstone deleted IDs and
+    take replacement vectors into a small exact delta index. Search merges
+    both and filters tombstones; compaction folds everything back into one
+    index of the main type.
+    """
+
+    def __init__(
+        self,
+        index: faiss.Index,
+        tombstones: Optional[Set[int]] = None,
+        exact: Optional[ExactVectorStore] = None
+    ):
+        self.index = index
+        self.exact = exact
+        self.delta: Optional[faiss.Index] = None
+        self._ids: Set[int] = set(self._stored_ids(index).tolist())
+        # Always a subset of _ids; replaced vectors of tombstoned IDs live in the delta
+        self.tombstones: Set[int] = set(tombstones or ()) & self._ids
+        self._delta_ids: Set[int] = set()
+        self._supports_remove = self._initial_remove_support()
+        # (product ID per row, argsort of those IDs, sorted IDs), built on first filtered search
+        self._row_lookup: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]] = None
+
+        # Per-shop search-time knobs
+        self.nprobe = settings.FAISS_NPROBE
+        self.ef_search = settings.FAISS_EF_SEARCH
+        self.rerank_factor = settings.FAISS_RERANK_FACTOR
+
+    @classmethod
+    def create(cls, dimension: int) -> "ShopIndex":
+        """Create an empty exact inner-product index"""
+        index = faiss.index_factory(dimension, "IDMap2,Flat", faiss.METRIC_INNER_PRODUCT)
+        return cls(index)
+
+    @classmethod
+    def from_faiss(cls, index: faiss.Index, exact: Optional[ExactVectorStore] = None) -> "ShopIndex":
+        """Wrap an index read from disk"""
+        if isinstance(index, faiss.IndexIDMap2):
+            return cls(index, exact=exact)
+        if index.ntotal > 0:
+            raise ValueError("Index has no product ID map, re-index the shop")
+        return cls(faiss.IndexIDMap2(index), exact=exact)
+
+    @classmethod
+    def load(cls, path: str, exact: Optional[ExactVectorStore] = None) -> "ShopIndex":
+        """Read an index file"""
+        return cls.from_faiss(faiss.read_index(path), exact)
+
+    def save(self, path: str):
+        """Write the index, folding tombstones and the delta in first
+
+        Full-precision vectors of compressed indices are saved separately
+        through `exact`.
+        """
+        self.compact()
+        faiss.write_index(self.index, path)
+
+    @property
+    def dimension(self) -> int:
+        return self.index.d
+
+    @property
+    def index_type(self) -> str:
+        return _index_type_of(self.index)
+
+    @property
+    def storage(self) -> str:
+        return _storage_of(self.index)
+
+    @property
+    def reduction(self) -> Optional[Tuple[str, int]]:
+        """(method, reduced dimension) of the projection, if any"""
+        pre_transform = _pre_transform(self.index)
+        if pre_transform is None:
+            return None
+        transform = faiss.downcast_VectorTransform(pre_transform.chain.at(0))
+        method = "opq" if isinstance(transform, faiss.OPQMatrix) else "pca"
+        return method, transform.d_out
+
+    @property
+    def stored_dimension(self) -> int:
+        """Dimension of the vectors the index stores"""
+        reduction = self.reduction
+        return reduction[1] if reduction else self.dimension
+
+    @property
+    def pq_code_size(self) -> Optional[int]:
+        codes = _codes_index(self.index)
+        if isinstance(codes, (faiss.IndexPQ, faiss.IndexIVFPQ)):
+            return codes.pq.M
+        return None
+
+    @property
+    def ntotal(self) -> int:
+        """Vectors physically stored, including tombstones"""
+        delta_total = self.delta.ntotal if self.delta is not None else 0
+        return self.index.ntotal + delta_total
+
+    @property
+    def live_count(self) -> int:
+        """Vectors that can be returned by search"""
+        # Delta IDs are tombstoned in the main index, so they are not counted twice
+        return len(self._ids) - len(self.tombstones) + len(self._delta_ids)
+
+    @staticmethod
+    def _stored_ids(index: faiss.Index) -> np.ndarray:
+        """Product IDs in storage order"""
+        return faiss.vector_to_array(index.id_map).astype(np.int64)
+
+    def product_ids(self) -> Set[int]:
+        """IDs of live products"""
+        return (self._ids - self.tombstones) | self._delta_ids
+
+    def _initial_remove_support(self) -> Optional[bool]:
+        # IDMap2 removal assumes the sub-index renumbers rows, which IVF does not
+        return False if self.index_type == "IVFPQ" else None
+
+    def _try_remove(self, ids: np.ndarray) -> bool:
+        """Physically remove IDs from the main index, False if the type cannot"""
+        if self._supports_remove is False:
+            return False
+        try:
+            self.index.remove_ids(ids)
+        except RuntimeError:
+            self._supports_remove = False
+            return False
+        self._supports_remove = True
+        self._ids.difference_update(ids.tolist())
+        self.tombstones.difference_update(ids.tolist())
+        self._row_lookup = None
+        return True
+
+    def _delta_upsert(self, ids: np.ndarray, vectors: np.ndarray):
+        if self.delta is None:
+            self.delta = faiss.index_factory(self.dimension, "IDMap2,Flat", faiss.METRIC_INNER_PRODUCT)
+        existing = np.asarray([i for i in ids.tolist() if i in self._delta_ids], dtype=np.int64)
+        if len(existing):
+            self.delta.remove_ids(existing)
+        self.delta.add_with_ids(vectors, ids)
+        self._delta_ids.update(ids.tolist())
+
+    def live_vectors(self) -> Tuple[np.ndarray, np.ndarray]:
+        """(ids, vectors) of every live product"""
+        if self.exact is not None:
+            ids = np.fromiter(self.product_ids(), dtype=np.int64)
+            vectors, found = self.exact.lookup(ids)
+            if found.all():
+                return ids, vectors
+            logger.warning(f"{int((~found).sum())} vectors missing from exact store, using index codes")
+
+        parts_ids: List[np.ndarray] = []
+        parts_vectors: List[np.ndarray] = []
+
+        if self.index.ntotal:
+            # Through a projection this reverses it, which is lossy
+            base = faiss.downcast_index(self.index.index)
+            inner = _inner_index(self.index)
+            if isinstance(inner, faiss.IndexIVF):
+                inner.make_direct_map()
+            stored_ids = self._stored_ids(self.index)
+            vectors = base.reconstruct_n(0, self.index.ntotal)
+            keep = ~np.isin(stored_ids, np.fromiter(self.tombstones | self._delta_ids, dtype=np.int64))
+            parts_ids.append(stored_ids[keep])
+            parts_vectors.append(vectors[keep])
+
+        if self.delta is not None and self.delta.ntotal:
+            parts_ids.append(self._stored_ids(self.delta))
+            parts_vectors.append(faiss.downcast_index(self.delta.index).reconstruct_n(0, self.delta.ntotal))
+
+        if not parts_ids:
+            return np.empty(0, dtype=np.int64), np.empty((0, self.dimension), dtype=np.float32)
+        return np.concatenate(parts_ids), np.concatenate(parts_vectors)
+
+    def iter_live_vectors(self, block_size: int) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """(ids, vectors) of live products, at most block_size at a time
+
+        Unlike live_vectors(), only one block of vectors is in memory at
+        once: consecutive storage rows are read from the exact store, or
+        reconstructed from the index for products it lacks.
+        """
+        sources = []
+        if self.index.ntotal:
+            inner = _inner_index(self.index)
+            if isinstance(inner, faiss.IndexIVF):
+                inner.make_direct_map()
+            sources.append((self.index, np.fromiter(self.tombstones | self._delta_ids, dtype=np.int64)))
+        if self.delta is not None and self.delta.ntotal:
+            sources.append((self.delta, np.empty(0, dtype=np.int64)))
+
+        for index, dead in sources:
+            stored_ids = self._stored_ids(index)
+            base = faiss.downcast_index(index.index)
+            for start in range(0, index.ntotal, block_size):
+                keep = ~np.isin(stored_ids[start:start + block_size], dead)
+                ids = stored_ids[start:start + block_size][keep]
+                if not len(ids):
+                    continue
+
+                found = None
+                if self.exact is not None:
+                    vectors, found = self.exact.lookup(ids)
+                if found is None or not found.all():
+                    # Through a projection this reverses it, which is lossy
+                    reconstructed = base.reconstruct_n(start, len(keep))[keep]
+                    vectors = reconstructed if found is None else np.where(found[:, None], vectors, reconstructed)
+                yield ids, vectors
+
+    def _rebuild(
+        self,
+        index_type: Optional[str] = None,
+        storage: str = "float32",
+        code_size: Optional[int] = None,
+        reduction: Optional[Tuple[str, int]] = None,
+        transform: Optional[faiss.VectorTransform] = None
+    ):
+        """Rebuild from live vectors, or into a new index type, storage and projection
+
+        Without an index type the index keeps its configuration. A reduction
+        without a pre-trained transform trains one on the live vectors.
+        """
+        ids, vectors = self.live_vectors()
+
+        if index_type is None:
+            # Clone keeps trained state (e.g. coarse quantizers); reset empties storage
+            rebuilt = faiss.clone_index(self.index)
+            rebuilt.reset()
+            if len(ids):
+                rebuilt.add_with_ids(vectors, ids)
+        else:
+            if reduction is not None and transform is None:
+                method, reduce_dim = reduction
+                transform = train_projection(vectors, reduce_dim, method, code_size)
+                logger.info(
+                    f"Trained {method} projection to {reduce_dim} dims, "
+                    f"explained variance {explained_variance(transform, vectors):.3f}"
+                )
+            rebuilt = build_index(self.dimension, index_type, ids, vectors, storage, code_size, transform)
+
+        self.index = rebuilt
+        # Compressed or projected codes are re-ranked against the original vectors
+        lossy = self.storage != "float32" or self.reduction is not None
+        self.exact = ExactVectorStore.from_arrays(ids, vectors) if lossy else None
+        self.delta = None
+        self.tombstones = set()
+        self._ids = set(ids.tolist())
+        self._delta_ids = set()
+        self._supports_remove = self._initial_remove_support()
+        self._row_lookup = None
+
+    def upsert(self, ids: Iterable, vectors: np.ndarray):
+        """Insert or replace vectors so each ID has exactly one"""
+        ids = _as_ids(ids)
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(len(ids), -1)
+
+        # Keep the last vector for IDs repeated within the batch
+        _, last_positions = np.unique(ids[::-1], return_index=True)
+        if len(last_positions) != len(ids):
+            keep = np.sort(len(ids) - 1 - last_positions)
+            ids, vectors = ids[keep], vectors[keep]
+
+        if self.exact is not None:
+            self.exact.upsert(ids, vectors)
+
+        in_main = np.isin(ids, np.fromiter(self._ids, dtype=np.int64))
+        existing = ids[in_main]
+
+        if not len(existing) or self._try_remove(existing):
+            self.index.add_with_ids(vectors, ids)
+            self._row_lookup = None
+            self._ids.update(ids.tolist())
+            self.tombstones.difference_update(ids.tolist())
+            return
+
+        # Main index cannot replace in place: shadow old vectors via the delta
+        self.tombstones.update(existing.tolist())
+        self._delta_upsert(existing, vectors[in_main])
+        if (~in_main).any():
+            self.index.add_with_ids(vectors[~in_main], ids[~in_main])
+            self._row_lookup = None
+            self._ids.update(ids[~in_main].tolist())
+
+    def remove(self, ids: Iterable) -> int:
+        """Delete products, returning how many were present"""
+        ids = _as_ids(ids)
+        live = self.product_ids()
+        present = np.asarray([i for i in ids.tolist() if i in live], dtype=np.int64)
+        if not len(present):
+            return 0
+
+        if self.exact is not None:
+            self.exact.remove(present)
+
+        in_delta = np.asarray([i for i in present.tolist() if i in self._delta_ids], dtype=np.int64)
+        if len(in_delta):
+            self.delta.remove_ids(in_delta)
+            self._delta_ids.difference_update(in_delta.tolist())
+
+        in_main = np.asarray(
+            [i for i in present.tolist() if i in self._ids and i not in self.tombstones],
+            dtype=np.int64
+        )
+        if len(in_main) and not self._try_remove(in_main):
+            self.tombstones.update(in_main.tolist())
+        return len(present)
+
+    def compact(self):
+        """Fold tombstones and the delta back into the main index"""
+        if self.tombstones or self._delta_ids:
+            self._rebuild()
+
+    def optimize(
+        self,
+        configured_type: str,
+        storage: str = "float32",
+        code_size: Optional[int] = None,
+        reduce_dim: int = 0,
+        reduce_method: str = "pca",
+        transform: Optional[faiss.VectorTransform] = None
+    ):
+        """Rebuild into the index type, storage and projection the catalog size and settings call for
+
+        `transform` is a pre-trained (global) projection used instead of
+        training one on this shop's vectors.
+        """
+        target_type = resolve_index_type(configured_type, self.live_count)
+        target_storage = resolve_storage(target_type, storage)
+        code_size = code_size or settings.IVFPQ_CODE_SIZE
+
+        target_reduction = (reduce_method, reduce_dim) if reduce_dim else None
+        if target_reduction is not None and transform is None and self.live_count < REDUCE_MIN_VECTORS:
+            # Too few vectors to train a projection, keep the current one
+            target_reduction = self.reduction
+
+        changed = (
+            target_type != self.index_type
+            or target_storage != self.storage
+            or target_reduction != self.reduction
+        )
+        if target_storage == "pq" and not changed:
+            changed = self.pq_code_size != code_size
+
+        # Types that need more training points than the catalog has stay as they are
+        if changed and self._can_build(target_type, target_storage):
+            logger.info(
+                f"Rebuilding {self.index_type}/{self.storage} index as "
+                f"{target_type}/{target_storage} for {self.live_count} vectors"
+                f"{f', reduced to {target_reduction[1]} dims' if target_reduction else ''}"
+            )
+            self._rebuild(
+                target_type,
+                target_storage,
+                code_size,
+                target_reduction,
+                transform if target_reduction else None
+            )
+        else:
+            self.compact()
+
+    def _can_build(self, index_type: str, storage: str) -> bool:
+        if storage == "pq" or index_type == "IVFPQ":
+            return self.live_count >= 256
+        return storage == "float32" or self.live_count > 0
+
+    def _apply_search_knobs(self):
+        """Set nprobe / efSearch on the index below the ID map
+
+        IndexIDMap2 rejects per-call SearchParameters before faiss 1.8, so
+        the knobs live on the sub-index instead.
+        """
+        inner = _inner_index(self.index)
+        if isinstance(inner, faiss.IndexIVF):
+            inner.nprobe = self.nprobe
+        elif isinstance(inner, faiss.IndexHNSW):
+            inner.hnsw.efSearch = self.ef_search
+
+    def _search_parameters(self, selector: faiss.IDSelector, k: int, selectivity: float) -> faiss.SearchParameters:
+        """Search-time knobs for the main index type, restricted to selector's rows
+
+        The fewer rows pass the filter, the more IVF lists are probed and
+        the wider the HNSW beam, so about as many allowed candidates are
+        seen as an unfiltered search would see.
+        """
+        inner = _inner_index(self.index)
+        if isinstance(inner, faiss.IndexIVF):
+            params = faiss.SearchParametersIVF()
+            params.nprobe = min(inner.nlist, max(self.nprobe, math.ceil(self.nprobe / selectivity)))
+        elif isinstance(inner, faiss.IndexHNSW):
+            params = faiss.SearchParametersHNSW()
+            params.efSearch = max(k, min(math.ceil(self.ef_search / selectivity), self.index.ntotal))
+        else:
+            params = faiss.SearchParameters()
+        params.sel = selector
+        return params
+
+    def _row_index(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        if self._row_lookup is None:
+            stored = self._stored_ids(self.index)
+            order = np.argsort(stored, kind="stable")
+            self._row_lookup = (stored, order, stored[order])
+        return self._row_lookup
+
+    def _resolve_allowed(self, allowed: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """(main-index rows, delta product IDs) holding the live vectors of allowed products"""
+        allowed = np.unique(np.asarray(allowed, dtype=np.int64))
+
+        stored, order, sorted_ids = self._row_index()
+        rows = np.empty(0, dtype=np.int64)
+        if len(sorted_ids) and len(allowed):
+            positions = np.minimum(np.searchsorted(sorted_ids, allowed), len(sorted_ids) - 1)
+            rows = np.sort(order[positions[sorted_ids[positions] == allowed]])
+            if self.tombstones:
+                rows = rows[~np.isin(stored[rows], np.fromiter(self.tombstones, dtype=np.int64))]
+
+        delta_ids = np.empty(0, dtype=np.int64)
+        if self._delta_ids:
+            delta_ids = allowed[np.isin(allowed, np.fromiter(self._delta_ids, dtype=np.int64))]
+        return rows, delta_ids
+
+    def search(
+        self,
+        queries: np.ndarray,
+        k: int,
+        allowed: Optional[np.ndarray] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Top-k (scores, product IDs) per query; missing slots have ID -1
+
+        With `allowed`, only those product IDs are considered, and the
+        result holds k of them whenever that many are indexed.
+        """
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        n_queries = len(queries)
+        if allowed is not None:
+            rows, delta_ids = self._resolve_allowed(allowed)
+            k = min(k, len(rows) + len(delta_ids))
+        k = min(k, self.live_count)
+        if k <= 0:
+            empty = np.full((n_queries, 0), -1, dtype=np.int64)
+            return empty.astype(np.float32), empty
+
+        # Compressed codes are over-fetched, then re-scored exactly
+        fetch_k = k if self.exact is None else min(k * max(1, self.rerank_factor), self.live_count)
+        if allowed is None:
+            scores, labels = self._candidates(queries, fetch_k)
+        else:
+            scores, labels = self._filtered_candidates(queries, fetch_k, rows, delta_ids)
+
+        if self.exact is None:
+            return scores, labels
+        return self._rerank(queries, labels, k)
+
+    def ann_search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Top-k straight from the ANN index, before any exact re-scoring
+
+        Scores of compressed or reduced indices are approximate; search()
+        is what serving uses. This is for measuring what re-ranking buys.
+        """
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        k = min(k, self.live_count)
+        if k <= 0:
+            empty = np.full((len(queries), 0), -1, dtype=np.int64)
+            return empty.astype(np.float32), empty
+        return self._candidates(queries, k)
+
+    def _rerank(self, queries: np.ndarray, labels: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Re-score candidates against full-precision vectors and keep the top k"""
+        vectors, found = self.exact.lookup(labels)
+        scores = np.einsum("qkd,qd->qk", vectors, queries)
+
+        valid = found & (labels >= 0)
+        scores = np.where(valid, scores, -np.inf)
+        labels = np.where(valid, labels, -1)
+
+        order = np.argsort(-scores, axis=1, kind="stable")[:, :k]
+        scores = np.take_along_axis(scores, order, axis=1)
+        labels = np.take_along_axis(labels, order, axis=1)
+        return scores.astype(np.float32), labels
+
+    def _candidates(
+        self,
+        queries: np.ndarray,
+        k: int,
+        allowed: Optional[np.ndarray] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Top-k from the main and delta indices, with tombstones filtered"""
+        if allowed is not None:
+            return self._filtered_candidates(queries, k, *self._resolve_allowed(allowed))
+
+        all_scores, all_labels = [], []
+
+        if self.index.ntotal:
+            # Over-fetch so tombstoned hits can be dropped
+            fetch_k = min(k + len(self.tombstones), self.index.ntotal)
+            self._apply_search_knobs()
+            scores, labels = self.index.search(queries, fetch_k)
+
+            if self.tombstones:
+                dead = np.isin(labels, np.fromiter(self.tombstones, dtype=np.int64))
+                scores = np.where(dead, -np.inf, scores)
+                labels = np.where(dead, -1, labels)
+            all_scores.append(scores)
+            all_labels.append(labels)
+
+        if self.delta is not None and self.delta.ntotal:
+            scores, labels = self.delta.search(queries, min(k, self.delta.ntotal))
+            all_scores.append(scores)
+            all_labels.append(labels)
+
+        return _merge_top_k(all_scores, all_labels, k)
+
+    def _filtered_candidates(
+        self,
+        queries: np.ndarray,
+        k: int,
+        rows: np.ndarray,
+        delta_ids: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Top-k among allowed main-index rows and delta products (see _resolve_allowed)
+
+        Filters matching few products are scanned exactly; larger ones go
+        through an ID selector on the main index.
+        """
+        all_scores, all_labels = [], []
+
+        if len(rows):
+            main_k = min(k, len(rows))
+            if len(rows) <= settings.FAISS_FILTER_EXACT_MAX_IDS:
+                scores, labels = self._exact_rows(queries, main_k, rows)
+            else:
+                scores, labels = self._selector_search(queries, main_k, rows)
+            all_scores.append(scores)
+            all_labels.append(labels)
+
+        if len(delta_ids):
+            stored = self._stored_ids(self.delta)
+            keep = np.flatnonzero(np.isin(stored, delta_ids))
+            vectors = _flat_vectors(faiss.downcast_index(self.delta.index))[keep]
+            scores, labels = _exact_top_k(queries, stored[keep], vectors, min(k, len(keep)))
+            all_scores.append(scores)
+            all_labels.append(labels)
+
+        return _merge_top_k(all_scores, all_labels, k)
+
+    def _row_vectors(self, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """(product IDs, full-precision vectors) of main-index rows"""
+        ids = self._row_index()[0][rows]
+        if self.exact is not None:
+            vectors, found = self.exact.lookup(ids)
+            return ids[found], vectors[found]
+
+        codes = _codes_index(self.index)
+        if self.reduction is None and isinstance(codes, faiss.IndexFlat):
+            return ids, _flat_vectors(codes)[rows]
+
+        # Compressed without an exact store: decode the codes
+        inner = _inner_index(self.index)
+        if isinstance(inner, faiss.IndexIVF):
+            inner.make_direct_map()
+        base = faiss.downcast_index(self.index.index)
+        vectors = np.vstack([base.reconstruct(int(row)) for row in rows.tolist()])
+        return ids, vectors
+
+    def _exact_rows(self, queries: np.ndarray, k: int, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Exact top-k over main-index rows"""
+        ids, vectors = self._row_vectors(rows)
+        return _exact_top_k(queries, ids, vectors, k)
+
+    def _selector_search(self, queries: np.ndarray, k: int, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Approximate top-k restricted to main-index rows
+
+        IndexIDMap2 rejects selectors before faiss 1.8, so the search runs
+        on the index below the ID map with a bitmap over row numbers, which
+        stays compact however sparse the product IDs are. Queries the
+        approximate search leaves with fewer than k hits are answered
+        exactly, so a filter never returns short.
+        """
+        ntotal = self.index.ntotal
+        mask = np.zeros(ntotal, dtype=bool)
+        mask[rows] = True
+        bitmap = np.packbits(mask, bitorder="little")
+        selector = faiss.IDSelectorBitmap(len(bitmap), faiss.swig_ptr(bitmap))
+        base = faiss.downcast_index(self.index.index)
+
+        try:
+            scores, found = base.search(
+                queries, k, params=self._search_parameters(selector, k, len(rows) / ntotal)
+            )
+        except RuntimeError as e:
+            # Some codecs (flat PQ, older HNSW) reject search parameters
+            logger.warning(f"{self.index_type} search rejected the ID selector ({str(e)}), post-filtering")
+            scores, found = self._post_filtered_search(base, queries, k, mask)
+
+        stored = self._row_index()[0]
+        valid = found >= 0
+        labels = np.where(valid, stored[np.maximum(found, 0)], -1)
+        scores = np.where(valid, scores, -np.inf).astype(np.float32)
+
+        short = valid.sum(axis=1) < k
+        if short.any():
+            scores[short], labels[short] = self._exact_rows(queries[short], k, rows)
+        return scores, labels
+
+    def _post_filtered_search(
+        self,
+        base: faiss.Index,
+        queries: np.ndarray,
+        k: int,
+        mask: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Top-k rows within mask from an unrestricted search of the sub-index
+
+        Over-fetches by the inverse share of allowed rows, doubling until
+        every query has k allowed hits or the index runs out of candidates.
+        """
+        self._apply_search_knobs()
+        ntotal = len(mask)
+        fetch_k = min(ntotal, 2 * k * math.ceil(ntotal / mask.sum()))
+
+        while True:
+            scores, found = base.search(queries, fetch_k)
+            allowed = (found >= 0) & mask[np.maximum(found, 0)]
+            short = allowed.sum(axis=1) < k
+            # IVF returns -1 once its probed lists are exhausted
+            exhausted = (found < 0).any(axis=1)
+            if fetch_k >= ntotal or not (short & ~exhausted).any():
+                break
+            fetch_k = min(ntotal, fetch_k * 2)
+
+        scores = np.where(allowed, scores, -np.inf)
+        found = np.where(allowed, found, -1)
+        order = np.argsort(-scores, axis=1, kind="stable")[:, :k]
+        return np.take_along_axis(scores, order, axis=1), np.take_along_axis(found, order, axis=1)
+
+    def range_search(self, queries: np.ndarray, threshold: float) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """(product IDs, scores) with similarity above threshold, per query
+
+        Compressed indices gather candidates slightly below the threshold
+        and keep those whose exact similarity clears it.
+        """
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        radius = threshold - 0.05 if self.exact is not None else threshold
+        dead = np.fromiter(self.tombstones, dtype=np.int64)
+        parts: List[List[Tuple[np.ndarray, np.ndarray]]] = [[] for _ in range(len(queries))]
+
+        self._apply_search_knobs()
+        for index, filter_dead in ((self.index, True), (self.delta, False)):
+            if index is None or not index.ntotal:
+                continue
+            lims, scores, labels = index.range_search(queries, radius)
+
+            for q in range(len(queries)):
+                q_labels = labels[lims[q]:lims[q + 1]]
+                q_scores = scores[lims[q]:lims[q + 1]]
+                if filter_dead and len(dead):
+                    keep = ~np.isin(q_labels, dead)
+                    q_labels, q_scores = q_labels[keep], q_scores[keep]
+                parts[q].append((q_labels, q_scores))
+
+        results = []
+        for q, q_parts in enumerate(parts):
+            if not q_parts:
+                results.append((np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)))
+                continue
+            labels = np.concatenate([p[0] for p in q_parts]).astype(np.int64)
+            scores = np.concatenate([p[1] for p in q_parts])
+            if self.exact is not None and len(labels):
+                vectors, found = self.exact.lookup(labels)
+                scores = vectors @ queries[q]
+                keep = found & (scores > threshold)
+                labels, scores = labels[keep], scores[keep]
+            results.append((labels, scores.astype(np.float32)))
+        return results
+
+    def code_bytes_per_vector(self) -> int:
+        """Bytes of vector codes per product for the storage mode"""
+        storage = self.storage
+        if storage == "pq":
+            return self.pq_code_size  # one 8-bit centroid index per sub-vector
+        return self.stored_dimension * {"float32": 4, "fp16": 2, "sq8": 1}[storage]
+
+    def bytes_per_vector(self) -> int:
+        """In-memory bytes per product: codes plus ID map and graph/list overhead"""
+        size = self.code_bytes_per_vector() + 8  # IDMap2 product ID
+        base = _inner_index(self.index)
+        if isinstance(base, faiss.IndexHNSW):
+            size += base.hnsw.nb_neighbors(0) * 4  # level-0 links, int32 each
+        elif isinstance(base, faiss.IndexIVF):
+            size += 8  # ID stored in the inverted list
+        return size
+
+    def get_stats(self) -> dict:
+        """Live and tombstoned vector counts and storage footprint"""
+        return {
+            "index_type": self.index_type,
+            "storage": self.storage,
+            "dimension": self.stored_dimension,
+            "live_vectors": self.live_count,
+            "tombstoned_vectors": len(self.tombstones),
+            "total_vectors": self.ntotal,
+            "code_bytes_per_vector": self.code_bytes_per_vector(),
+            "bytes_per_vector": self.bytes_per_vector(),
+            "exact_bytes_per_vector": self.dimension * 4 if self.exact is not None else 0
+        }